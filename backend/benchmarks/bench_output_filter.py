@@ -0,0 +1,113 @@
+"""Throughput benchmark for the SimC output sanitizer.
+
+Replays recorded SimC output through the previous filter, which recompiled
+every rule on every line, and the current SafeOutputFilter, checks both
+produce identical output and reports lines/sec for each. Run from the backend directory:
+
+    python -m benchmarks.bench_output_filter [--repeat N]
+"""
+import argparse
+import os
+import re
+import time
+from pathlib import Path
+
+from core.output_filter import SafeOutputFilter
+from core.simc import SimcClient
+
+DATA_FILE = Path(__file__).parent / "data" / "simc_output.txt"
+
+
+class LegacySafeOutputFilter:
+    """The filter as it was before precompiling, one re.sub per rule; tests check against it"""
+
+    def __init__(self):
+        self.project_root = Path(os.getcwd())
+        self.patterns = [
+            (r'(/[^\s]+)', self._sanitize_path),
+            (r'/home/[^/\s]+', '/home/user'),
+            (r'([A-Z_]+)=([^\s]+)', self._sanitize_env_var),
+            (r'(Linux|Darwin|Windows).*?(\d+\.\d+\.\d+)', 'OS version'),
+            (r'\b(?:(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\.){3}(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\b', 'xxx.xxx.xxx.xxx'),
+            (r'Users/[^/\s]+', 'Users/user'),
+            (r'(?i)(hostname|host)[:=\s]+[^\s]+', r'\1: [hidden]'),
+        ]
+
+    def _sanitize_path(self, match):
+        path = match.group(1)
+        try:
+            if path.startswith(str(self.project_root)):
+                return os.path.relpath(path, self.project_root)
+            else:
+                return os.path.basename(path)
+        except:
+            return '[path]'
+
+    def _sanitize_env_var(self, match):
+        var_name = match.group(1)
+        safe_vars = ['PATH', 'PYTHONPATH', 'LANG', 'LC_ALL']
+        if var_name in safe_vars:
+            return match.group(0)
+        else:
+            return f"{var_name}=[hidden]"
+
+    def filter_line(self, line):
+        filtered_line = line
+        for pattern, replacement in self.patterns:
+            filtered_line = re.sub(pattern, replacement, filtered_line)
+        return filtered_line
+
+
+def legacy_extract_progress(line):
+    """Progress extraction as it was, importing re and compiling per line"""
+    progress_patterns = [
+        r'(\d+)%',
+        r'Progress:\s*(\d+)',
+        r'Completed:\s*(\d+)/(\d+)'
+    ]
+    for pattern in progress_patterns:
+        import re
+        match = re.search(pattern, line)
+        if match:
+            if len(match.groups()) == 2:
+                return (int(match.group(1)) / int(match.group(2))) * 100
+            else:
+                return float(match.group(1))
+    return None
+
+
+def run(lines, filter_line, extract_progress):
+    start = time.perf_counter()
+    output = [(filter_line(line), extract_progress(line)) for line in lines]
+    return output, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=2000, help="times to replay the recording")
+    args = parser.parse_args()
+
+    lines = DATA_FILE.read_text().splitlines() * args.repeat
+    legacy = LegacySafeOutputFilter()
+    current = SafeOutputFilter()
+    # Only the pure helper is needed, skip SimcClient.__init__ side effects
+    client = SimcClient.__new__(SimcClient)
+
+    before, before_secs = run(lines, legacy.filter_line, legacy_extract_progress)
+    after, after_secs = run(lines, current.filter_line, client._extract_progress)
+
+    mismatches = [i for i, (old, new) in enumerate(zip(before, after)) if old != new]
+    print(f"lines:  {len(lines)}")
+    print(f"before: {len(lines) / before_secs:>12,.0f} lines/sec")
+    print(f"after:  {len(lines) / after_secs:>12,.0f} lines/sec ({before_secs / after_secs:.1f}x)")
+    if mismatches:
+        first = mismatches[0]
+        print(f"output differs on {len(mismatches)} lines, first: {lines[first]!r}")
+        print(f"  before: {before[first]!r}")
+        print(f"  after:  {after[first]!r}")
+        raise SystemExit(1)
+    print("output identical")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""Load benchmark for queue position lookups.
+
+Fills a queue N jobs deep, then polls random jobs' positions at a fixed rate,
+once with the old scan of the whole list queue and once through
+JobQueue.position, and reports the rate kept up and the lookup latencies.
+Keys are written to a scratch database which is flushed before and after,
+so point it at a Redis nobody else uses. Run from the backend directory:
+
+    python -m benchmarks.bench_queue_position [--depth N] [--qps N] [--seconds N] [--db N]
+"""
+import argparse
+import random
+import time
+
+import redis
+
+from core.queue import LEGACY_QUEUE, JobQueue
+
+
+def legacy_position(client, job_id):
+    """Position lookup as get_job_status did it, scanning the whole list"""
+    queue = client.lrange(LEGACY_QUEUE, 0, -1)
+    for index, queued_id in enumerate(queue):
+        if queued_id.decode() == job_id:
+            return index + 1
+    return 0
+
+
+def poll(lookup, job_ids, qps, seconds):
+    """Call `lookup` on random jobs `qps` times a second, returns the latencies"""
+    latencies = []
+    interval = 1 / qps
+    start = next_call = time.perf_counter()
+    while next_call - start < seconds:
+        now = time.perf_counter()
+        if now < next_call:
+            time.sleep(next_call - now)
+        call_start = time.perf_counter()
+        lookup(random.choice(job_ids))
+        latencies.append(time.perf_counter() - call_start)
+        next_call += interval
+    return latencies, time.perf_counter() - start
+
+
+def report(name, latencies, elapsed, qps):
+    latencies = sorted(latencies)
+    achieved = len(latencies) / elapsed
+    p50 = latencies[len(latencies) // 2] * 1000
+    p99 = latencies[int(len(latencies) * 0.99)] * 1000
+    kept_up = "kept up" if achieved >= qps * 0.95 else "fell behind"
+    print(f"{name:<8} {achieved:>8,.0f} QPS ({kept_up})  p50 {p50:7.3f} ms  p99 {p99:7.3f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--depth", type=int, default=10000, help="jobs in the queue")
+    parser.add_argument("--qps", type=int, default=1000, help="position lookups per second")
+    parser.add_argument("--seconds", type=float, default=10, help="how long to poll for")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=6379)
+    parser.add_argument("--db", type=int, default=15, help="scratch database, flushed")
+    args = parser.parse_args()
+
+    client = redis.Redis(host=args.host, port=args.port, db=args.db)
+    client.flushdb()
+    try:
+        job_ids = [f"bench-{index}" for index in range(args.depth)]
+        pipe = client.pipeline(transaction=False)
+        for job_id in job_ids:
+            pipe.hset(f"job:{job_id}", mapping={"status": "QUEUED"})
+            pipe.rpush(LEGACY_QUEUE, job_id)
+        pipe.execute()
+
+        job_queue = JobQueue(client, consumer="bench")
+        for index, job_id in enumerate(job_ids):
+            # A few hundred owners so the lane mixes their rounds
+            job_queue.enqueue(job_id, f"user:{index % 300}")
+
+        print(f"depth:   {args.depth} jobs, target {args.qps} QPS for {args.seconds:g}s")
+        report("before", *poll(lambda job_id: legacy_position(client, job_id), job_ids, args.qps, args.seconds), args.qps)
+        report("after", *poll(job_queue.position, job_ids, args.qps, args.seconds), args.qps)
+    finally:
+        client.flushdb()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+import re
+from typing import Any, Dict, List, Optional
+
+from core.topgear import GearItem
+
+# Playable class ids of the Battle.net API and their SimC class options
+SIMC_CLASSES = {
+    1: "warrior",
+    2: "paladin",
+    3: "hunter",
+    4: "rogue",
+    5: "priest",
+    6: "death_knight",
+    7: "shaman",
+    8: "mage",
+    9: "warlock",
+    10: "monk",
+    11: "druid",
+    12: "demon_hunter",
+    13: "evoker",
+}
+
+# Equipment slot types of the Battle.net API and their SimC slots, shirts and
+# tabards do nothing in a simulation
+SIMC_SLOTS = {
+    "HEAD": "head",
+    "NECK": "neck",
+    "SHOULDER": "shoulder",
+    "BACK": "back",
+    "CHEST": "chest",
+    "WRIST": "wrist",
+    "HANDS": "hands",
+    "WAIST": "waist",
+    "LEGS": "legs",
+    "FEET": "feet",
+    "FINGER_1": "finger1",
+    "FINGER_2": "finger2",
+    "TRINKET_1": "trinket1",
+    "TRINKET_2": "trinket2",
+    "MAIN_HAND": "main_hand",
+    "OFF_HAND": "off_hand",
+}
+
+
+def simc_token(name: str) -> str:
+    """SimC spelling of a race or spec name, e.g. `Mag'har Orc` -> `maghar_orc`"""
+    return re.sub(r"[^a-z0-9]+", "_", name.lower().replace("'", "")).strip("_")
+
+
+def equipped_item(item: Dict[str, Any]) -> GearItem:
+    """Build an item from an entry of the equipment endpoint's `equipped_items`"""
+    enchants = [
+        enchantment["enchantment_id"] for enchantment in item.get("enchantments", [])
+        if enchantment.get("enchantment_slot", {}).get("type") == "PERMANENT"
+    ]
+    return GearItem(
+        id=item["item"]["id"],
+        enchant_id=enchants[0] if enchants else None,
+        gem_id=tuple(socket["item"]["id"] for socket in item.get("sockets", []) if "item" in socket),
+        bonus_id=tuple(item.get("bonus_list", [])),
+        crafted_stats=tuple(stat["id"] for stat in item.get("modified_crafting_stat", [])),
+        item_level=item.get("level", {}).get("value"),
+        name=item.get("name", ""),
+    )
+
+
+def active_loadout(specializations: Optional[Dict[str, Any]]) -> Optional[str]:
+    """Talent loadout code of the active specialization, if the armory has one"""
+    if not specializations:
+        return None
+    active_id = specializations.get("active_specialization", {}).get("id")
+    for specialization in specializations.get("specializations", []):
+        if specialization.get("specialization", {}).get("id") != active_id:
+            continue
+        for loadout in specialization.get("loadouts", []):
+            if loadout.get("is_active"):
+                return loadout.get("talent_loadout_code")
+    return None
+
+
+def build_simc_profile(
+    profile: Optional[Dict[str, Any]],
+    equipment: Optional[Dict[str, Any]],
+    specializations: Optional[Dict[str, Any]] = None,
+    region: str = "us"
+) -> str:
+    """Build a SimC profile from armory data, raising ValueError if data is missing"""
+    if not profile or not equipment:
+        raise ValueError("No armory data")
+
+    simc_class = SIMC_CLASSES.get(profile.get("character_class", {}).get("id"))
+    if simc_class is None:
+        raise ValueError("Unknown class")
+    spec = profile.get("active_spec", {}).get("name")
+    if not spec:
+        raise ValueError("No active specialization")
+
+    lines: List[str] = [
+        f'{simc_class}="{profile["name"]}"',
+        f"level={profile['level']}",
+        f"race={simc_token(profile['race']['name'])}",
+        f"region={region}",
+        f"server={profile['realm']['slug']}",
+        f"spec={simc_token(spec)}",
+    ]
+    talents = active_loadout(specializations)
+    if talents:
+        lines.append(f"talents={talents}")
+
+    for item in equipment.get("equipped_items", []):
+        slot = SIMC_SLOTS.get(item.get("slot", {}).get("type"))
+        if slot is not None:
+            lines.append(equipped_item(item).to_simc(slot))
+
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,101 @@
+import json
+import logging
+import os
+from typing import Any, Callable, Dict, Iterable, Optional
+from uuid import uuid4
+
+import dotenv
+import redis.asyncio as aioredis
+
+from core.cache import REDIS_URL
+
+dotenv.load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# "redis" routes websocket messages between API processes, "local" keeps them in process
+WS_BACKPLANE = os.getenv("WS_BACKPLANE", "local")
+# Seconds a client's registry entry outlives the process it is connected to
+WS_REGISTRY_TTL = int(os.getenv("WS_REGISTRY_TTL", "30"))
+
+BROADCAST_CHANNEL = "ws:broadcast"
+
+
+def client_key(client_id: str) -> str:
+    """Registry entry naming the process a client is connected to"""
+    return f"ws:client:{client_id}"
+
+
+def node_channel(node_id: str) -> str:
+    """Channel carrying messages for the clients of one process"""
+    return f"ws:node:{node_id}"
+
+
+class RedisBackplane:
+    """Routes websocket messages for clients of other API processes through Redis pub/sub.
+
+    Every process registers its clients under WS_REGISTRY_TTL entries it
+    keeps refreshing, and listens on its own channel and the broadcast one.
+    A process that dies takes its entries with it once they expire.
+    """
+
+    def __init__(self, redis_client: Optional[aioredis.Redis] = None):
+        self.redis = redis_client or aioredis.from_url(REDIS_URL)
+        self.node_id = uuid4().hex
+
+    async def register(self, client_ids: Iterable[str]) -> None:
+        """Add or refresh clients connected to this process"""
+        pipe = self.redis.pipeline(transaction=False)
+        for client_id in client_ids:
+            pipe.set(client_key(client_id), self.node_id, ex=WS_REGISTRY_TTL)
+        await pipe.execute()
+
+    async def unregister(self, client_id: str) -> None:
+        await self.redis.delete(client_key(client_id))
+
+    async def send(self, client_id: str, message: Dict[str, Any]) -> bool:
+        """Send a message to a client of another process, returns False if no process has it"""
+        node_id = await self.redis.get(client_key(client_id))
+        if node_id is None:
+            return False
+        data = json.dumps({"client_id": client_id, "message": message})
+        return await self.redis.publish(node_channel(node_id.decode()), data) > 0
+
+    async def broadcast(self, text: str) -> None:
+        """Send an already serialized message to the clients of every other process"""
+        await self.redis.publish(BROADCAST_CHANNEL, json.dumps({"origin": self.node_id, "message": text}))
+
+    async def listen(
+        self,
+        deliver: Callable[[str, Dict[str, Any]], Any],
+        deliver_all: Callable[[str], Any]
+    ) -> None:
+        """Hand messages published for this process's clients to `deliver` and broadcasts to `deliver_all`"""
+        pubsub = self.redis.pubsub()
+        await pubsub.subscribe(node_channel(self.node_id), BROADCAST_CHANNEL)
+        try:
+            while True:
+                message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                if message is None or message["type"] != "message":
+                    continue
+                data = json.loads(message["data"])
+                if message["channel"].decode() == BROADCAST_CHANNEL:
+                    # This process delivered its own broadcasts directly
+                    if data["origin"] != self.node_id:
+                        deliver_all(data["message"])
+                else:
+                    deliver(data["client_id"], data["message"])
+        finally:
+            await pubsub.aclose()
+
+    async def close(self) -> None:
+        await self.redis.aclose()
+
+
+def get_backplane() -> Optional[RedisBackplane]:
+    """Backplane chosen by WS_BACKPLANE, None when websocket messages stay in process"""
+    if WS_BACKPLANE == "redis":
+        return RedisBackplane()
+    if WS_BACKPLANE != "local":
+        raise ValueError(f"Unknown websocket backplane: {WS_BACKPLANE}")
+    return None
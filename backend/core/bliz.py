@@ -203,6 +203,14 @@ class BlizzardAPIClient:
             namespace=Namespace.PROFILE
         )
     
+    async def get_character_specializations(self, access_token: str, realm: str, character: str, region_locale: Optional[RegionLocale] = None):
+        return await self.make_request(
+            endpoint=f"/profile/wow/character/{realm}/{character}/specializations",
+            access_token=access_token,
+            region_locale=region_locale,
+            namespace=Namespace.PROFILE
+        )
+    
     async def get_character_media(self, access_token: str, realm: str, character: str, region_locale: Optional[RegionLocale] = None):
         return await self.make_request(
             endpoint=f"/profile/wow/character/{realm}/{character}/character-media",
@@ -321,6 +329,7 @@ get_wow_profile = bliz_client.get_wow_profile
 get_character_profile = bliz_client.get_character_profile
 get_character_equipment = bliz_client.get_character_equipment
 get_character_media = bliz_client.get_character_media
+get_character_specializations = bliz_client.get_character_specializations
 get_mythic_keystone_profile = bliz_client.get_mythic_keystone_profile
 get_raid_progression = bliz_client.get_raid_progression
 get_guild_info = bliz_client.get_guild_info
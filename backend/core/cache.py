@@ -8,6 +8,8 @@ import os
 import dotenv
 import hashlib
 
+from core.profile import canonical_profile
+
 dotenv.load_dotenv()
 
 # Single Redis client instance
@@ -48,9 +50,32 @@ def create_cache_key(func_name, args, kwargs):
     return f"{func_name}:{args_str}:{kwargs_str}"
 
 def create_simc_cache_key(input_text):
-    """Create a hash key for SimC input text"""
+    """Create a hash key for SimC input text, equal for equivalent profiles"""
+    try:
+        input_text = canonical_profile(input_text)
+    except ValueError:
+        pass  # Inputs we cannot parse are keyed as they are
     return f"simc:{hashlib.md5(input_text.encode()).hexdigest()}"
 
+def get_cached_simc_summary(input_text):
+    """Return the cached summary of a simulation's results, None if there is none"""
+    try:
+        cached = redis_client.get(f"{create_simc_cache_key(input_text)}:summary")
+    except redis.RedisError:
+        return None
+    return json.loads(cached) if cached else None
+
+def cache_simc_summary(input_text, summary):
+    """Cache the summary of a simulation's results, e.g. a stat weight baseline"""
+    try:
+        redis_client.setex(
+            f"{create_simc_cache_key(input_text)}:summary",
+            int(CACHE_EXPIRY[CacheType.SIMC].total_seconds()),
+            json.dumps(summary)
+        )
+    except redis.RedisError:
+        pass
+
 def cache_api_response(func):
     @wraps(func)
     async def wrapper(*args, **kwargs):
@@ -99,7 +124,7 @@ def cache_api_response(func):
 
 def cache_simc_result(func):
     @wraps(func)
-    async def wrapper(self, input: str):
+    async def wrapper(self, input: str, *args, **kwargs):
         cache_key = create_simc_cache_key(input)
         
         try:
@@ -112,9 +137,9 @@ def cache_simc_result(func):
             # If not in cache or file doesn't exist, run simulation
             # Properly handle both sync and async calls
             if asyncio.iscoroutinefunction(func):
-                output_file = await func(self, input)
+                output_file = await func(self, input, *args, **kwargs)
             else:
-                output_file = func(self, input)
+                output_file = func(self, input, *args, **kwargs)
             
             # Cache the successful simulation
             if output_file and os.path.exists(output_file):
@@ -129,8 +154,8 @@ def cache_simc_result(func):
         except redis.RedisError:
             # If Redis fails, just run the simulation without caching
             if asyncio.iscoroutinefunction(func):
-                return await func(self, input)
+                return await func(self, input, *args, **kwargs)
             else:
-                return func(self, input)
+                return func(self, input, *args, **kwargs)
     
     return wrapper
\ No newline at end of file
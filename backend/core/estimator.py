@@ -0,0 +1,139 @@
+import json
+import math
+import os
+from typing import Dict, List, Optional
+
+import dotenv
+import redis
+
+from core.profile import parse_profile
+from core.sharding import SIMC_SHARD_DEFAULT_ITERATIONS
+from core.simc import SIMC_THREADS, profile_option
+
+dotenv.load_dotenv()
+
+ESTIMATOR_KEY = "queue:estimator"
+
+# Order jobs of the same round in a lane by their estimate, see JobQueue.enqueue
+SHORTEST_JOB_FIRST = os.getenv("SIMC_SHORTEST_JOB_FIRST", "false").lower() == "true"
+# Weight left on past jobs per fit, below 1 so the model follows hardware and SimC changes
+ESTIMATOR_FORGETTING = float(os.getenv("SIMC_ESTIMATOR_FORGETTING", "0.995"))
+MIN_ESTIMATE = 1.0
+
+FEATURES = ("bias", "iteration_work", "error_work", "runs", "busy_fight_work")
+# Seconds per unit of each feature before any job has been fitted
+PRIOR_WEIGHTS = (2.0, 1.0, 0.05, 0.5, 0.5)
+# Confidence in the prior, larger lets the first jobs move the weights further
+PRIOR_VARIANCE = 100.0
+
+# SimC defaults for profiles that do not set these
+DEFAULT_MAX_TIME = 300
+DEFAULT_FIGHT_STYLE = "patchwerk"
+ENEMY_OPTIONS = {"enemy", "tank_dummy"}
+
+
+def _number_option(input_text: str, name: str, default: float) -> float:
+    """Value of a numeric option, `default` when it is unset or not a finite number"""
+    try:
+        value = float(profile_option(input_text, name) or default)
+    except ValueError:
+        return default
+    return value if math.isfinite(value) and value >= 0 else default
+
+
+def job_features(input_text: str, profilesets: Optional[int] = None) -> Dict[str, float]:
+    """Cheap features of a profile that SimC's runtime grows with.
+
+    Work is counted in thousands of iterations of a five minute fight for
+    every player and profileset, divided by the threads each run gets.
+    """
+    scopes = parse_profile(input_text)
+    players = sum(
+        1 for scope in scopes[1:]
+        if scope.header.split("=", 1)[0].split(".", 1)[0].lower() not in ENEMY_OPTIONS
+    ) or 1
+    if profilesets is None:
+        profilesets = len({
+            key.split(".", 1)[1] for scope in scopes for key in scope.options
+            if key.lower().startswith("profileset.")
+        })
+    runs = players * (1 + profilesets)
+
+    # SimC rejects options it cannot read, those jobs fail fast and need no estimate
+    fight_minutes = _number_option(input_text, "max_time", DEFAULT_MAX_TIME) / DEFAULT_MAX_TIME
+    scale = runs * fight_minutes / (SIMC_THREADS or 1)
+    target_error = _number_option(input_text, "target_error", 0)
+    iterations = profile_option(input_text, "iterations")
+    if target_error > 0 and iterations is None:
+        # Iterations to reach an error grow with its inverse square
+        iteration_work, error_work = 0.0, scale / target_error ** 2
+    else:
+        iterations = _number_option(input_text, "iterations", SIMC_SHARD_DEFAULT_ITERATIONS)
+        iteration_work, error_work = scale * iterations / 1000, 0.0
+
+    fight_style = (profile_option(input_text, "fight_style") or DEFAULT_FIGHT_STYLE).lower()
+    return {
+        "bias": 1.0,
+        "iteration_work": iteration_work,
+        "error_work": error_work,
+        "runs": float(runs),
+        # Fights with adds or movement cost more per iteration than a single target
+        "busy_fight_work": iteration_work + error_work if fight_style != DEFAULT_FIGHT_STYLE else 0.0,
+    }
+
+
+class RuntimeEstimator:
+    """Linear model of job durations fitted online by recursive least squares.
+
+    The weights and their covariance live in Redis, shared by the API that
+    predicts and the workers that fit each finished job's duration.
+    """
+
+    def __init__(self, redis_client: redis.Redis):
+        self.redis = redis_client
+
+    def _load(self, data: Optional[bytes]) -> Dict[str, List]:
+        if data:
+            return json.loads(data)
+        size = len(FEATURES)
+        return {
+            "weights": list(PRIOR_WEIGHTS),
+            "covariance": [[PRIOR_VARIANCE if i == j else 0.0 for j in range(size)] for i in range(size)],
+            "samples": 0
+        }
+
+    def predict(self, features: Dict[str, float]) -> float:
+        """Estimated seconds a job with these features holds a worker slot"""
+        model = self._load(self.redis.get(ESTIMATOR_KEY))
+        x = [features.get(name, 0.0) for name in FEATURES]
+        return max(MIN_ESTIMATE, sum(w * v for w, v in zip(model["weights"], x)))
+
+    def fit(self, features: Dict[str, float], duration: float) -> None:
+        """Update the model with the duration a finished job took"""
+        x = [features.get(name, 0.0) for name in FEATURES]
+        # Optimistic transaction, retried if another worker fits at the same time
+        with self.redis.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(ESTIMATOR_KEY)
+                    model = self._load(pipe.get(ESTIMATOR_KEY))
+                    weights, covariance = model["weights"], model["covariance"]
+
+                    p_x = [sum(row[j] * x[j] for j in range(len(x))) for row in covariance]
+                    gain_denominator = ESTIMATOR_FORGETTING + sum(x[i] * p_x[i] for i in range(len(x)))
+                    gain = [value / gain_denominator for value in p_x]
+                    error = duration - sum(w * v for w, v in zip(weights, x))
+                    model["weights"] = [w + k * error for w, k in zip(weights, gain)]
+                    # P = (P - k x'P) / lambda, x'P equals (P x)' as P is symmetric
+                    model["covariance"] = [
+                        [(covariance[i][j] - gain[i] * p_x[j]) / ESTIMATOR_FORGETTING for j in range(len(x))]
+                        for i in range(len(x))
+                    ]
+                    model["samples"] += 1
+
+                    pipe.multi()
+                    pipe.set(ESTIMATOR_KEY, json.dumps(model))
+                    pipe.execute()
+                    return
+                except redis.WatchError:
+                    continue
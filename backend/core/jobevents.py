@@ -0,0 +1,55 @@
+import json
+import logging
+import time
+from typing import Any, Callable, Dict
+
+import redis
+
+logger = logging.getLogger(__name__)
+
+# Fields of a job hash too large or internal to send to clients
+PRIVATE_FIELDS = {
+    "input", "input_ref", "coalesce_key", "features", "result", "queue_member", "queue_entry",
+    "candidates", "character"
+}
+# Seconds between progress events of one job, status changes are always sent
+PROGRESS_INTERVAL = 0.5
+
+
+def job_channel(job_id: str) -> str:
+    """Pub/sub channel carrying a job's status changes and progress"""
+    return f"job_events:{job_id}"
+
+
+def job_event(job_id: str, event_type: str, **fields: Any) -> str:
+    """Message of a `status` or `progress` event, for scripts that publish it themselves"""
+    return json.dumps({"type": event_type, "job_id": job_id, **fields})
+
+
+def publish_job_event(redis_client: redis.Redis, job_id: str, event_type: str, **fields: Any) -> None:
+    """Publish a `status` or `progress` event of a job to its subscribers"""
+    try:
+        redis_client.publish(job_channel(job_id), job_event(job_id, event_type, **fields))
+    except redis.RedisError as e:
+        # Events are best effort, the job hash stays the source of truth
+        logger.warning(f"Could not publish {event_type} event of job {job_id}: {e}")
+
+
+def job_snapshot(job_id: str, job: Dict[str, str]) -> Dict[str, Any]:
+    """Client view of a decoded job hash, sent when a client subscribes"""
+    return {"type": "snapshot", "job_id": job_id, **{k: v for k, v in job.items() if k not in PRIVATE_FIELDS}}
+
+
+def progress_publisher(redis_client: redis.Redis, job_id: str) -> Callable[[float, str], None]:
+    """Progress callback for SimcClient that publishes at most every PROGRESS_INTERVAL"""
+    last_sent = 0.0
+
+    def on_progress(progress: float, content: str) -> None:
+        nonlocal last_sent
+        now = time.monotonic()
+        if progress < 100 and now - last_sent < PROGRESS_INTERVAL:
+            return
+        last_sent = now
+        publish_job_event(redis_client, job_id, "progress", progress=progress, content=content)
+
+    return on_progress
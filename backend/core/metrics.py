@@ -0,0 +1,28 @@
+from collections import defaultdict
+from typing import Any, Dict
+
+
+class Metrics:
+    """In-process counters and gauges for the simulation services"""
+
+    def __init__(self):
+        self.counters: Dict[str, int] = defaultdict(int)
+        self.gauges: Dict[str, float] = {}
+
+    def incr(self, name: str, value: int = 1) -> None:
+        """Increase a counter"""
+        self.counters[name] += value
+
+    def gauge(self, name: str, value: float) -> None:
+        """Set a gauge to its current value"""
+        self.gauges[name] = value
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Return a copy of all metrics"""
+        return {
+            "counters": dict(self.counters),
+            "gauges": dict(self.gauges)
+        }
+
+# Create a global instance
+metrics = Metrics()
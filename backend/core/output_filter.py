@@ -2,58 +2,88 @@ import re
 import os
 from pathlib import Path
 
+# Lines without any of these characters cannot match a rule and skip the scan
+_NEEDS_SCAN = re.compile(r'[/=\d]|host', re.IGNORECASE)
+
+# Rules in the order they are applied, each with a marker every match of it
+# contains; a rule whose marker is missing from the line is skipped
+_RULES = [
+    # Remove absolute paths
+    ("path", r'/', r'/[^\s]+'),
+    # Remove username references
+    ("home", r'/home/', r'/home/[^/\s]+'),
+    # Remove specific environment variables
+    ("env", r'=', r'(?P<env_name>[A-Z_]+)=[^\s]+'),
+    # Remove system details
+    ("os", r'Linux|Darwin|Windows', r'(?:Linux|Darwin|Windows).*?\d+\.\d+\.\d+'),
+    # Remove IP addresses
+    ("ip", r'\.', r'\b(?:(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\.){3}(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\b'),
+    # Remove potential user directories
+    ("users", r'Users/', r'Users/[^/\s]+'),
+    # Remove hostname patterns
+    ("host", r'(?i)host', r'(?i)(?P<host_key>hostname|host)[:=\s]+[^\s]+'),
+]
+
+
 class SafeOutputFilter:
+    """Strips paths, secrets and host details from SimC output.
+
+    The rules run one after another, each on the text the previous ones
+    produced, so a later rule also sees what an earlier one rewrote: the path
+    rule turns `10.0.0.1/24` into `10.0.0.124`, which the IP rule then masks.
+    Patterns are compiled once and a rule only runs if its marker is in the
+    line, which leaves the output exactly that of the plain per-rule passes;
+    tests/test_output_filter.py checks it against them.
+    """
+
     def __init__(self):
         self.project_root = Path(os.getcwd())
-        self.patterns = [
-            # Remove absolute paths
-            (r'(/[^\s]+)', self._sanitize_path),
-            # Remove username references
-            (r'/home/[^/\s]+', '/home/user'),
-            # Remove specific environment variables
-            (r'([A-Z_]+)=([^\s]+)', self._sanitize_env_var),
-            # Remove system details
-            (r'(Linux|Darwin|Windows).*?(\d+\.\d+\.\d+)', 'OS version'),
-            # Remove IP addresses
-            (r'\b(?:(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\.){3}(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\b', 'xxx.xxx.xxx.xxx'),
-            # Remove potential user directories
-            (r'Users/[^/\s]+', 'Users/user'),
-            # Remove hostname patterns
-            (r'(?i)(hostname|host)[:=\s]+[^\s]+', r'\1: [hidden]'),
+        self._project_root_str = str(self.project_root)
+        self.safe_vars = {'PATH', 'PYTHONPATH', 'LANG', 'LC_ALL'}
+
+        replacements = {
+            "path": lambda match: self._sanitize_path(match.group(0)),
+            "home": lambda match: '/home/user',
+            "env": self._sanitize_env_var,
+            "os": lambda match: 'OS version',
+            "ip": lambda match: 'xxx.xxx.xxx.xxx',
+            "users": lambda match: 'Users/user',
+            "host": lambda match: f"{match.group('host_key')}: [hidden]",
+        }
+        self._rules = [
+            (re.compile(marker), re.compile(pattern), replacements[name])
+            for name, marker, pattern in _RULES
         ]
-        
-    def _sanitize_path(self, match):
-        path = match.group(1)
+
+    def _sanitize_path(self, path):
         try:
             # If the path is within our project, make it relative
-            if path.startswith(str(self.project_root)):
+            if path.startswith(self._project_root_str):
                 return os.path.relpath(path, self.project_root)
             else:
                 # Otherwise, just return the last component
                 return os.path.basename(path)
         except:
             return '[path]'
-    
+
     def _sanitize_env_var(self, match):
-        var_name = match.group(1)
+        var_name = match.group('env_name')
         # Keep some safe environment variables
-        safe_vars = ['PATH', 'PYTHONPATH', 'LANG', 'LC_ALL']
-        if var_name in safe_vars:
+        if var_name in self.safe_vars:
             return match.group(0)
         else:
             return f"{var_name}=[hidden]"
-    
+
     def filter_line(self, line):
         """Filter a single line of output"""
-        filtered_line = line
-        for pattern, replacement in self.patterns:
-            if callable(replacement):
-                filtered_line = re.sub(pattern, replacement, filtered_line)
-            else:
-                filtered_line = re.sub(pattern, replacement, filtered_line)
-        return filtered_line
-    
+        if _NEEDS_SCAN.search(line) is None:
+            return line
+        for marker, pattern, replacement in self._rules:
+            if marker.search(line) is not None:
+                line = pattern.sub(replacement, line)
+        return line
+
     def filter_text(self, text):
         """Filter multiple lines of output"""
         lines = text.split('\n')
-        return '\n'.join(self.filter_line(line) for line in lines)
\ No newline at end of file
+        return '\n'.join(self.filter_line(line) for line in lines)
@@ -0,0 +1,83 @@
+import hashlib
+import os
+import zlib
+from typing import Optional
+
+import dotenv
+import redis
+
+dotenv.load_dotenv()
+
+# Seconds a payload no job refers to any more is kept, so a resubmitted
+# profile is stored again for free
+PAYLOAD_TTL = int(os.getenv("SIMC_PAYLOAD_TTL", "3600"))
+PAYLOAD_COMPRESSION_LEVEL = 6
+
+# Stores the payload if it is new and counts the reference, a referenced
+# payload never expires
+STORE_SCRIPT = """
+redis.call('HSETNX', KEYS[1], 'data', ARGV[1])
+redis.call('HINCRBY', KEYS[1], 'refs', 1)
+redis.call('PERSIST', KEYS[1])
+return 1
+"""
+
+# Drops a reference, the last one starts the payload's retention
+RELEASE_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+local refs = redis.call('HINCRBY', KEYS[1], 'refs', -1)
+if refs <= 0 then
+    redis.call('HSET', KEYS[1], 'refs', 0)
+    redis.call('EXPIRE', KEYS[1], tonumber(ARGV[1]))
+end
+return refs
+"""
+
+
+def payload_ref(input_text: str) -> str:
+    """Content hash a payload is stored under"""
+    return hashlib.sha256(input_text.encode("utf-8")).hexdigest()
+
+
+def payload_key(ref: str) -> str:
+    return f"payload:{ref}"
+
+
+def encode_payload(input_text: str) -> bytes:
+    """Stored form of a profile"""
+    return zlib.compress(input_text.encode("utf-8"), PAYLOAD_COMPRESSION_LEVEL)
+
+
+def decode_payload(data: bytes) -> str:
+    """Profile text of a stored payload"""
+    return zlib.decompress(data).decode("utf-8")
+
+
+class PayloadStore:
+    """Job inputs stored once per content hash, compressed and reference counted.
+
+    Job hashes hold the `input_ref` of their input, every job holding a
+    reference releases it when it finishes.
+    """
+
+    def __init__(self, redis_client: redis.Redis):
+        self.redis = redis_client
+        self._store = self.redis.register_script(STORE_SCRIPT)
+        self._release = self.redis.register_script(RELEASE_SCRIPT)
+
+    def store(self, input_text: str, client: Optional[redis.client.Pipeline] = None) -> str:
+        """Store a profile, or add a reference to the stored copy, returns its ref"""
+        ref = payload_ref(input_text)
+        self._store(keys=[payload_key(ref)], args=[encode_payload(input_text)], client=client)
+        return ref
+
+    def load(self, ref: str) -> Optional[str]:
+        """Profile text of a stored payload, None if it has expired"""
+        data = self.redis.hget(payload_key(ref), "data")
+        return decode_payload(data) if data is not None else None
+
+    def release(self, ref: str, client: Optional[redis.client.Pipeline] = None) -> None:
+        """Drop a job's reference to a payload"""
+        self._release(keys=[payload_key(ref)], args=[PAYLOAD_TTL], client=client)
@@ -0,0 +1,166 @@
+import os
+import re
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+import dotenv
+
+dotenv.load_dotenv()
+
+# Largest profile accepted from a client
+SIMC_MAX_INPUT_BYTES = int(os.getenv("SIMC_MAX_INPUT_BYTES", str(512 * 1024)))
+# Most iterations a client may ask for
+SIMC_MAX_ITERATIONS = int(os.getenv("SIMC_MAX_ITERATIONS", "250000"))
+
+# Options that declare a new actor, every option after them applies to that actor
+ACTOR_OPTIONS = {
+    "warrior", "paladin", "hunter", "rogue", "priest", "death_knight", "deathknight",
+    "shaman", "mage", "warlock", "monk", "druid", "demon_hunter", "demonhunter",
+    "evoker", "enemy", "tank_dummy", "copy",
+}
+
+# Options a profile may set, anything else is rejected, as SimC also has
+# options that read or write files, reach the network, or take over the
+# server's resources
+SIM_OPTIONS = {
+    "iterations", "target_error", "max_time", "vary_combat_length", "fight_style",
+    "desired_targets", "optimal_raid", "fixed_time", "raid_events", "ptr", "seed",
+    "deterministic", "single_actor_batch", "calculate_scale_factors", "scale_only",
+    "report_details", "target_level", "target_race", "bloodlust_percent", "bloodlust_time",
+    "profileset",
+}
+PLAYER_OPTIONS = {
+    "level", "race", "region", "server", "role", "professions", "spec", "talents",
+    "class_talents", "spec_talents", "hero_talents", "position", "timeofday",
+    "potion", "flask", "food", "augmentation", "temporary_enchant", "set_bonus",
+    "head", "neck", "shoulder", "shoulders", "back", "chest", "shirt", "tabard",
+    "wrist", "wrists", "hands", "waist", "legs", "feet", "finger1", "finger2",
+    "trinket1", "trinket2", "main_hand", "off_hand", "actions",
+}
+ALLOWED_OPTIONS = ACTOR_OPTIONS | SIM_OPTIONS | PLAYER_OPTIONS
+# Families of options, e.g. actions.precombat= or enchant_strength=
+ALLOWED_PREFIXES = ("actions.", "override.", "external_buffs.", "enchant_")
+
+# Options like: head=,id=1 or profileset."Combo 1"+=finger1=,id=2
+OPTION = re.compile(r'^(?P<key>(?:[^\s="+]|"[^"]*")+)(?P<op>\+?=)(?P<value>.*)$')
+# SimC splits lines on whitespace outside of double quotes
+TOKEN = re.compile(r'(?:[^\s"]|"[^"]*")+')
+# Variables, defined with $(name)=value and expanded in every token after it
+VARIABLE = re.compile(r'\$\(([^)]*)\)')
+# Printable characters only, SimC profiles are plain text
+CONTROL_CHARACTERS = re.compile(r'[\x00-\x08\x0b-\x1f\x7f]')
+
+
+@dataclass
+class ProfileScope:
+    """Options set before the first actor, or for one actor"""
+    header: Optional[str] = None
+    options: Dict[str, List[Tuple[str, str]]] = field(default_factory=dict)
+
+    def set(self, key: str, op: str, value: str) -> None:
+        # `=` replaces what came before, `+=` appends to it
+        if op == "=":
+            self.options[key] = [(op, value)]
+        else:
+            self.options.setdefault(key, []).append((op, value))
+
+    def lines(self) -> List[str]:
+        lines = [self.header] if self.header else []
+        for key in sorted(self.options):
+            lines.extend(f"{key}{op}{value}" for op, value in self.options[key])
+        return lines
+
+
+def _option_name(key: str) -> str:
+    """Base name of an option key, e.g. `actions.precombat` -> `actions`"""
+    return key.replace('"', "").split(".", 1)[0].lower()
+
+
+def _tokens(line: str, variables: Dict[str, str], number: int) -> List[str]:
+    """Split a line into tokens the way SimC does, with variables expanded"""
+    if line.count('"') % 2:
+        raise ValueError(f"Line {number}: unbalanced quotes")
+    return [
+        VARIABLE.sub(lambda match: variables.get(match.group(1), match.group(0)), token)
+        for token in TOKEN.findall(line)
+    ]
+
+
+def _check_option(key: str, value: str, number: int) -> None:
+    name = _option_name(key)
+    allowed = name in ALLOWED_OPTIONS or key.replace('"', "").lower().startswith(ALLOWED_PREFIXES)
+    if not allowed:
+        raise ValueError(f"Line {number}: option '{name}' is not allowed")
+    if name == "iterations":
+        try:
+            iterations = int(value)
+        except ValueError:
+            raise ValueError(f"Line {number}: iterations must be a whole number")
+        if iterations > SIMC_MAX_ITERATIONS:
+            raise ValueError(f"Line {number}: at most {SIMC_MAX_ITERATIONS} iterations are allowed")
+    if name == "profileset":
+        # The value of a profileset option is itself an option
+        match = OPTION.match(value)
+        if match is None:
+            raise ValueError(f"Line {number}: malformed profileset option")
+        _check_option(match.group("key"), match.group("value"), number)
+
+
+def parse_profile(input_text: str) -> List[ProfileScope]:
+    """Parse and validate a SimC profile, raising ValueError if it is malformed or unsafe.
+
+    Lines are split into tokens like SimC does, every token must be an allowed
+    option and a line may only hold one, as the helpers reading options back
+    work line by line. Comments and blank lines are dropped. The first scope holds
+    the options set before any actor is declared.
+    """
+    if len(input_text.encode("utf-8")) > SIMC_MAX_INPUT_BYTES:
+        raise ValueError(f"Input is larger than {SIMC_MAX_INPUT_BYTES} bytes")
+
+    scopes = [ProfileScope()]
+    variables: Dict[str, str] = {}
+    for number, raw_line in enumerate(input_text.splitlines(), start=1):
+        line = raw_line.strip()
+        if not line or line.startswith("#"):
+            continue
+        if CONTROL_CHARACTERS.search(line):
+            raise ValueError(f"Line {number}: contains control characters")
+
+        for index, token in enumerate(_tokens(line, variables, number)):
+            # SimC reads tokens without an option as the name of a file to include
+            match = OPTION.match(token)
+            if match is None:
+                raise ValueError(f"Line {number}: expected options like name=value, got '{token}'")
+            key, op, value = match.group("key"), match.group("op"), match.group("value")
+
+            variable = VARIABLE.fullmatch(key)
+            if variable is not None and op == "=" and index == 0:
+                variables[variable.group(1)] = value
+                continue
+            _check_option(key, value, number)
+            if index > 0:
+                raise ValueError(f"Line {number}: put each option on its own line, got '{token}'")
+
+            if _option_name(key) in ACTOR_OPTIONS and op == "=":
+                scopes.append(ProfileScope(header=f"{key}={value}"))
+            else:
+                scopes[-1].set(key, op, value)
+
+    if len(scopes) == 1:
+        raise ValueError("Input does not declare a character")
+    return scopes
+
+
+def canonical_profile(input_text: str) -> str:
+    """Canonical form of a profile, equal for profiles SimC runs the same way.
+
+    Comments, whitespace and overridden options are dropped and the options of
+    each scope sorted, while `+=` options keep their order and actors keep
+    theirs. Profiles using `$(variables)` only have their lines cleaned up, as
+    a redefined variable changes the lines after it.
+    """
+    scopes = parse_profile(input_text)
+    if "$(" in input_text:
+        lines = (line.strip() for line in input_text.splitlines())
+        return "\n".join(line for line in lines if line and not line.startswith("#")) + "\n"
+    return "\n".join(line for scope in scopes for line in scope.lines()) + "\n"
@@ -0,0 +1,666 @@
+import asyncio
+import json
+import logging
+import os
+import socket
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import dotenv
+import redis
+
+from core.jobevents import job_channel, job_event
+from core.payloads import (
+    PAYLOAD_TTL, PayloadStore, decode_payload
+)
+
+dotenv.load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+QUEUE_STREAM = "simulation_stream"
+QUEUE_GROUP = "simulation_workers"
+DEAD_LETTER_STREAM = "simulation_dead_letter"
+# Set of worker ids, each with a `worker:{id}` hash that expires unless refreshed
+WORKERS_KEY = "simulation_workers:live"
+# Jobs queued before the move to streams
+LEGACY_QUEUE = "simulation_queue"
+# Jobs wait in a `queue:{lane}` sorted set until dispatched onto the stream,
+# lanes are served in this order
+LANES = ("interactive", "bulk")
+# Job types that go in the bulk lane, behind single interactive simulations
+BULK_JOB_TYPES = {"shard", "batch_member", "stat_weight", "topgear"}
+# Dispatched and running jobs by owner
+IN_FLIGHT_KEY = "queue:in_flight"
+QUEUE_SEQUENCE = "queue:sequence"
+# Counters and averages of finished jobs, see core.queuestats
+STATS_KEY = "queue:stats"
+
+# How long a blocking read waits before the worker looks for stale entries again
+QUEUE_BLOCK_MS = int(os.getenv("SIMC_QUEUE_BLOCK_MS", "5000"))
+# Lease on a claimed job, entries idle this long belong to a stuck worker and are
+# claimed by another
+QUEUE_CLAIM_IDLE_MS = int(os.getenv("SIMC_QUEUE_CLAIM_IDLE_MS", "60000"))
+# Claims after which a job that keeps losing its worker is dead-lettered
+QUEUE_MAX_ATTEMPTS = int(os.getenv("SIMC_QUEUE_MAX_ATTEMPTS", "3"))
+DEAD_LETTER_MAXLEN = int(os.getenv("SIMC_DEAD_LETTER_MAXLEN", "10000"))
+# Jobs one owner may have dispatched or running at once, 0 for no limit
+USER_MAX_IN_FLIGHT = int(os.getenv("SIMC_USER_MAX_IN_FLIGHT", "8"))
+# Seconds a finished job's hash and result are kept, 0 to keep them forever
+JOB_TTL = int(os.getenv("SIMC_JOB_TTL", str(7 * 24 * 3600)))
+# Seconds a worker's heartbeat lives, its jobs are requeued once it expires
+WORKER_TTL = int(os.getenv("SIMC_WORKER_TTL", "30"))
+
+
+# Lua helpers shared by the scripts below. Each script gets the stream, the
+# in-flight hash and the live workers set as its first keys, and the group,
+# the in-flight cap and the comma separated lanes as its first arguments.
+# Besides their keys the scripts use the `job:`, `queue:` and `worker:` keys
+# they derive from them, so they need a single Redis server, not a cluster.
+SCRIPT_FUNCTIONS = """
+local function split(text)
+    local items = {}
+    for item in string.gmatch(text, '[^,]+') do
+        table.insert(items, item)
+    end
+    return items
+end
+
+local function ready_count(stream, group)
+    return redis.call('XLEN', stream) - redis.call('XPENDING', stream, group)[1]
+end
+
+-- Free job slots of the live workers, at least one so a job is always ready
+local function idle_slots(workers)
+    local idle = 0
+    for _, worker_id in ipairs(redis.call('SMEMBERS', workers)) do
+        local worker = redis.call('HMGET', 'worker:' .. worker_id, 'capacity', 'in_flight')
+        if worker[1] then
+            idle = idle + tonumber(worker[1]) - tonumber(worker[2] or '0')
+        end
+    end
+    return math.max(1, idle)
+end
+
+-- Makes an owner's first waiting job of a lane one of the heads dispatch
+-- picks from, or leaves the owner out while it is at its in-flight cap
+local function refresh_owner(lane, owner, in_flight, cap)
+    local queue = 'queue:' .. lane
+    local current = redis.call('HGET', queue .. ':head_of', owner)
+    if current then
+        redis.call('ZREM', queue .. ':heads', current)
+        redis.call('HDEL', queue .. ':head_of', owner)
+    end
+    if cap > 0 and tonumber(redis.call('HGET', in_flight, owner) or '0') >= cap then
+        return
+    end
+    local head = redis.call('ZRANGE', queue .. ':owner:' .. owner, 0, 0, 'WITHSCORES')
+    if #head > 0 then
+        redis.call('ZADD', queue .. ':heads', head[2], head[1])
+        redis.call('HSET', queue .. ':head_of', owner, head[1])
+    end
+end
+
+-- Moves the first jobs of the lanes onto the stream while fewer than
+-- `max_ready` entries wait there. Only the first job of each owner below its
+-- in-flight cap is a head, so the next job is the first head
+local function dispatch(stream, group, in_flight, max_ready, cap, lanes)
+    local ready = ready_count(stream, group)
+    local dispatched = 0
+    for _, lane in ipairs(lanes) do
+        local queue = 'queue:' .. lane
+        while ready < max_ready do
+            local head = redis.call('ZRANGE', queue .. ':heads', 0, 0, 'WITHSCORES')
+            if #head == 0 then break end
+            local member, round = head[1], tonumber(head[2])
+            local job_id = string.sub(member, 18)
+            local job = redis.call('HMGET', 'job:' .. job_id, 'owner', 'estimated_duration')
+            local owner = job[1] or 'anonymous'
+            redis.call('ZREM', queue, member)
+            redis.call('ZREM', queue .. ':owner:' .. owner, member)
+            redis.call('ZREM', queue .. ':heads', member)
+            redis.call('INCRBYFLOAT', queue .. ':work', -tonumber(job[2] or '0'))
+            if round > tonumber(redis.call('GET', queue .. ':clock') or '0') then
+                redis.call('SET', queue .. ':clock', round)
+            end
+            if tonumber(redis.call('HGET', queue .. ':rounds', owner) or '0') <= round then
+                redis.call('HDEL', queue .. ':rounds', owner)
+            end
+            local entry = redis.call('XADD', stream, '*', 'job_id', job_id, 'owner', owner)
+            redis.call('HSET', 'job:' .. job_id, 'queue_entry', entry)
+            redis.call('HDEL', 'job:' .. job_id, 'queue_member')
+            redis.call('HINCRBY', in_flight, owner, 1)
+            refresh_owner(lane, owner, in_flight, cap)
+            ready = ready + 1
+            dispatched = dispatched + 1
+        end
+    end
+    return dispatched
+end
+
+-- Jobs ahead of a waiting job plus one, 0 once it is no longer waiting. Ready
+-- entries are the tail of the stream, behind them come the lanes in order.
+local function position(stream, group, job_id, lanes)
+    local job = redis.call('HMGET', 'job:' .. job_id, 'status', 'queue_entry', 'queue_member', 'lane')
+    if job[1] ~= 'QUEUED' then return 0 end
+    local ready = ready_count(stream, group)
+    if job[2] then
+        return math.max(0, ready - #redis.call('XRANGE', stream, '(' .. job[2], '+'))
+    end
+    if not job[3] then return 0 end
+    local ahead = ready
+    for _, lane in ipairs(lanes) do
+        if lane == job[4] then
+            local rank = redis.call('ZRANK', 'queue:' .. lane, job[3])
+            if not rank then return 0 end
+            return ahead + rank + 1
+        end
+        ahead = ahead + redis.call('ZCARD', 'queue:' .. lane)
+    end
+    return 0
+end
+"""
+
+# Stores a job's fields and adds it to its lane's sorted set and its owner's
+# one in that lane, scored by the owner's next round so owners take turns:
+# an owner's n-th waiting job goes in round n after the last dispatched one.
+# Members are prefixed with a sequence number, or the job's estimated
+# milliseconds for shortest job first, which orders jobs within a round,
+# with requeued jobs first. Then dispatches and returns the job's position.
+# Given a coalescing key, a job the key points to that is still queued or
+# running takes the new job as a follower instead, and the position is
+# that job's; otherwise the key points to the new job.
+ENQUEUE_SCRIPT = SCRIPT_FUNCTIONS + """
+local stream, in_flight, workers, sequence = KEYS[1], KEYS[2], KEYS[3], KEYS[4]
+local group, cap, lanes = ARGV[1], tonumber(ARGV[2]), split(ARGV[3])
+local job_id, owner, lane, front = ARGV[4], ARGV[5], ARGV[6], ARGV[7] == '1'
+local estimate, order, channel, event = tonumber(ARGV[8]), tonumber(ARGV[9]), ARGV[10], ARGV[11]
+local job = 'job:' .. job_id
+if #ARGV > 11 then
+    redis.call('HSET', job, unpack(ARGV, 12))
+end
+
+local coalesce_key = KEYS[5]
+if coalesce_key and not front then
+    local leader = redis.call('GET', coalesce_key)
+    if leader then
+        local status = redis.call('HGET', 'job:' .. leader, 'status')
+        if status == 'QUEUED' or status == 'PROCESSING' then
+            redis.call('HSET', job, 'coalesced_with', leader)
+            redis.call('RPUSH', 'job:' .. leader .. ':followers', job_id)
+            return position(stream, group, leader, lanes)
+        end
+    end
+    redis.call('SET', coalesce_key, job_id)
+    redis.call('HSET', job, 'coalesce_key', coalesce_key)
+end
+
+local round, member
+if front then
+    -- A requeued job keeps its owner, lane and estimate
+    local stored = redis.call('HMGET', job, 'owner', 'lane', 'estimated_duration')
+    owner, lane, estimate = stored[1] or 'anonymous', stored[2] or 'interactive', tonumber(stored[3] or '0')
+    redis.call('HDEL', job, 'worker', 'lease_expires_at')
+end
+local queue = 'queue:' .. lane
+local now = tonumber(redis.call('GET', queue .. ':clock') or '0')
+if front then
+    round = now
+    member = string.format('%016d', 0) .. ':' .. job_id
+else
+    round = math.max(now, tonumber(redis.call('HGET', queue .. ':rounds', owner) or '0')) + 1
+    redis.call('HSET', queue .. ':rounds', owner, round)
+    member = string.format('%016d', order or redis.call('INCR', sequence)) .. ':' .. job_id
+end
+redis.call('ZADD', queue, round, member)
+redis.call('ZADD', queue .. ':owner:' .. owner, round, member)
+redis.call('HSET', job, 'owner', owner, 'lane', lane, 'queue_member', member, 'estimated_duration', estimate)
+redis.call('INCRBYFLOAT', queue .. ':work', estimate)
+refresh_owner(lane, owner, in_flight, cap)
+if event ~= '' then
+    redis.call('PUBLISH', channel, event)
+end
+
+dispatch(stream, group, in_flight, idle_slots(workers), cap, lanes)
+return position(stream, group, job_id, lanes)
+"""
+
+DISPATCH_SCRIPT = SCRIPT_FUNCTIONS + """
+return dispatch(KEYS[1], ARGV[1], KEYS[2], idle_slots(KEYS[3]), tonumber(ARGV[2]), split(ARGV[3]))
+"""
+
+POSITION_SCRIPT = SCRIPT_FUNCTIONS + """
+return position(KEYS[1], ARGV[1], ARGV[4], split(ARGV[3]))
+"""
+
+# Counts a claim and, below the attempt limit, marks the job as running on
+# this worker and returns the requested fields and its stored input
+CLAIM_SCRIPT = """
+local job = KEYS[1]
+local attempts = redis.call('HINCRBY', job, 'attempts', 1)
+if attempts > tonumber(ARGV[1]) then
+    return {attempts}
+end
+redis.call('HSET', job, 'status', 'PROCESSING', 'worker', ARGV[2], 'lease_expires_at', ARGV[3], 'started_at', ARGV[4])
+redis.call('PUBLISH', ARGV[5], ARGV[6])
+local input_ref = redis.call('HGET', job, 'input_ref')
+local payload = input_ref and redis.call('HGET', 'payload:' .. input_ref, 'data') or false
+return {attempts, redis.call('HMGET', job, unpack(ARGV, 7)), payload}
+"""
+
+# Drops a finished entry, frees its owner's in-flight slot and dispatches
+# what that slot lets through
+ACK_SCRIPT = SCRIPT_FUNCTIONS + """
+local stream, in_flight, workers, job = KEYS[1], KEYS[2], KEYS[3], KEYS[4]
+local group, cap, lanes = ARGV[1], tonumber(ARGV[2]), split(ARGV[3])
+redis.call('XACK', stream, group, ARGV[4])
+redis.call('XDEL', stream, ARGV[4])
+redis.call('HDEL', job, 'queue_entry')
+local owner = redis.call('HGET', job, 'owner')
+if owner then
+    if redis.call('HINCRBY', in_flight, owner, -1) <= 0 then
+        redis.call('HDEL', in_flight, owner)
+    end
+    -- An owner that was at its cap has a head again
+    for _, lane in ipairs(lanes) do
+        refresh_owner(lane, owner, in_flight, cap)
+    end
+end
+return dispatch(stream, group, in_flight, idle_slots(workers), cap, lanes)
+"""
+
+# Gives the jobs waiting on a finished job its outcome, publishes their events
+# and releases their payloads as in payloads.RELEASE_SCRIPT
+FINISH_FOLLOWERS_SCRIPT = """
+local leader_key, job = KEYS[1], KEYS[2]
+local ttl, channel_prefix, event = tonumber(ARGV[2]), ARGV[3], cjson.decode(ARGV[4])
+local payload_ttl = tonumber(ARGV[5])
+if redis.call('GET', leader_key) == ARGV[1] then
+    redis.call('DEL', leader_key)
+end
+local followers = redis.call('LRANGE', job .. ':followers', 0, -1)
+redis.call('DEL', job .. ':followers')
+for _, follower in ipairs(followers) do
+    local ref = redis.call('HGET', 'job:' .. follower, 'input_ref')
+    if ref and redis.call('EXISTS', 'payload:' .. ref) == 1 then
+        if redis.call('HINCRBY', 'payload:' .. ref, 'refs', -1) <= 0 then
+            redis.call('HSET', 'payload:' .. ref, 'refs', 0)
+            redis.call('EXPIRE', 'payload:' .. ref, payload_ttl)
+        end
+    end
+    redis.call('HSET', 'job:' .. follower, unpack(ARGV, 6))
+    redis.call('HDEL', 'job:' .. follower, 'input_ref')
+    if ttl > 0 then
+        redis.call('EXPIRE', 'job:' .. follower, ttl)
+    end
+    event['job_id'] = follower
+    redis.call('PUBLISH', channel_prefix .. follower, cjson.encode(event))
+end
+return #followers
+"""
+
+# Stores a child job's result, counts it on the parent and publishes the
+# parent's progress, returns how many children have completed
+COMPLETE_CHILD_SCRIPT = """
+local child, parent = KEYS[1], KEYS[2]
+redis.call('HSET', child, 'result', ARGV[1])
+local completed = redis.call('HINCRBY', parent, 'children_completed', 1)
+redis.call('PUBLISH', ARGV[2], cjson.encode({
+    type = 'progress', job_id = ARGV[3], progress = 100 * completed / tonumber(ARGV[4])
+}))
+return completed
+"""
+
+
+class JobQueue:
+    """Simulation job queue on a Redis stream read by a consumer group.
+
+    Workers block on the stream instead of polling, and acknowledge an entry
+    once its job has finished. A claimed job carries a lease that the worker
+    renews with `keep_claimed` while the job runs, next to a heartbeat sent
+    with `advertise`. `reap` requeues the jobs of workers whose heartbeat
+    expired, and entries whose lease lapsed are claimed by another worker.
+    Jobs claimed more than QUEUE_MAX_ATTEMPTS times go to the dead letter stream.
+
+    Queued jobs wait in a sorted set per lane, and `dispatch` only moves them
+    onto the stream as workers have idle slots: interactive jobs before bulk
+    ones, owners taking turns, and none past USER_MAX_IN_FLIGHT. Each owner
+    also has a sorted set per lane, and only the first job of owners below
+    the cap is a head to dispatch from, so owners at their cap cost nothing.
+
+    The Lua scripts reach keys they are not passed, the queue runs on a
+    single Redis server and not on Redis Cluster.
+    """
+
+    def __init__(self, redis_client: redis.Redis, consumer: Optional[str] = None):
+        self.redis = redis_client
+        self.consumer = consumer or f"{socket.gethostname()}-{os.getpid()}"
+        self._group_ready = False
+        self._enqueue = self.redis.register_script(ENQUEUE_SCRIPT)
+        self._dispatch = self.redis.register_script(DISPATCH_SCRIPT)
+        self._position = self.redis.register_script(POSITION_SCRIPT)
+        self._claim = self.redis.register_script(CLAIM_SCRIPT)
+        self._ack = self.redis.register_script(ACK_SCRIPT)
+        self._complete_child = self.redis.register_script(COMPLETE_CHILD_SCRIPT)
+        self._finish_followers = self.redis.register_script(FINISH_FOLLOWERS_SCRIPT)
+        self.payloads = PayloadStore(self.redis)
+
+    def ensure_group(self) -> None:
+        """Create the stream and consumer group if they do not exist yet"""
+        if self._group_ready:
+            return
+        try:
+            self.redis.xgroup_create(QUEUE_STREAM, QUEUE_GROUP, id="0", mkstream=True)
+        except redis.ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+        self._group_ready = True
+
+    def _keys(self, *keys: str) -> List[str]:
+        return [QUEUE_STREAM, IN_FLIGHT_KEY, WORKERS_KEY, *keys]
+
+    def _args(self, *args: Any) -> List[Any]:
+        return [QUEUE_GROUP, USER_MAX_IN_FLIGHT, ",".join(LANES), *args]
+
+    def enqueue(
+        self,
+        job_id: str,
+        owner: str = "anonymous",
+        lane: str = "interactive",
+        estimate: float = 0.0,
+        shortest_first: bool = False,
+        fields: Optional[Dict[str, Any]] = None,
+        payload: Optional[str] = None,
+        coalesce_key: Optional[str] = None,
+        client: Optional[redis.client.Pipeline] = None
+    ) -> Optional[int]:
+        """Store a job's `fields` and add it to its owner's queue in `lane`, returns its queue position.
+
+        `estimate` is the seconds the job is expected to run, with
+        `shortest_first` it orders the job among those of the same round.
+        The job's input `payload` is stored once per content, see PayloadStore.
+        With a `coalesce_key`, a queued or running job under the same key
+        runs for this one too: this job waits on it, holding its own payload
+        reference until it finishes, and gets that job's position.
+        Given a pipeline as `client` the position is among its results instead.
+        """
+        if lane not in LANES:
+            raise ValueError(f"Unknown queue lane: {lane}")
+        self.ensure_group()
+        fields = dict(fields or {})
+        pipe = client if client is not None else self.redis.pipeline(transaction=True)
+        if payload is not None:
+            fields["input_ref"] = self.payloads.store(payload, client=pipe)
+        order = int(estimate * 1000) if shortest_first else ""
+        pairs = [value for item in fields.items() for value in item]
+        self._enqueue(
+            keys=self._keys(QUEUE_SEQUENCE, *([coalesce_key] if coalesce_key else [])),
+            args=self._args(job_id, owner, lane, 0, estimate, order, job_channel(job_id), "", *pairs),
+            client=pipe
+        )
+        return None if client is not None else pipe.execute()[-1]
+
+    def enqueue_group(self, parent: Dict[str, Any], children: List[Dict[str, Any]]) -> int:
+        """Store a parent job and enqueue its children in one round trip, returns the last child's position.
+
+        Each child is a dict of `enqueue` keyword arguments.
+        """
+        self.ensure_group()
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.hset(f"job:{parent['id']}", mapping=parent)
+        for child in children:
+            self.enqueue(client=pipe, **child)
+        results = pipe.execute()
+        # The enqueue script is the last command of each child
+        return results[-1] if children else 0
+
+    def dispatch(self) -> int:
+        """Move waiting jobs onto the stream while workers have idle slots.
+
+        Jobs are only put on the stream when a worker can take them, so the
+        choice of which job runs next is made as late as possible.
+        """
+        self.ensure_group()
+        return self._dispatch(keys=self._keys(), args=self._args())
+
+    def length(self) -> int:
+        """Number of jobs waiting for a worker"""
+        self.ensure_group()
+        pipe = self.redis.pipeline()
+        pipe.xlen(QUEUE_STREAM)
+        pipe.xpending(QUEUE_STREAM, QUEUE_GROUP)
+        for lane in LANES:
+            pipe.zcard(f"queue:{lane}")
+        stream_length, pending, *waiting = pipe.execute()
+        # Finished entries are deleted, so the stream holds the claimed and the ready ones
+        return stream_length - pending["pending"] + sum(waiting)
+
+    def mean_estimate(self) -> Optional[float]:
+        """Average estimated seconds of the jobs waiting in the lanes, None if they are empty"""
+        pipe = self.redis.pipeline()
+        for lane in LANES:
+            pipe.zcard(f"queue:{lane}")
+            pipe.get(f"queue:{lane}:work")
+        values = pipe.execute()
+        waiting = sum(values[0::2])
+        if not waiting:
+            return None
+        return sum(float(work or 0) for work in values[1::2]) / waiting
+
+    def position(self, job_id: str) -> int:
+        """Position of a waiting job in dispatch order, 0 once a worker has claimed it.
+
+        The stream only holds as many ready entries as workers have idle slots,
+        behind them a job's position is a rank in its lane's sorted set, so the
+        lookup does not grow with the queue.
+        """
+        self.ensure_group()
+        return self._position(keys=self._keys(), args=self._args(job_id))
+
+    def migrate_legacy_queue(self) -> int:
+        """Move jobs left on the old list queue onto the stream"""
+        moved = 0
+        while (job_id := self.redis.lpop(LEGACY_QUEUE)) is not None:
+            self.enqueue(job_id.decode())
+            moved += 1
+        return moved
+
+    def _reclaim(self) -> Optional[Tuple[str, str]]:
+        """Claim one entry left idle by a worker that stopped renewing its lease"""
+        _, entries, *_ = self.redis.xautoclaim(
+            QUEUE_STREAM, QUEUE_GROUP, self.consumer, QUEUE_CLAIM_IDLE_MS, count=1
+        )
+        if not entries:
+            return None
+        entry_id, fields = entries[0]
+        logger.warning(f"Reclaimed job {fields[b'job_id'].decode()} from a stale worker")
+        return entry_id.decode(), fields[b"job_id"].decode()
+
+    def dead_letter(self, entry_id: str, job_id: str, attempts: int) -> None:
+        """Give up on a job, recording it on the dead letter stream"""
+        logger.error(f"Job {job_id} dead-lettered after {attempts} attempts")
+        input_ref, coalesce_key = self.redis.hmget(f"job:{job_id}", "input_ref", "coalesce_key")
+        error = f"Worker was lost {attempts} times while running this job"
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.xadd(DEAD_LETTER_STREAM, {
+            "job_id": job_id,
+            "entry_id": entry_id,
+            "attempts": attempts,
+            "failed_at": datetime.now().isoformat()
+        }, maxlen=DEAD_LETTER_MAXLEN, approximate=True)
+        pipe.hset(f"job:{job_id}", mapping={"status": "FAILED", "error": error})
+        pipe.hincrby(STATS_KEY, "DEAD_LETTERED", 1)
+        if JOB_TTL:
+            pipe.expire(f"job:{job_id}", JOB_TTL)
+        pipe.publish(job_channel(job_id), job_event(job_id, "status", status="FAILED", error="Worker was lost"))
+        self.ack(entry_id, job_id, client=pipe)
+        if input_ref is not None:
+            self.payloads.release(input_ref.decode(), client=pipe)
+        pipe.execute()
+        if coalesce_key is not None:
+            self.finish_followers(job_id, coalesce_key.decode(), {"status": "FAILED", "error": error})
+
+    def _read(self, block_ms: int, fields: Sequence[str]) -> Optional[Tuple[str, str, Dict[str, str]]]:
+        claimed = self._reclaim()
+        if claimed is None:
+            self.dispatch()
+            response = self.redis.xreadgroup(
+                QUEUE_GROUP, self.consumer, {QUEUE_STREAM: ">"}, count=1, block=block_ms
+            )
+            if not response:
+                return None
+            entry_id, entry = response[0][1][0]
+            claimed = entry_id.decode(), entry[b"job_id"].decode()
+
+        entry_id, job_id = claimed
+        attempts, *claimed_values = self._claim(
+            keys=[f"job:{job_id}"],
+            args=[
+                QUEUE_MAX_ATTEMPTS, self.consumer, _lease_expiry(), datetime.now().isoformat(),
+                job_channel(job_id), job_event(job_id, "status", status="PROCESSING"), *fields
+            ]
+        )
+        if attempts > QUEUE_MAX_ATTEMPTS:
+            self.dead_letter(entry_id, job_id, attempts - 1)
+            return None
+        values, payload = claimed_values
+        job_data = {
+            field: value.decode() for field, value in zip(fields, values) if value is not None
+        }
+        if payload:
+            job_data["payload"] = decode_payload(payload)
+        return entry_id, job_id, job_data
+
+    async def claim(
+        self,
+        fields: Sequence[str] = ("id", "type", "input"),
+        block_ms: int = QUEUE_BLOCK_MS
+    ) -> Optional[Tuple[str, str, Dict[str, str]]]:
+        """Wait up to `block_ms` for a job and mark it as running here.
+
+        Returns (entry id, job id, job fields) with only the `fields` asked
+        for and the stored input under "payload", or None.
+        """
+        self.ensure_group()
+        # The read blocks, keep it off the event loop
+        return await asyncio.to_thread(self._read, block_ms, fields)
+
+    def ack(self, entry_id: str, job_id: str, client: Optional[redis.client.Pipeline] = None) -> None:
+        """Acknowledge a finished entry and drop it from the stream"""
+        self._ack(keys=self._keys(f"job:{job_id}"), args=self._args(entry_id), client=client)
+
+    async def keep_claimed(self, entry_id: str, job_id: str) -> None:
+        """Renew a running job's lease until cancelled"""
+        while True:
+            await asyncio.sleep(QUEUE_CLAIM_IDLE_MS / 3000)
+            pipe = self.redis.pipeline(transaction=False)
+            # Claiming the entry again resets its idle time
+            pipe.xclaim(QUEUE_STREAM, QUEUE_GROUP, self.consumer, 0, [entry_id], justid=True)
+            pipe.hset(f"job:{job_id}", "lease_expires_at", _lease_expiry())
+            pipe.execute()
+
+    def requeue(self, job_id: str) -> None:
+        """Put a job whose worker was lost back at the front of its lane"""
+        self.ensure_group()
+        fields = {"status": "QUEUED", "requeued_at": datetime.now().isoformat()}
+        self._enqueue(
+            keys=self._keys(QUEUE_SEQUENCE),
+            args=self._args(
+                job_id, "", "", 1, 0, "", job_channel(job_id), job_event(job_id, "status", status="QUEUED"),
+                *(value for item in fields.items() for value in item)
+            )
+        )
+
+    def finish_followers(self, job_id: str, key: str, fields: Dict[str, Any]) -> int:
+        """Give the jobs coalesced with a finished job its result `fields`, returns how many there were"""
+        event = job_event(job_id, "status", status=fields["status"], coalesced_with=job_id)
+        pairs = [value for item in {**fields, "coalesced_with": job_id}.items() for value in item]
+        return self._finish_followers(
+            keys=[key, f"job:{job_id}"],
+            args=[job_id, JOB_TTL, job_channel(""), event, PAYLOAD_TTL, *pairs]
+        )
+
+    def complete_child(self, job_id: str, parent_id: str, children: int, result: str) -> bool:
+        """Store a child job's result and count it on its parent, True for the last child"""
+        completed = self._complete_child(
+            keys=[f"job:{job_id}", f"job:{parent_id}"],
+            args=[result, job_channel(parent_id), parent_id, children]
+        )
+        return completed == children
+
+    def reap(self) -> int:
+        """Requeue the jobs of workers whose heartbeat expired, returns how many"""
+        self.ensure_group()
+        live = {worker["id"] for worker in self.live_workers()}
+        requeued = 0
+        for consumer in self.redis.xinfo_consumers(QUEUE_STREAM, QUEUE_GROUP):
+            name = consumer["name"].decode() if isinstance(consumer["name"], bytes) else consumer["name"]
+            if name in live or name == self.consumer:
+                continue
+            entries = self.redis.xpending_range(
+                QUEUE_STREAM, QUEUE_GROUP, min="-", max="+", count=1000, consumername=name
+            )
+            for entry in entries:
+                # Taking the entry over first means only one reaper requeues it,
+                # a second one finds it no longer idle
+                claimed = self.redis.xclaim(QUEUE_STREAM, QUEUE_GROUP, self.consumer, 1000, [entry["message_id"]])
+                if not claimed or claimed[0][1] is None:
+                    continue
+                entry_id, fields = claimed[0]
+                job_id = fields[b"job_id"].decode()
+                self.ack(entry_id.decode(), job_id)
+                logger.warning(f"Worker {name} is gone, requeueing job {job_id}")
+                self.requeue(job_id)
+                requeued += 1
+            if len(entries) < 1000:
+                self.redis.xgroup_delconsumer(QUEUE_STREAM, QUEUE_GROUP, name)
+        return requeued
+
+    def advertise(self, capacity: int, jobs: List[str]) -> None:
+        """Heartbeat: publish this worker's capacity and in-flight jobs, repeat within WORKER_TTL"""
+        key = f"worker:{self.consumer}"
+        pipe = self.redis.pipeline()
+        pipe.hset(key, mapping={
+            "id": self.consumer,
+            "host": socket.gethostname(),
+            "pid": os.getpid(),
+            "capacity": capacity,
+            "in_flight": len(jobs),
+            "jobs": json.dumps(jobs),
+            "updated_at": datetime.now().isoformat()
+        })
+        pipe.expire(key, WORKER_TTL)
+        pipe.sadd(WORKERS_KEY, self.consumer)
+        pipe.execute()
+
+    def withdraw(self) -> None:
+        """Stop advertising this worker"""
+        self.redis.delete(f"worker:{self.consumer}")
+        self.redis.srem(WORKERS_KEY, self.consumer)
+
+    def live_workers(self) -> List[Dict[str, Any]]:
+        """Workers with a current heartbeat, forgetting the rest"""
+        workers = []
+        for worker_id in self.redis.smembers(WORKERS_KEY):
+            data = self.redis.hgetall(f"worker:{worker_id.decode()}")
+            if not data:
+                # The worker stopped refreshing its hash, it is gone
+                self.redis.srem(WORKERS_KEY, worker_id)
+                continue
+            worker = {k.decode(): v.decode() for k, v in data.items()}
+            worker.update(
+                capacity=int(worker["capacity"]),
+                in_flight=int(worker["in_flight"]),
+                jobs=json.loads(worker.get("jobs", "[]"))
+            )
+            workers.append(worker)
+        return workers
+
+    def total_capacity(self) -> int:
+        """Jobs all live workers run at once, 0 if no worker is up"""
+        return sum(worker["capacity"] for worker in self.live_workers())
+
+
+def _lease_expiry() -> str:
+    return (datetime.now() + timedelta(milliseconds=QUEUE_CLAIM_IDLE_MS)).isoformat()
+
@@ -0,0 +1,136 @@
+import math
+import os
+from typing import Any, Dict, Optional
+
+import dotenv
+import redis
+
+from core.jobevents import job_channel
+from core.queue import JOB_TTL, STATS_KEY
+
+dotenv.load_dotenv()
+
+# Durations by sketch bucket, see QueueStats.record
+DURATIONS_KEY = "queue:stats:durations"
+
+# Weight of the latest duration in the moving average
+DURATION_EWMA_ALPHA = float(os.getenv("SIMC_DURATION_EWMA_ALPHA", "0.1"))
+# Relative error of the duration percentiles
+SKETCH_ACCURACY = 0.02
+SKETCH_GAMMA = (1 + SKETCH_ACCURACY) / (1 - SKETCH_ACCURACY)
+# Durations under this many seconds share the lowest bucket
+SKETCH_MIN_DURATION = 0.01
+PERCENTILES = (50, 90, 99)
+
+# Stores a finished job's fields, counts it, folds its duration into the
+# moving average and the sketch, starts its job hash's retention and
+# publishes its event, in one step so concurrent workers do not lose updates
+RECORD_SCRIPT = """
+local stats, durations, job = KEYS[1], KEYS[2], KEYS[3]
+local status, job_type, ttl = ARGV[1], ARGV[2], tonumber(ARGV[3])
+if #ARGV > 8 then
+    redis.call('HSET', job, unpack(ARGV, 9))
+end
+redis.call('HINCRBY', stats, status, 1)
+redis.call('HINCRBY', stats, status .. ':' .. job_type, 1)
+if ARGV[4] ~= '' then
+    local duration, alpha = tonumber(ARGV[4]), tonumber(ARGV[6])
+    local average = tonumber(redis.call('HGET', stats, 'duration_ewma') or '')
+    if average then
+        average = alpha * duration + (1 - alpha) * average
+    else
+        average = duration
+    end
+    redis.call('HSET', stats, 'duration_ewma', tostring(average))
+    redis.call('HINCRBY', durations, ARGV[5], 1)
+end
+if ttl > 0 then
+    redis.call('EXPIRE', job, ttl)
+end
+if ARGV[8] ~= '' then
+    redis.call('PUBLISH', ARGV[7], ARGV[8])
+end
+return 1
+"""
+
+
+def sketch_bucket(duration: float) -> int:
+    """Bucket of a duration, buckets grow geometrically so each is within SKETCH_ACCURACY"""
+    return math.ceil(math.log(max(duration, SKETCH_MIN_DURATION)) / math.log(SKETCH_GAMMA))
+
+
+def bucket_value(bucket: int) -> float:
+    """Representative duration of a bucket"""
+    return 2 * SKETCH_GAMMA ** bucket / (SKETCH_GAMMA + 1)
+
+
+class QueueStats:
+    """Rolling job statistics kept up to date by the workers as jobs finish.
+
+    Durations feed a moving average and a log-bucketed sketch giving
+    percentiles within SKETCH_ACCURACY, so reading the statistics costs the
+    same however many jobs have run.
+    """
+
+    def __init__(self, redis_client: redis.Redis):
+        self.redis = redis_client
+        self._record = self.redis.register_script(RECORD_SCRIPT)
+
+    def record(
+        self,
+        job_id: str,
+        job_type: str,
+        status: str,
+        duration: Optional[float] = None,
+        fields: Optional[Dict[str, Any]] = None,
+        event: str = ""
+    ) -> None:
+        """Count a job that finished with `status`, with the seconds it held a worker slot.
+
+        The job's `fields` are stored and its `event` published in the same step.
+        """
+        self._record(
+            keys=[STATS_KEY, DURATIONS_KEY, f"job:{job_id}"],
+            args=[
+                status, job_type, JOB_TTL,
+                "" if duration is None else duration,
+                sketch_bucket(duration) if duration is not None else "",
+                DURATION_EWMA_ALPHA,
+                job_channel(job_id), event,
+                *(value for item in (fields or {}).items() for value in item)
+            ]
+        )
+
+    def percentiles(self) -> Dict[str, float]:
+        """Job duration percentiles, empty until a job has finished"""
+        buckets = sorted(
+            (int(bucket), int(count)) for bucket, count in self.redis.hgetall(DURATIONS_KEY).items()
+        )
+        total = sum(count for _, count in buckets)
+        if not total:
+            return {}
+        result = {}
+        seen = 0
+        wanted = iter(PERCENTILES)
+        percentile = next(wanted)
+        for bucket, count in buckets:
+            seen += count
+            while percentile is not None and seen >= total * percentile / 100:
+                result[f"p{percentile}"] = bucket_value(bucket)
+                percentile = next(wanted, None)
+        return result
+
+    def average_duration(self) -> Optional[float]:
+        """Moving average of job durations, None until a job has finished"""
+        average = self.redis.hget(STATS_KEY, "duration_ewma")
+        return float(average) if average is not None else None
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Counters, average and percentiles of finished jobs"""
+        stats = {k.decode(): v.decode() for k, v in self.redis.hgetall(STATS_KEY).items()}
+        average = stats.pop("duration_ewma", None)
+        return {
+            "counters": {name: int(value) for name, value in stats.items()},
+            "duration_ewma": float(average) if average is not None else None,
+            "duration_percentiles": self.percentiles()
+        }
@@ -0,0 +1,99 @@
+import math
+import os
+import random
+from typing import Any, Dict, List
+
+import dotenv
+
+from core.simc import profile_option, with_options
+
+dotenv.load_dotenv()
+
+# Upper bound on the shards a single job may be split into
+SIMC_MAX_SHARDS = int(os.getenv("SIMC_MAX_SHARDS", "32"))
+# Iterations split across the shards when the profile does not set them
+SIMC_SHARD_DEFAULT_ITERATIONS = int(os.getenv("SIMC_SHARD_DEFAULT_ITERATIONS", "10000"))
+
+# SimC seeds each of its threads from the seed plus the thread index, spacing the
+# shard seeds keeps the threads of different shards on different streams
+SEED_STRIDE = 1 << 16
+
+
+def shard_inputs(input_text: str, shards: int) -> List[str]:
+    """Split a profile into `shards` profiles with their own seed and share of the iterations"""
+    if not 1 <= shards <= SIMC_MAX_SHARDS:
+        raise ValueError(f"shards must be between 1 and {SIMC_MAX_SHARDS}")
+
+    try:
+        iterations = int(profile_option(input_text, "iterations") or SIMC_SHARD_DEFAULT_ITERATIONS)
+    except ValueError:
+        raise ValueError("iterations must be a whole number")
+    if iterations < shards:
+        raise ValueError(f"Cannot split {iterations} iterations into {shards} shards")
+
+    base_seed = random.SystemRandom().randrange(1, 1 << 30)
+    per_shard = math.ceil(iterations / shards)
+    return [
+        # A target error would let each shard stop early at a different point
+        with_options(input_text, iterations=per_shard, target_error=0, seed=base_seed + index * SEED_STRIDE)
+        for index in range(shards)
+    ]
+
+
+def _shard_stats(mean: float, std_dev: float, count: int) -> Dict[str, float]:
+    return {"mean": mean, "std_dev": std_dev, "count": count}
+
+
+def shard_summary(report: dict) -> Dict[str, Dict[str, Dict[str, float]]]:
+    """Per actor and per profileset statistics of one shard's JSON report"""
+    sim = report.get("sim", {})
+    iterations = sim.get("statistics", {}).get("iterations")
+
+    players = {}
+    for player in sim.get("players", []):
+        dps = player["collected_data"]["dps"]
+        count = dps.get("count") or iterations or 1
+        std_dev = dps.get("std_dev", dps.get("mean_std_dev", 0) * math.sqrt(count))
+        players[player["name"]] = _shard_stats(dps["mean"], std_dev, count)
+
+    profilesets = {}
+    for result in sim.get("profilesets", {}).get("results", []):
+        count = result.get("iterations") or iterations or 1
+        std_dev = result.get("stddev", result.get("mean_stddev", 0) * math.sqrt(count))
+        profilesets[result["name"]] = _shard_stats(result["mean"], std_dev, count)
+
+    return {"players": players, "profilesets": profilesets}
+
+
+def pool(shards: List[Dict[str, float]]) -> Dict[str, Any]:
+    """Pool the mean and variance of independent samples of the same distribution"""
+    count = sum(shard["count"] for shard in shards)
+    mean = sum(shard["mean"] * shard["count"] for shard in shards) / count
+    # Within shard sum of squares plus the spread of the shard means
+    squares = sum(
+        (shard["count"] - 1) * shard["std_dev"] ** 2 + shard["count"] * (shard["mean"] - mean) ** 2
+        for shard in shards
+    )
+    variance = squares / (count - 1) if count > 1 else 0.0
+    mean_std_dev = math.sqrt(variance / count)
+    return {
+        "mean": mean,
+        "std_dev": math.sqrt(variance),
+        "mean_std_dev": mean_std_dev,
+        "error": 1.96 * mean_std_dev,
+        "iterations": count
+    }
+
+
+def merge_shards(stats: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Merge the summaries of every shard of a job, see shard_summary"""
+    merged: Dict[str, Any] = {"shards": len(stats)}
+    for section in ("players", "profilesets"):
+        names = list(dict.fromkeys(name for shard in stats for name in shard[section]))
+        merged[section] = [
+            {"name": name, **pool([shard[section][name] for shard in stats if name in shard[section]])}
+            for name in names
+        ]
+    merged["profilesets"].sort(key=lambda result: result["mean"], reverse=True)
+    merged["iterations"] = max((player["iterations"] for player in merged["players"]), default=0)
+    return merged
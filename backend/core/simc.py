@@ -1,83 +1,470 @@
+import re
+import json
 import uuid
 import dotenv
 import os
 import asyncio
+import tempfile
+from collections import deque
+from contextlib import asynccontextmanager
 from datetime import datetime
-from typing import Optional, AsyncGenerator
+import logging
+from typing import AsyncGenerator, Awaitable, Callable, Dict, List, Optional, Tuple
 import aiofiles
+import redis.asyncio as aioredis
+from redis.exceptions import RedisError
 
-from core.cache import cache_simc_result
+from core.cache import REDIS_URL, cache_simc_result, create_simc_cache_key
+from core.metrics import metrics
 from core.output_filter import SafeOutputFilter
 
 dotenv.load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 simc = os.getenv("SIMC")
 
+# Streaming output is coalesced into frames flushed every window or every N lines
+STREAM_BATCH_WINDOW = int(os.getenv("SIMC_STREAM_BATCH_WINDOW_MS", "100")) / 1000
+STREAM_BATCH_MAX_LINES = int(os.getenv("SIMC_STREAM_BATCH_MAX_LINES", "200"))
+# Upper bound on lines read from SimC but not yet batched
+STREAM_BUFFER_LINES = int(os.getenv("SIMC_STREAM_BUFFER_LINES", "1000"))
+# Frames of a streamed run kept for clients that resume after losing their connection
+STREAM_REPLAY_FRAMES = int(os.getenv("SIMC_STREAM_REPLAY_FRAMES", "500"))
+# Seconds a finished run, with its final frame, can still be resumed
+STREAM_RETENTION = float(os.getenv("SIMC_STREAM_RETENTION", "300"))
+# Seconds a run keeps going without subscribers, waiting for one to resume
+STREAM_RESUME_GRACE = float(os.getenv("SIMC_STREAM_RESUME_GRACE", "30"))
+# Frames waiting for one subscriber of a run, one that falls further behind
+# loses its queued output frames, see SimulationRun.publish
+STREAM_SUBSCRIBER_FRAMES = max(8, int(os.getenv("SIMC_STREAM_SUBSCRIBER_FRAMES", "100")))
+# Output frames a lagging subscriber can lose, it keeps the latest progress
+LOSSY_FRAME_TYPES = {"stdout", "stderr"}
+
+# Threads each SimC process uses, 0 leaves it to SimC which uses every core
+SIMC_THREADS = int(os.getenv("SIMC_THREADS", "0"))
+# Maximum concurrent SimC processes per client, defaults to as many as fit the
+# cores at SIMC_THREADS each, or one when every process uses every core
+SIMC_MAX_PROCESSES = int(os.getenv(
+    "SIMC_MAX_PROCESSES",
+    str(max(1, (os.cpu_count() or 1) // SIMC_THREADS) if SIMC_THREADS else 1)
+))
+# Seconds a SimC process gets to exit after SIGTERM before it is killed
+SIMC_KILL_GRACE_PERIOD = float(os.getenv("SIMC_KILL_GRACE_PERIOD", "5"))
+
+# How profiles reach SimC: "file" writes them under inputs/, "tmpfs" uses an
+# unlinked memory-backed file and "stdin" pipes them in, neither touching disk
+SIMC_INPUT_MODE = os.getenv("SIMC_INPUT_MODE", "tmpfs" if os.path.isdir("/dev/shm") else "file")
+SIMC_TMPFS_DIR = os.getenv("SIMC_TMPFS_DIR", "/dev/shm")
+
+# Precision of the first pass of a two stage simulation, in percent
+COARSE_TARGET_ERROR = float(os.getenv("SIMC_COARSE_TARGET_ERROR", "1.0"))
+
+# SimC often outputs progress like: "Generating baseline: 100%"
+PROGRESS_PATTERNS = (
+    re.compile(r'(\d+)%'),
+    re.compile(r'Progress:\s*(\d+)'),
+    re.compile(r'Completed:\s*(\d+)/(\d+)'),
+)
+
+# Global options like: target_error=0.1
+OPTION_LINE = re.compile(r'^\s*([a-z_]+)\s*=')
+# Profileset lines like: profileset."Combo 1"+=finger1=,id=...
+PROFILESET_LINE = re.compile(r'^\s*profileset\.("?)([^"+=]+)\1\+?=')
+
+def run_frames_key(run_id: str) -> str:
+    """Redis stream of a run's frames, entry `seq-0` for each and `seq-1` marking the end"""
+    return f"simc:run:{run_id}:frames"
+
+
+def run_owner_key(run_id: str) -> str:
+    """Registry entry naming the API process running a run"""
+    return f"simc:run:{run_id}:owner"
+
+
+def run_followed_key(run_id: str) -> str:
+    """Set while a client follows a run from another API process"""
+    return f"simc:run:{run_id}:followed"
+
+
+def entry_seq(entry_id) -> Tuple[int, bool]:
+    """Frame seq of a run stream entry, and whether it is the end marker"""
+    if isinstance(entry_id, bytes):
+        entry_id = entry_id.decode()
+    seq, marker = entry_id.split("-")
+    return int(seq), marker != "0"
+
+def simc_command(input_arg: str, *options: str) -> List[str]:
+    """SimC command line for a profile and output options"""
+    command = [simc, input_arg, *options]
+    if SIMC_THREADS:
+        command.append(f"threads={SIMC_THREADS}")
+    return command
+
+def with_options(input_text: str, **options) -> str:
+    """Replace global options of a profile, e.g. with_options(text, iterations=1000)"""
+    lines = []
+    for line in input_text.splitlines():
+        match = OPTION_LINE.match(line)
+        if match is None or match.group(1) not in options:
+            lines.append(line)
+    return "\n".join(lines + [f"{name}={value}" for name, value in options.items()]) + "\n"
+
+def with_target_error(input_text: str, target_error: float) -> str:
+    """Override the precision of a profile"""
+    return with_options(input_text, target_error=target_error)
+
+def profile_option(input_text: str, name: str) -> Optional[str]:
+    """Value of the last global `name=` option in a profile, SimC uses the last one"""
+    value = None
+    for line in input_text.splitlines():
+        match = OPTION_LINE.match(line)
+        if match is not None and match.group(1) == name:
+            value = line.split("=", 1)[1].strip()
+    return value
+
+def keep_profilesets(input_text: str, names: set) -> str:
+    """Remove every profileset whose name is not in `names`"""
+    lines = []
+    for line in input_text.splitlines():
+        match = PROFILESET_LINE.match(line)
+        if match is None or match.group(2) in names:
+            lines.append(line)
+    return "\n".join(lines) + "\n"
+
+def report_summary(report: dict) -> dict:
+    """Mean DPS and 95% error of every actor and profileset in a JSON report"""
+    sim = report.get("sim", {})
+    players = []
+    for player in sim.get("players", []):
+        dps = player["collected_data"]["dps"]
+        players.append({
+            "name": player["name"],
+            "mean": dps["mean"],
+            "error": 1.96 * dps.get("mean_std_dev", 0)
+        })
+    profilesets = [
+        {"name": result["name"], "mean": result["mean"], "error": 1.96 * result.get("mean_stddev", 0)}
+        for result in sim.get("profilesets", {}).get("results", [])
+    ]
+    return {"players": players, "profilesets": profilesets}
+
+def contending_profilesets(summary: dict) -> set:
+    """Profilesets whose error interval reaches the leader's, the rest cannot win"""
+    entries = summary["players"] + summary["profilesets"]
+    if not entries:
+        return set()
+    leader = max(entries, key=lambda entry: entry["mean"])
+    floor = leader["mean"] - leader["error"]
+    return {entry["name"] for entry in summary["profilesets"] if entry["mean"] + entry["error"] >= floor}
+
+class SimulationRun:
+    """A single SimC process whose output frames are fanned out to every subscriber.
+
+    Frames are numbered by `seq` and the last STREAM_REPLAY_FRAMES of them
+    kept, the final result or error being the last, so a client that lost
+    its connection can resume from the last frame it got. The process running
+    it also records its frames in Redis, where clients reconnected to any
+    other API process resume from, see SimcClient.resume_simulation.
+    """
+
+    def __init__(self, key: str):
+        self.key = key
+        self.run_id = uuid.uuid4().hex
+        self.subscribers: List[asyncio.Queue] = []
+        self.task: Optional[asyncio.Task] = None
+        self.done = False
+        self.seq = 0
+        self.frames: deque = deque(maxlen=STREAM_REPLAY_FRAMES)
+        self.abandon_task: Optional[asyncio.Task] = None
+        # Cleared when recording the frames in Redis fails
+        self.recorded = True
+
+    def subscribe(self, after: Optional[int] = None) -> asyncio.Queue:
+        """Queue of the run's frames from now on, or from the first kept after seq `after`.
+
+        The queue starts with a "run" frame naming the run, and a "gap" frame
+        if frames after `after` are no longer kept. It holds at most
+        STREAM_SUBSCRIBER_FRAMES frames, see `publish`.
+        """
+        if self.abandon_task is not None:
+            self.abandon_task.cancel()
+            self.abandon_task = None
+        queue: asyncio.Queue = asyncio.Queue(maxsize=STREAM_SUBSCRIBER_FRAMES)
+        queue.put_nowait({"type": "run", "run_id": self.run_id, "latest_seq": self.seq})
+        if after is not None:
+            missed = [frame for frame in self.frames if frame["seq"] > after]
+            first = missed[0]["seq"] if missed else self.seq + 1
+            if first > after + 1:
+                queue.put_nowait({"type": "gap", "from_seq": after + 1, "to_seq": first - 1})
+            for frame in missed:
+                _put_frame(queue, frame)
+        if self.done:
+            _put_frame(queue, None)
+        else:
+            self.subscribers.append(queue)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue) -> bool:
+        """Remove a subscriber, returns True if it was the last one"""
+        if queue in self.subscribers:
+            self.subscribers.remove(queue)
+        return not self.subscribers
+
+    def publish(self, frame: Optional[dict]) -> Optional[dict]:
+        """Number and keep a frame and send it to every subscriber, None marks the end of the run.
+
+        Returns the numbered frame.
+
+        A subscriber whose queue is full loses its queued output frames but
+        the latest, each run of lost frames replaced by a "gap" frame it can
+        resume from.
+        """
+        if frame is not None:
+            self.seq += 1
+            frame = {**frame, "seq": self.seq}
+            self.frames.append(frame)
+        for queue in self.subscribers:
+            _put_frame(queue, frame)
+        return frame
+
+
+def _put_frame(queue: asyncio.Queue, frame: Optional[dict]) -> None:
+    """Queue a frame for a subscriber, dropping older output frames if it is full"""
+    if queue.full():
+        queued = [queue.get_nowait() for _ in range(queue.qsize())]
+        latest = max(
+            (index for index, item in enumerate(queued) if item is not None and item["type"] == "stdout"),
+            default=None
+        )
+        kept: List[Optional[dict]] = []
+        for index, item in enumerate(queued):
+            if item is None or item["type"] not in LOSSY_FRAME_TYPES or index == latest:
+                kept.append(item)
+                continue
+            previous = kept[-1] if kept else None
+            if previous is not None and previous["type"] == "gap" and previous["to_seq"] == item["seq"] - 1:
+                previous["to_seq"] = item["seq"]
+            else:
+                kept.append({"type": "gap", "from_seq": item["seq"], "to_seq": item["seq"]})
+            metrics.incr("simc_stream_frames_dropped")
+        for item in kept:
+            queue.put_nowait(item)
+    queue.put_nowait(frame)
+
 class SimcClient:
     """Singleton client for SimulationCraft operations with streaming support"""
     
-    def __init__(self):
+    def __init__(self, redis_client: Optional[aioredis.Redis] = None):
         self.simulations_dir = "simulations"
         os.makedirs(self.simulations_dir, exist_ok=True)
         self.inputs_dir = "inputs"
         os.makedirs(self.inputs_dir, exist_ok=True)
         self.output_filter = SafeOutputFilter()
+        # Bounds the number of SimC processes this client runs at once
+        self.process_slots = asyncio.Semaphore(SIMC_MAX_PROCESSES)
+        # Streaming runs in progress, keyed by input so identical inputs share one process
+        self.active_runs: Dict[str, SimulationRun] = {}
+        # Running and recently finished runs clients can resume, keyed by run id
+        self.resumable_runs: Dict[str, SimulationRun] = {}
+        # Where runs are recorded for clients resuming them from other processes
+        self.redis = redis_client or aioredis.from_url(REDIS_URL)
+        self.node_id = uuid.uuid4().hex
+
+    async def close(self) -> None:
+        await self.redis.aclose()
 
     async def stream_simulation(self, input_text: str) -> AsyncGenerator[dict, None]:
+        """Stream output frames of a simulation, sharing the run with identical inputs.
+
+        Closing the generator unsubscribes; when the last subscriber of a run
+        leaves before it finishes and none resumes within STREAM_RESUME_GRACE,
+        its SimC process is terminated.
+        """
+        key = create_simc_cache_key(input_text)
+        run = self.active_runs.get(key)
+        if run is None or run.done:
+            run = SimulationRun(key)
+            self.active_runs[key] = run
+            self.resumable_runs[run.run_id] = run
+            run.task = asyncio.create_task(self._execute_run(run, input_text))
+
+        async for frame in self._follow(run):
+            yield frame
+
+    async def resume_simulation(self, run_id: str, after: int) -> Optional[AsyncGenerator[dict, None]]:
+        """Stream the frames of a run after seq `after`, None if the run is unknown or expired.
+
+        Runs of other API processes are followed through the frames they
+        record in Redis, keeping them from being abandoned while followed.
+        """
+        run = self.resumable_runs.get(run_id)
+        if run is not None:
+            return self._follow(run, after)
+        try:
+            owner = await self.redis.get(run_owner_key(run_id))
+        except RedisError as e:
+            logger.warning(f"Could not look up run {run_id}: {e}")
+            return None
+        if owner is None:
+            return None
+        return self._follow_recorded(run_id, after)
+
+    async def _follow(self, run: SimulationRun, after: Optional[int] = None) -> AsyncGenerator[dict, None]:
+        queue = run.subscribe(after)
+        try:
+            while True:
+                frame = await queue.get()
+                if frame is None:
+                    break
+                yield frame
+        finally:
+            if run.unsubscribe(queue) and not run.done and run.abandon_task is None:
+                logger.info(f"Last subscriber left run {run.key}, cancelling it unless one resumes")
+                run.abandon_task = asyncio.create_task(self._abandon_run(run))
+
+    async def _follow_recorded(self, run_id: str, after: int) -> AsyncGenerator[dict, None]:
+        """Frames of a run another process records, as `_follow` gives those of local runs.
+
+        Reads the kept frames after `after`, then blocks for new ones until
+        the end marker, refreshing the run's followed entry meanwhile.
+        """
+        key = run_frames_key(run_id)
+        followed_ms = int(STREAM_RESUME_GRACE * 1000)
+        loop = asyncio.get_running_loop()
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.set(run_followed_key(run_id), self.node_id, px=followed_ms)
+        pipe.xrevrange(key, count=1)
+        # `after-1` sorts right after frame `after`, before the next one
+        pipe.xrange(key, min=f"{after}-1")
+        _, latest, entries = await pipe.execute()
+        refreshed_at = loop.time()
+        yield {"type": "run", "run_id": run_id, "latest_seq": entry_seq(latest[0][0])[0] if latest else after}
+
+        last_id = f"{after}-0"
+        while True:
+            for entry_id, fields in entries:
+                seq, end = entry_seq(entry_id)
+                first = seq + 1 if end else seq
+                if first > after + 1:
+                    yield {"type": "gap", "from_seq": after + 1, "to_seq": first - 1}
+                if end:
+                    return
+                after, last_id = seq, entry_id
+                yield json.loads(fields[b"frame"])
+
+            if loop.time() - refreshed_at >= STREAM_RESUME_GRACE / 2:
+                await self.redis.set(run_followed_key(run_id), self.node_id, px=followed_ms)
+                refreshed_at = loop.time()
+            response = await self.redis.xread({key: last_id}, count=STREAM_SUBSCRIBER_FRAMES, block=followed_ms // 2 or 1)
+            entries = response[0][1] if response else []
+            if not entries and not await self.redis.exists(key):
+                # The run expired without its end marker, its process is gone
+                return
+
+    async def _abandon_run(self, run: SimulationRun) -> None:
+        """Cancel a run nobody resumes within STREAM_RESUME_GRACE, here or from another process"""
+        while True:
+            await asyncio.sleep(STREAM_RESUME_GRACE)
+            if run.subscribers or run.done:
+                return
+            try:
+                followed = await self.redis.exists(run_followed_key(run.run_id))
+            except RedisError:
+                followed = False
+            if not followed:
+                break
+        run.abandon_task = None
+        logger.info(f"Nobody resumed run {run.key}, cancelling simulation")
+        metrics.incr("simc_runs_abandoned")
+        run.task.cancel()
+
+    async def _record(self, run: SimulationRun, entry_id: Optional[str] = None, fields: Optional[dict] = None) -> None:
+        """Add an entry to the run's Redis stream and refresh its owner entry, both for STREAM_RETENTION.
+
+        A run whose frames cannot be recorded is only resumable on this process.
+        """
+        if not run.recorded:
+            return
+        retention = int(STREAM_RETENTION * 1000)
+        key = run_frames_key(run.run_id)
+        pipe = self.redis.pipeline(transaction=False)
+        if entry_id is not None:
+            pipe.xadd(key, fields, id=entry_id, maxlen=STREAM_REPLAY_FRAMES, approximate=True)
+            pipe.pexpire(key, retention)
+        pipe.set(run_owner_key(run.run_id), self.node_id, px=retention)
+        try:
+            await pipe.execute()
+        except RedisError as e:
+            logger.warning(f"Could not record run {run.key}, it can only be resumed on this process: {e}")
+            run.recorded = False
+
+    async def _execute_run(self, run: "SimulationRun", input_text: str) -> None:
+        """Run a simulation and publish its frames to the run's subscribers and Redis"""
+        try:
+            await self._record(run)
+            async for frame in self._run_process(input_text):
+                frame = run.publish(frame)
+                await self._record(run, f"{frame['seq']}-0", {"frame": json.dumps(frame)})
+        except asyncio.CancelledError:
+            pass
+        finally:
+            run.done = True
+            run.publish(None)
+            if self.active_runs.get(run.key) is run:
+                del self.active_runs[run.key]
+            asyncio.get_running_loop().call_later(STREAM_RETENTION, self.resumable_runs.pop, run.run_id, None)
+            await self._record(run, f"{run.seq}-1", {"end": 1})
+
+    async def _run_process(self, input_text: str) -> AsyncGenerator[dict, None]:
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         unique_id = str(uuid.uuid4())[:8]
         filename = f"simc_{timestamp}_{unique_id}"
 
-        input_file = f"{self.inputs_dir}/{filename}.simc"
-        with open(input_file, "w") as f:
-            f.write(input_text)
-
         output_file = f"{self.simulations_dir}/{filename}.html"
-        command = [simc, input_file, f"html={output_file}"]
+        process = None
+        completed = False
 
         try:
-            process = await asyncio.create_subprocess_exec(
-                *command,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
+            async with self._simc_input(input_text, filename) as (input_arg, input_options):
+                command = simc_command(input_arg, f"html={output_file}")
+                async with self.process_slots:
+                    process = await asyncio.create_subprocess_exec(
+                        *command,
+                        stdout=asyncio.subprocess.PIPE,
+                        stderr=asyncio.subprocess.PIPE,
+                        **input_options
+                    )
+                    metrics.incr("simc_runs_started")
+                    if process.stdin is not None:
+                        await self._feed_stdin(process, input_text)
 
-            # Stream stdout
-            while True:
-                line = await process.stdout.readline()
-                if not line:
-                    break
-                    
-                decoded_line = line.decode().rstrip()
-                filtered_line = self.output_filter.filter_line(decoded_line)
-                
-                # Detect progress
-                progress = self._extract_progress(filtered_line)
-                
-                yield {
-                    "type": "stdout",
-                    "content": filtered_line,
-                    "progress": progress
-                }
+                    # Drain stdout and stderr concurrently so a chatty stderr can never
+                    # fill its pipe and stall SimC while we are blocked on stdout
+                    queue: asyncio.Queue = asyncio.Queue(maxsize=STREAM_BUFFER_LINES)
+                    readers = [
+                        asyncio.create_task(self._drain_pipe(process.stdout, "stdout", queue)),
+                        asyncio.create_task(self._drain_pipe(process.stderr, "stderr", queue)),
+                    ]
+                    try:
+                        async for frame in self._batch_frames(queue, len(readers)):
+                            yield frame
+                    finally:
+                        for reader in readers:
+                            reader.cancel()
 
-            # Stream stderr if any
-            stderr_output = await process.stderr.read()
-            if stderr_output:
-                filtered_stderr = self.output_filter.filter_text(stderr_output.decode())
-                yield {
-                    "type": "stderr",
-                    "content": filtered_stderr
-                }
+                    # Wait for process to complete
+                    return_code = await process.wait()
 
-            # Wait for process to complete
-            return_code = await process.wait()
-            
             if return_code != 0:
+                metrics.incr("simc_runs_failed")
                 yield {
                     "type": "error",
                     "content": f"SimC exited with code {return_code}"
                 }
             else:
+                completed = True
+                metrics.incr("simc_runs_completed")
                 # Read the HTML report and send it as 'result'
                 try:
                     async with aiofiles.open(output_file, mode='r', encoding='utf-8') as f:
@@ -99,22 +486,286 @@ class SimcClient:
                 "content": self.output_filter.filter_text(str(e))
             }
         finally:
-            if os.path.exists(input_file):
-                os.remove(input_file)
+            if process is not None:
+                await self._terminate(process)
+            # A killed run leaves a partial report behind
+            if not completed and os.path.exists(output_file):
+                os.remove(output_file)
+
+    @asynccontextmanager
+    async def _simc_input(self, input_text: str, filename: str):
+        """Hand the profile to SimC as configured by SIMC_INPUT_MODE.
+
+        Yields the input argument for the SimC command line and extra options
+        for create_subprocess_exec. The profile is gone once the context exits.
+        """
+        if SIMC_INPUT_MODE == "stdin":
+            yield "/dev/stdin", {"stdin": asyncio.subprocess.PIPE}
+        elif SIMC_INPUT_MODE == "tmpfs":
+            fd, path = tempfile.mkstemp(prefix=f"{filename}_", suffix=".simc", dir=SIMC_TMPFS_DIR)
+            try:
+                # Unlinked before SimC starts, so nothing is left behind even if
+                # we crash; SimC reopens it through the inherited descriptor
+                os.unlink(path)
+                with os.fdopen(fd, "w", closefd=False) as f:
+                    f.write(input_text)
+                yield f"/dev/fd/{fd}", {"pass_fds": (fd,)}
+            finally:
+                os.close(fd)
+        else:
+            input_file = f"{self.inputs_dir}/{filename}.simc"
+            try:
+                async with aiofiles.open(input_file, "w") as f:
+                    await f.write(input_text)
+                yield input_file, {}
+            finally:
+                if os.path.exists(input_file):
+                    os.remove(input_file)
+
+    async def _feed_stdin(self, process: asyncio.subprocess.Process, input_text: str) -> None:
+        """Write the profile to SimC's stdin and close it"""
+        try:
+            process.stdin.write(input_text.encode())
+            await process.stdin.drain()
+            process.stdin.close()
+        except (BrokenPipeError, ConnectionResetError):
+            # SimC exited before reading its input, the exit code reports why
+            pass
 
+    async def _communicate(
+        self,
+        process: asyncio.subprocess.Process,
+        input_text: str,
+        on_progress: Optional[Callable[[float, str], None]] = None
+    ) -> bytes:
+        """Wait for SimC to exit and return its stderr, passing progress lines to `on_progress`"""
+        stdin_data = input_text.encode() if process.stdin is not None else None
+        if on_progress is None:
+            _, stderr = await process.communicate(stdin_data)
+            return stderr
+
+        if stdin_data is not None:
+            await self._feed_stdin(process, input_text)
+        stderr_task = asyncio.create_task(process.stderr.read())
+        try:
+            while True:
+                try:
+                    line = await process.stdout.readline()
+                except ValueError:
+                    continue
+                if not line:
+                    break
+                decoded_line = line.decode(errors="replace").rstrip().rsplit("\r", 1)[-1]
+                progress = self._extract_progress(decoded_line)
+                if progress is not None:
+                    on_progress(progress, self.output_filter.filter_line(decoded_line))
+            await process.wait()
+            return await stderr_task
+        finally:
+            stderr_task.cancel()
+
+    async def _terminate(self, process: asyncio.subprocess.Process) -> None:
+        """Stop a SimC process with SIGTERM, then SIGKILL after the grace period, and reap it"""
+        if process.returncode is not None:
+            return
+        try:
+            process.terminate()
+        except ProcessLookupError:
+            return
+        try:
+            await asyncio.wait_for(process.wait(), SIMC_KILL_GRACE_PERIOD)
+        except asyncio.TimeoutError:
+            logger.warning(f"SimC process {process.pid} ignored SIGTERM, sending SIGKILL")
+            process.kill()
+            await process.wait()
+        metrics.incr("simc_processes_killed")
+
+    async def _drain_pipe(self, stream: asyncio.StreamReader, name: str, queue: asyncio.Queue) -> None:
+        """Read a subprocess pipe line by line into the shared bounded queue"""
+        while True:
+            try:
+                line = await stream.readline()
+            except ValueError:
+                # Line exceeded the reader limit and was discarded, keep draining
+                continue
+            if not line:
+                break
+            # SimC redraws its progress bar with carriage returns, only the
+            # last redraw of a line is worth keeping
+            decoded_line = line.decode(errors="replace").rstrip().rsplit("\r", 1)[-1]
+            await queue.put((name, decoded_line))
+        await queue.put((name, None))
+
+    async def _batch_frames(self, queue: asyncio.Queue, open_pipes: int) -> AsyncGenerator[dict, None]:
+        """Coalesce queued lines into frames flushed every batch window or batch size"""
+        loop = asyncio.get_running_loop()
+        stdout_lines: List[str] = []
+        stderr_lines: List[str] = []
+        progress = None
+        last_was_progress = False
+        deadline = None
+        pending_get = None
+
+        def flush():
+            frames = []
+            if stdout_lines:
+                frames.append({
+                    "type": "stdout",
+                    "content": "\n".join(stdout_lines),
+                    "progress": progress
+                })
+            if stderr_lines:
+                frames.append({
+                    "type": "stderr",
+                    "content": "\n".join(stderr_lines)
+                })
+            stdout_lines.clear()
+            stderr_lines.clear()
+            return frames
+
+        try:
+            while open_pipes:
+                if pending_get is None:
+                    pending_get = asyncio.ensure_future(queue.get())
+                timeout = None if deadline is None else max(0.0, deadline - loop.time())
+                done, _ = await asyncio.wait({pending_get}, timeout=timeout)
+
+                if not done:
+                    # Batch window elapsed
+                    for frame in flush():
+                        yield frame
+                    deadline = None
+                    last_was_progress = False
+                    continue
+
+                name, line = pending_get.result()
+                pending_get = None
+
+                if line is None:
+                    open_pipes -= 1
+                    continue
+
+                filtered_line = self.output_filter.filter_line(line)
+                if name == "stdout":
+                    line_progress = self._extract_progress(line)
+                    if line_progress is not None:
+                        progress = line_progress
+                        # Collapse consecutive progress updates to the latest one
+                        if last_was_progress:
+                            stdout_lines[-1] = filtered_line
+                        else:
+                            stdout_lines.append(filtered_line)
+                        last_was_progress = True
+                    else:
+                        stdout_lines.append(filtered_line)
+                        last_was_progress = False
+                else:
+                    stderr_lines.append(filtered_line)
+
+                if deadline is None:
+                    deadline = loop.time() + STREAM_BATCH_WINDOW
+                if len(stdout_lines) + len(stderr_lines) >= STREAM_BATCH_MAX_LINES:
+                    for frame in flush():
+                        yield frame
+                    deadline = None
+                    last_was_progress = False
+
+            for frame in flush():
+                yield frame
+        finally:
+            if pending_get is not None:
+                pending_get.cancel()
+
+    async def stream_adaptive(
+        self,
+        input_text: str,
+        should_refine: Callable[[dict], Awaitable[bool]],
+        target_error: Optional[float] = None
+    ) -> AsyncGenerator[dict, None]:
+        """Two stage simulation, a coarse pass then a refine pass on request.
+
+        Both passes yield their progress as "stdout" frames. The coarse pass
+        runs at SIMC_COARSE_TARGET_ERROR and its numbers are yielded straight
+        away. The refine pass runs at `target_error`, or the
+        precision the input asks for, only if `should_refine` agrees, and only
+        for profilesets still within the error margin of the leader.
+        """
+        yield {"type": "stage", "content": {"stage": "coarse", "target_error": COARSE_TARGET_ERROR}}
+        async for frame in self._stream_json(with_target_error(input_text, COARSE_TARGET_ERROR)):
+            if frame["type"] == "report":
+                coarse = report_summary(frame["content"])
+            else:
+                yield frame
+        yield {"type": "preliminary", "content": coarse}
+
+        if not await should_refine(coarse):
+            return
+
+        refine_input = input_text if target_error is None else with_target_error(input_text, target_error)
+        refined_names = set()
+        if coarse["profilesets"]:
+            refined_names = contending_profilesets(coarse)
+            refine_input = keep_profilesets(refine_input, refined_names)
+            metrics.incr("simc_profilesets_pruned", len(coarse["profilesets"]) - len(refined_names))
+
+        yield {"type": "stage", "content": {
+            "stage": "refine",
+            "target_error": target_error,
+            "profilesets": len(refined_names)
+        }}
+        async for frame in self._stream_json(refine_input):
+            if frame["type"] == "report":
+                final = report_summary(frame["content"])
+            else:
+                yield frame
+        for profileset in final["profilesets"]:
+            profileset["refined"] = True
+        # Keep the coarse numbers of candidates that were ruled out
+        final["profilesets"] += [
+            {**profileset, "refined": False}
+            for profileset in coarse["profilesets"]
+            if profileset["name"] not in refined_names
+        ]
+        final["profilesets"].sort(key=lambda profileset: profileset["mean"], reverse=True)
+        yield {"type": "final", "content": final}
+
+    async def _stream_json(self, input_text: str) -> AsyncGenerator[dict, None]:
+        """Run `run_json`, yielding "stdout" frames of its progress lines and then a "report" frame"""
+        lines: asyncio.Queue = asyncio.Queue(maxsize=STREAM_BUFFER_LINES)
+
+        def on_progress(progress: float, line: str) -> None:
+            # Only the latest progress matters, older lines give way to it
+            if lines.full():
+                lines.get_nowait()
+            lines.put_nowait((progress, line))
+
+        def frame(batch: List[Tuple[float, str]]) -> dict:
+            return {"type": "stdout", "content": "\n".join(line for _, line in batch), "progress": batch[-1][0]}
+
+        run = asyncio.create_task(self.run_json(input_text, on_progress=on_progress))
+        try:
+            while not run.done():
+                next_line = asyncio.ensure_future(lines.get())
+                await asyncio.wait({run, next_line}, return_when=asyncio.FIRST_COMPLETED)
+                if not next_line.done():
+                    next_line.cancel()
+                    break
+                batch = [next_line.result()]
+                while not lines.empty():
+                    batch.append(lines.get_nowait())
+                yield frame(batch)
+            batch = [lines.get_nowait() for _ in range(lines.qsize())]
+            if batch:
+                yield frame(batch)
+            yield {"type": "report", "content": await run}
+        finally:
+            # Closing the stream early stops SimC
+            run.cancel()
 
     def _extract_progress(self, line: str) -> Optional[float]:
         """Extract progress from SimC output lines"""
-        # SimC often outputs progress like: "Generating baseline: 100%"
-        progress_patterns = [
-            r'(\d+)%',
-            r'Progress:\s*(\d+)',
-            r'Completed:\s*(\d+)/(\d+)'
-        ]
-        
-        for pattern in progress_patterns:
-            import re
-            match = re.search(pattern, line)
+        for pattern in PROGRESS_PATTERNS:
+            match = pattern.search(line)
             if match:
                 if len(match.groups()) == 2:  # For completed/total pattern
                     completed = int(match.group(1))
@@ -125,26 +776,27 @@ class SimcClient:
         return None
 
     @cache_simc_result
-    async def run_simulation(self, input: str):
-        """Existing method for backward compatibility"""
+    async def run_simulation(self, input: str, on_progress: Optional[Callable[[float, str], None]] = None):
+        """Existing method for backward compatibility, `on_progress` gets SimC's progress lines"""
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         unique_id = str(uuid.uuid4())[:8]
         filename = f"simc_{timestamp}_{unique_id}"
 
-        input_file = f"{self.inputs_dir}/{filename}.simc"
-        with open(input_file, "w") as f:
-            f.write(input)
-
         output_file = f"{self.simulations_dir}/{filename}.html"
-        command = [simc, input_file, f"html={output_file}"]
+        command = [simc]
+        process = None
 
         try:
-            process = await asyncio.create_subprocess_exec(
-                *command,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-            stdout, stderr = await process.communicate()
+            async with self._simc_input(input, filename) as (input_arg, input_options):
+                command = simc_command(input_arg, f"html={output_file}")
+                async with self.process_slots:
+                    process = await asyncio.create_subprocess_exec(
+                        *command,
+                        stdout=asyncio.subprocess.PIPE,
+                        stderr=asyncio.subprocess.PIPE,
+                        **input_options
+                    )
+                    stderr = await self._communicate(process, input, on_progress)
             
             if process.returncode != 0:
                 error_message = stderr.decode() if stderr else 'No error message provided'
@@ -162,15 +814,48 @@ class SimcClient:
                 f.write(f"Error: {self.output_filter.filter_text(str(e))}")
             raise e
         finally:
-            if os.path.exists(input_file):
-                os.remove(input_file)
+            if process is not None:
+                await self._terminate(process)
+
+    async def run_json(self, input_text: str, on_progress: Optional[Callable[[float, str], None]] = None) -> dict:
+        """Run a simulation and return SimC's JSON report as a dict, `on_progress` gets SimC's progress lines"""
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        unique_id = str(uuid.uuid4())[:8]
+        filename = f"simc_{timestamp}_{unique_id}"
+
+        json_file = f"{self.simulations_dir}/{filename}.json"
+        process = None
+
+        try:
+            async with self._simc_input(input_text, filename) as (input_arg, input_options):
+                async with self.process_slots:
+                    process = await asyncio.create_subprocess_exec(
+                        *simc_command(input_arg, f"json2={json_file}"),
+                        stdout=asyncio.subprocess.PIPE,
+                        stderr=asyncio.subprocess.PIPE,
+                        **input_options
+                    )
+                    stderr = await self._communicate(process, input_text, on_progress)
+
+            if process.returncode != 0:
+                error_message = stderr.decode() if stderr else 'No error message provided'
+                filtered_error = self.output_filter.filter_text(error_message)
+                raise Exception(f"SimC exited with code {process.returncode}: {filtered_error}")
+
+            async with aiofiles.open(json_file, mode='r', encoding='utf-8') as f:
+                return json.loads(await f.read())
+        finally:
+            if process is not None:
+                await self._terminate(process)
+            if os.path.exists(json_file):
+                os.remove(json_file)
 
 # Create a global instance
 simc_client = SimcClient()
 
-# Dependency injection function
-from fastapi import Request, WebSocket
+# Dependency injection function using global state
+from fastapi.requests import HTTPConnection
 
-async def get_simc_client(websocket: WebSocket):
-    # Initialize or return your simc client, possibly using info from the websocket
-    return SimcClient()
\ No newline at end of file
+async def get_simc_client(connection: HTTPConnection) -> SimcClient:
+    # Shared so process slots and in-flight runs are tracked across requests
+    return connection.app.state.simc_client
@@ -0,0 +1,87 @@
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+import dotenv
+
+from core.cache import create_simc_cache_key
+from core.profile import parse_profile
+from core.simc import profile_option, with_options
+
+dotenv.load_dotenv()
+
+# Rating added to the profile for each stat's delta run
+SIMC_STAT_WEIGHT_DELTA = int(os.getenv("SIMC_STAT_WEIGHT_DELTA", "1000"))
+
+SECONDARY_STATS = ("crit_rating", "haste_rating", "mastery_rating", "versatility_rating")
+PRIMARY_STATS = ("strength", "agility", "intellect")
+STATS = PRIMARY_STATS + SECONDARY_STATS
+
+# Specs using strength or agility by class, every other spec uses intellect
+STRENGTH_SPECS = {
+    "warrior": {"arms", "fury", "protection"},
+    "paladin": {"protection", "retribution"},
+    "death_knight": {"blood", "frost", "unholy"},
+    "deathknight": {"blood", "frost", "unholy"},
+}
+AGILITY_SPECS = {
+    "hunter": {"beast_mastery", "marksmanship", "survival"},
+    "rogue": {"assassination", "outlaw", "subtlety"},
+    "monk": {"brewmaster", "windwalker"},
+    "druid": {"feral", "guardian"},
+    "demon_hunter": {"havoc", "vengeance"},
+    "demonhunter": {"havoc", "vengeance"},
+    "shaman": {"enhancement"},
+}
+
+
+def primary_stat(input_text: str) -> str:
+    """Primary stat of the first character of a profile"""
+    scopes = parse_profile(input_text)
+    actor_class = scopes[1].header.split("=", 1)[0].lower()
+    spec = (profile_option(input_text, "spec") or "").lower()
+    if spec in STRENGTH_SPECS.get(actor_class, ()):
+        return "strength"
+    if spec in AGILITY_SPECS.get(actor_class, ()):
+        return "agility"
+    return "intellect"
+
+
+def stat_weight_inputs(input_text: str, stats: Optional[List[str]] = None) -> Tuple[str, Dict[str, str]]:
+    """Build the baseline profile and one profile per stat, raising ValueError on unknown stats.
+
+    Every run shares a seed derived from the profile, so the runs see the same
+    fights and repeat requests produce the same, cacheable, baseline.
+    """
+    if stats is None:
+        stats = [primary_stat(input_text), *SECONDARY_STATS]
+    if not stats:
+        raise ValueError("Choose at least one stat to weigh")
+    unknown = set(stats) - set(STATS)
+    if unknown:
+        raise ValueError(f"Unknown stats: {', '.join(sorted(unknown))}")
+
+    seed = int(create_simc_cache_key(input_text).split(":", 1)[1][:7], 16)
+    baseline = with_options(input_text, seed=seed)
+    return baseline, {
+        stat: with_options(baseline, **{f"enchant_{stat}": SIMC_STAT_WEIGHT_DELTA})
+        for stat in dict.fromkeys(stats)
+    }
+
+
+def stat_weights(baseline: Dict[str, float], runs: List[Dict[str, Any]], delta: int) -> Dict[str, Any]:
+    """DPS per point of each stat with its 95% error, normalized to the best stat"""
+    weights = [
+        {
+            "stat": run["stat"],
+            "weight": (run["mean"] - baseline["mean"]) / delta,
+            # Errors of independent runs add in quadrature, the shared seed
+            # correlates the runs so this errs on the safe side
+            "error": (run["error"] ** 2 + baseline["error"] ** 2) ** 0.5 / delta
+        }
+        for run in runs
+    ]
+    weights.sort(key=lambda weight: weight["weight"], reverse=True)
+    top = weights[0]["weight"] if weights else 0
+    for weight in weights:
+        weight["normalized"] = weight["weight"] / top if top > 0 else None
+    return {"baseline": baseline, "delta": delta, "weights": weights}
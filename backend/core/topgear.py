@@ -0,0 +1,291 @@
+import asyncio
+import itertools
+import os
+import re
+from dataclasses import dataclass
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import dotenv
+
+dotenv.load_dotenv()
+
+# Profilesets packed into a single SimC process
+TOPGEAR_CHUNK_SIZE = int(os.getenv("SIMC_TOPGEAR_CHUNK_SIZE", "250"))
+# Upper bound on combinations a single request may expand to
+TOPGEAR_MAX_COMBINATIONS = int(os.getenv("SIMC_TOPGEAR_MAX_COMBINATIONS", "5000"))
+
+GEAR_SLOTS = (
+    "head", "neck", "shoulder", "back", "chest", "wrist", "hands", "waist",
+    "legs", "feet", "finger1", "finger2", "trinket1", "trinket2",
+    "main_hand", "off_hand",
+)
+
+# Slots that share one pool of items, the same item cannot fill both
+PAIRED_SLOTS = (("finger1", "finger2"), ("trinket1", "trinket2"))
+
+# Equipment lines like: head=,id=231824,gem_id=213743,bonus_id=...
+EQUIPMENT_LINE = re.compile(rf"^({'|'.join(GEAR_SLOTS)})=([^,]*),(.+)$")
+
+
+@dataclass(frozen=True)
+class GearItem:
+    """An item that can be placed in a gear slot"""
+    id: int
+    enchant_id: Optional[int] = None
+    gem_id: Tuple[int, ...] = ()
+    bonus_id: Tuple[int, ...] = ()
+    crafted_stats: Tuple[int, ...] = ()
+    item_level: Optional[int] = None
+    name: str = ""
+    unique_equipped: bool = False
+    unique_equipped_category: Optional[str] = None
+    unique_equipped_limit: int = 1
+    two_hand: bool = False
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "GearItem":
+        """Build an item from request data, raising ValueError if it is malformed"""
+        try:
+            return cls(
+                id=int(data["id"]),
+                enchant_id=int(data["enchant_id"]) if data.get("enchant_id") else None,
+                gem_id=tuple(int(gem) for gem in data.get("gem_id") or ()),
+                bonus_id=tuple(int(bonus) for bonus in data.get("bonus_id") or ()),
+                crafted_stats=tuple(int(stat) for stat in data.get("crafted_stats") or ()),
+                item_level=int(data["item_level"]) if data.get("item_level") else None,
+                name=str(data.get("name") or ""),
+                unique_equipped=bool(data.get("unique_equipped")),
+                unique_equipped_category=data.get("unique_equipped_category"),
+                unique_equipped_limit=int(data.get("unique_equipped_limit") or 1),
+                two_hand=bool(data.get("two_hand")),
+            )
+        except (KeyError, TypeError, ValueError) as e:
+            raise ValueError(f"Invalid item {data!r}: {e}")
+
+    @classmethod
+    def from_simc(cls, options: str) -> "GearItem":
+        """Parse the options of a SimC equipment line, e.g. `id=1,bonus_id=2/3`"""
+        values = dict(part.split("=", 1) for part in options.split(",") if "=" in part)
+        ids = lambda key: tuple(int(v) for v in values[key].split("/") if v) if values.get(key) else ()
+        return cls(
+            id=int(values.get("id", 0)),
+            enchant_id=int(values["enchant_id"]) if values.get("enchant_id") else None,
+            gem_id=ids("gem_id"),
+            bonus_id=ids("bonus_id"),
+            crafted_stats=ids("crafted_stats"),
+        )
+
+    @property
+    def signature(self) -> tuple:
+        """What SimC sees of the item, request-only details like the name are ignored"""
+        return (self.id, self.enchant_id, self.gem_id, self.bonus_id, self.crafted_stats)
+
+    def dominates(self, other: "GearItem") -> bool:
+        """True if this is the same item as `other`, equally enchanted and gemmed,
+        at a strictly higher item level"""
+        return (
+            (self.id, self.enchant_id, self.gem_id, self.crafted_stats)
+            == (other.id, other.enchant_id, other.gem_id, other.crafted_stats)
+            and self.item_level is not None
+            and other.item_level is not None
+            and self.item_level > other.item_level
+        )
+
+    def to_simc(self, slot: str) -> str:
+        """Format the item as a SimC equipment line for `slot`"""
+        line = f"{slot}=,id={self.id}"
+        if self.enchant_id:
+            line += f",enchant_id={self.enchant_id}"
+        if self.gem_id:
+            line += f",gem_id={'/'.join(map(str, self.gem_id))}"
+        if self.bonus_id:
+            line += f",bonus_id={'/'.join(map(str, self.bonus_id))}"
+        if self.crafted_stats:
+            line += f",crafted_stats={'/'.join(map(str, self.crafted_stats))}"
+        return line
+
+    def describe(self) -> Dict[str, Any]:
+        return {"id": self.id, "name": self.name, "item_level": self.item_level}
+
+
+def parse_equipped(profile: str) -> Dict[str, GearItem]:
+    """Return the items equipped in a SimC profile by slot"""
+    equipped = {}
+    for line in profile.splitlines():
+        match = EQUIPMENT_LINE.match(line.strip())
+        if match:
+            equipped[match.group(1)] = GearItem.from_simc(match.group(3))
+    return equipped
+
+
+def same_item(a: Optional[GearItem], b: Optional[GearItem]) -> bool:
+    if a is None or b is None:
+        return a is b
+    return a.signature == b.signature
+
+
+def prune_dominated(items: List[GearItem]) -> List[GearItem]:
+    """Drop duplicates and items dominated by a higher item level copy"""
+    # Later duplicates win, request items carry more detail than parsed ones
+    unique = list({item.signature: item for item in items}.values())
+    return [item for item in unique if not any(other.dominates(item) for other in unique)]
+
+
+def violates_unique_constraints(combination: Dict[str, Optional[GearItem]]) -> bool:
+    """Check unique-equipped items and unique-equipped categories"""
+    unique_ids = set()
+    category_count: Dict[str, int] = {}
+    items = [item for item in combination.values() if item is not None]
+    all_ids = [item.id for item in items]
+
+    for item in items:
+        if item.unique_equipped:
+            if item.id in unique_ids or all_ids.count(item.id) > 1:
+                return True
+            unique_ids.add(item.id)
+        if item.unique_equipped_category:
+            category = item.unique_equipped_category
+            category_count[category] = category_count.get(category, 0) + 1
+            if category_count[category] > item.unique_equipped_limit:
+                return True
+    return False
+
+
+def _slot_options(
+    equipped: Dict[str, GearItem],
+    candidates: Dict[str, List[GearItem]]
+) -> List[List[Dict[str, Optional[GearItem]]]]:
+    """Build the per slot group choices, each choice maps slots to items"""
+    groups = []
+    paired = {slot for pair in PAIRED_SLOTS for slot in pair}
+
+    for first, second in PAIRED_SLOTS:
+        pool = candidates.get(first, []) + candidates.get(second, [])
+        if not pool:
+            continue
+        base = [equipped[slot] for slot in (first, second) if slot in equipped]
+        pool = prune_dominated(base + pool)
+        if len(pool) < 2:
+            # No other pair to try, e.g. the only candidate is the equipped
+            # item, the slots keep what they have
+            continue
+        choices = []
+        for a, b in itertools.combinations(pool, 2):
+            # Keep equipped items in their current slot so unchanged slots stay unlisted
+            if same_item(a, equipped.get(second)) or same_item(b, equipped.get(first)):
+                a, b = b, a
+            choices.append({first: a, second: b})
+        groups.append(choices)
+
+    for slot in GEAR_SLOTS:
+        if slot in paired or not candidates.get(slot):
+            continue
+        base = [equipped[slot]] if slot in equipped else []
+        groups.append([{slot: item} for item in prune_dominated(base + candidates[slot])])
+
+    return groups
+
+
+def enumerate_combinations(
+    equipped: Dict[str, GearItem],
+    candidates: Dict[str, List[GearItem]]
+) -> Iterator[Dict[str, Optional[GearItem]]]:
+    """Yield every valid combination that differs from the equipped gear.
+
+    Each combination only lists the slots it changes; a two-handed main hand
+    empties the off hand slot.
+    """
+    for choice in itertools.product(*_slot_options(equipped, candidates)):
+        combination: Dict[str, Optional[GearItem]] = {}
+        for part in choice:
+            combination.update(part)
+
+        main_hand = combination.get("main_hand", equipped.get("main_hand"))
+        if main_hand is not None and main_hand.two_hand:
+            # A two-handed weapon leaves no room for a different off hand
+            off_hand = combination.get("off_hand")
+            if off_hand is not None and not same_item(off_hand, equipped.get("off_hand")):
+                continue
+            if "off_hand" in equipped:
+                combination["off_hand"] = None
+
+        changes = {
+            slot: item for slot, item in combination.items()
+            if not same_item(equipped.get(slot), item)
+        }
+        if not changes:
+            continue
+        if violates_unique_constraints({**equipped, **combination}):
+            continue
+        yield changes
+
+
+def build_combinations(profile: str, candidates: Dict[str, List[Dict[str, Any]]]) -> List[Dict[str, Optional[GearItem]]]:
+    """Validate request candidates and expand them, raising ValueError on bad input"""
+    unknown = set(candidates) - set(GEAR_SLOTS)
+    if unknown:
+        raise ValueError(f"Unknown gear slots: {', '.join(sorted(unknown))}")
+
+    items = {slot: [GearItem.from_dict(item) for item in slot_items] for slot, slot_items in candidates.items()}
+    combinations = []
+    for combination in enumerate_combinations(parse_equipped(profile), items):
+        combinations.append(combination)
+        if len(combinations) > TOPGEAR_MAX_COMBINATIONS:
+            raise ValueError(f"More than {TOPGEAR_MAX_COMBINATIONS} gear combinations, select fewer items")
+    return combinations
+
+
+def build_profilesets(profile: str, combinations: List[Tuple[str, Dict[str, Optional[GearItem]]]]) -> str:
+    """Append one profileset per named combination to the base profile"""
+    lines = [profile.rstrip(), ""]
+    for name, combination in combinations:
+        for slot, item in combination.items():
+            line = item.to_simc(slot) if item is not None else f"{slot}="
+            lines.append(f'profileset."{name}"+={line}')
+    return "\n".join(lines) + "\n"
+
+
+def _summary(name: str, mean: float, mean_stddev: float) -> Dict[str, Any]:
+    return {"name": name, "mean": mean, "error": 1.96 * mean_stddev}
+
+
+async def run_top_gear(simc_client, profile: str, candidates: Dict[str, List[Dict[str, Any]]]) -> Dict[str, Any]:
+    """Rank every gear combination, packing them into profileset chunks run in parallel"""
+    combinations = build_combinations(profile, candidates)
+    named = [(f"Combo {index + 1}", combination) for index, combination in enumerate(combinations)]
+    chunks = [named[i:i + TOPGEAR_CHUNK_SIZE] for i in range(0, len(named), TOPGEAR_CHUNK_SIZE)] or [[]]
+
+    reports = await asyncio.gather(*(
+        simc_client.run_json(build_profilesets(profile, chunk)) for chunk in chunks
+    ))
+
+    # Every chunk also simulates the equipped gear, pool those baselines
+    baselines = [report["sim"]["players"][0]["collected_data"]["dps"] for report in reports]
+    baseline = _summary(
+        "Equipped",
+        sum(b["mean"] for b in baselines) / len(baselines),
+        (sum(b.get("mean_std_dev", 0) ** 2 for b in baselines) ** 0.5) / len(baselines)
+    )
+
+    by_name = dict(named)
+    results = [{**baseline, "items": {}}]
+    for report in reports:
+        for result in report["sim"].get("profilesets", {}).get("results", []):
+            summary = _summary(result["name"], result["mean"], result.get("mean_stddev", 0))
+            summary["items"] = {
+                slot: item.describe() if item is not None else None
+                for slot, item in by_name[result["name"]].items()
+            }
+            results.append(summary)
+
+    results.sort(key=lambda result: result["mean"], reverse=True)
+    for rank, result in enumerate(results, start=1):
+        result["rank"] = rank
+        result["delta"] = result["mean"] - baseline["mean"]
+
+    return {
+        "combinations": len(combinations),
+        "chunks": len(chunks),
+        "baseline": baseline,
+        "results": results
+    }
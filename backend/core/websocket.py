@@ -1,7 +1,20 @@
-from typing import Dict, Any
-from fastapi import WebSocket
+from collections import deque
+from typing import Deque, Dict, Any, Hashable, List, Optional, Set, Union
+from fastapi import WebSocket, status
+from redis import RedisError
 from uuid import uuid4
+import asyncio
+import json
 import logging
+import os
+import time
+
+import dotenv
+
+from core.backplane import WS_REGISTRY_TTL, RedisBackplane
+from core.metrics import metrics
+
+dotenv.load_dotenv()
 
 # Configure logging
 logging.basicConfig(
@@ -11,12 +24,202 @@ logging.basicConfig(
 
 ws_logger = logging.getLogger('websocket')
 
+# Messages waiting to be written to one client
+WS_SEND_QUEUE_SIZE = int(os.getenv("WS_SEND_QUEUE_SIZE", "256"))
+# Seconds a client may fall behind its messages before it is disconnected
+WS_MAX_LAG = float(os.getenv("WS_MAX_LAG", "10"))
+# Seconds a broadcast waits for each client before dropping it
+WS_BROADCAST_TIMEOUT = float(os.getenv("WS_BROADCAST_TIMEOUT", "5"))
+# Seconds between pings to every client, answered with {"type": "pong"}
+WS_HEARTBEAT_INTERVAL = float(os.getenv("WS_HEARTBEAT_INTERVAL", "20"))
+# Seconds without any message from a client before it is disconnected
+WS_HEARTBEAT_TIMEOUT = float(os.getenv("WS_HEARTBEAT_TIMEOUT", "60"))
+# Message types only the latest of is worth sending, per job. Progress
+# without a job_id is a line of streamed output, every one of them is sent
+COALESCED_TYPES = {"progress", "ping"}
+
+
+def coalesce_key(message: Union[Dict[str, Any], str]) -> Optional[Hashable]:
+    """Key a message replaces waiting messages under, None if it never does"""
+    if not isinstance(message, dict) or message.get("type") not in COALESCED_TYPES:
+        return None
+    if message["type"] == "progress" and "job_id" not in message:
+        return None
+    return (message["type"], message.get("job_id"))
+
+
+def _resolve(sent: Optional[asyncio.Future], result: bool) -> None:
+    if sent is not None and not sent.done():
+        sent.set_result(result)
+
+
+class ClientConnection:
+    """A client's socket and the messages waiting to be written to it.
+
+    Messages are queued as [message, queued_at, key, sent] entries, messages
+    already serialized are queued as text and `sent` is an optional future
+    resolved once the message is written or the client is gone. A coalesced
+    message replaces the one of the same type and job still waiting, which
+    keeps its queue time so a client that only ever gets progress still
+    shows its lag.
+    """
+
+    def __init__(self, websocket: WebSocket):
+        self.websocket = websocket
+        self.connected_at = self.last_seen = time.monotonic()
+        self.entries: Deque[List[Any]] = deque()
+        self.pending: Dict[Hashable, List[Any]] = {}
+        self.size = 0
+        self.ready = asyncio.Event()
+        self.closing = False
+        self.writer: Optional[asyncio.Task] = None
+
+    def put(self, message: Union[Dict[str, Any], str], sent: Optional[asyncio.Future] = None) -> bool:
+        """Queue a message, returns False if the queue is full and it cannot be dropped"""
+        now = time.monotonic()
+        key = coalesce_key(message)
+        if key is not None:
+            replaced = self.pending.pop(key, None)
+            if replaced is not None:
+                now = replaced[1]
+                replaced[0] = None
+                self.size -= 1
+                # The message replacing it carries what the client needs
+                _resolve(replaced[3], True)
+                metrics.incr("websocket_messages_coalesced")
+        if self.size >= WS_SEND_QUEUE_SIZE:
+            if key is not None:
+                metrics.incr("websocket_messages_dropped")
+                _resolve(sent, False)
+                return True
+            return False
+        entry = [message, now, key, sent]
+        self.entries.append(entry)
+        self.size += 1
+        if key is not None:
+            self.pending[key] = entry
+        self.ready.set()
+        return True
+
+    def _drop_replaced(self) -> None:
+        while self.entries and self.entries[0][0] is None:
+            self.entries.popleft()
+
+    def lag(self) -> float:
+        """Seconds the oldest waiting message has waited"""
+        self._drop_replaced()
+        return time.monotonic() - self.entries[0][1] if self.entries else 0.0
+
+    async def get(self) -> Optional[List[Any]]:
+        """Next entry to write, None once closing and every message is written"""
+        while True:
+            self._drop_replaced()
+            if self.entries:
+                entry = self.entries.popleft()
+                self.size -= 1
+                if entry[2] is not None and self.pending.get(entry[2]) is entry:
+                    del self.pending[entry[2]]
+                return entry
+            if self.closing:
+                return None
+            self.ready.clear()
+            await self.ready.wait()
+
+    def abandon(self) -> None:
+        """Resolve the futures of messages that will never be written"""
+        for entry in self.entries:
+            _resolve(entry[3], False)
+
+
 class WebSocketManager:
-    """Singleton manager for WebSocket connections with lifecycle management"""
+    """Singleton manager for WebSocket connections with lifecycle management.
+
+    Every connection has a writer task draining a bounded queue, so sending
+    never waits on the network. Clients that fall WS_MAX_LAG behind, or
+    whose queue fills up with messages that cannot be dropped, are
+    disconnected. Clients are pinged every WS_HEARTBEAT_INTERVAL and reaped
+    once nothing has been heard from them for WS_HEARTBEAT_TIMEOUT; routes
+    call touch() for every message they receive.
+
+    With a `backplane`, messages for clients of other API processes and
+    broadcasts are routed through it, clients of this process are still
+    sent to directly.
+    """
 
-    def __init__(self):
+    def __init__(self, backplane: Optional[RedisBackplane] = None):
         self.active_connections: Dict[str, WebSocket] = {}
+        self.connections: Dict[str, ClientConnection] = {}
         self.logger = ws_logger
+        self.backplane = backplane
+        self._tasks: Set[asyncio.Task] = set()
+        # Connections closed so far and how long they were open in total
+        self._closed = 0
+        self._lifetime_total = 0.0
+
+    def _spawn(self, coro) -> None:
+        """Run a coroutine in the background, keeping a reference until it finishes"""
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def start(self) -> None:
+        """Start the heartbeats, and listening to the backplane and keeping this process's clients registered"""
+        self._spawn(self._heartbeat())
+        if self.backplane is None:
+            return
+        self._spawn(self._listen())
+        self._spawn(self._refresh_registry())
+        self.logger.info(f"Websocket backplane started for node {self.backplane.node_id}")
+
+    async def stop(self) -> None:
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        if self.backplane is not None:
+            await self.backplane.close()
+
+    async def _heartbeat(self) -> None:
+        """Ping every client and disconnect those not heard from within WS_HEARTBEAT_TIMEOUT"""
+        while True:
+            await asyncio.sleep(WS_HEARTBEAT_INTERVAL)
+            now = time.monotonic()
+            for client_id, connection in list(self.connections.items()):
+                if now - connection.last_seen > WS_HEARTBEAT_TIMEOUT:
+                    self.logger.warning(f"Reaping client {client_id}, silent for {now - connection.last_seen:.0f}s")
+                    metrics.incr("websocket_connections_reaped")
+                    self.disconnect(client_id)
+                    self._spawn(self._close_socket(connection.websocket, status.WS_1001_GOING_AWAY))
+                else:
+                    self._send_local(client_id, {"type": "ping"})
+
+    def touch(self, client_id: str) -> None:
+        """Note that a client sent something, keeping it from being reaped"""
+        connection = self.connections.get(client_id)
+        if connection is not None:
+            connection.last_seen = time.monotonic()
+
+    async def _listen(self) -> None:
+        while True:
+            try:
+                await self.backplane.listen(self._send_local, self._deliver_broadcast)
+            except RedisError as e:
+                self.logger.error(f"Websocket backplane listener failed, retrying: {e}")
+                await asyncio.sleep(1)
+
+    async def _refresh_registry(self) -> None:
+        while True:
+            await asyncio.sleep(WS_REGISTRY_TTL / 3)
+            try:
+                await self.backplane.register(list(self.connections))
+            except RedisError as e:
+                self.logger.warning(f"Could not refresh websocket registry: {e}")
+
+    async def _unregister(self, client_id: str) -> None:
+        try:
+            await self.backplane.unregister(client_id)
+        except RedisError as e:
+            # The entry expires on its own
+            self.logger.warning(f"Could not unregister client {client_id}: {e}")
 
     async def connect(self, websocket: WebSocket) -> str:
         """Accept websocket connection and return a unique client_id"""
@@ -24,44 +227,161 @@ class WebSocketManager:
             self.logger.info("Accepting websocket connection")
             await websocket.accept()
             client_id = str(uuid4())
+            connection = ClientConnection(websocket)
+            connection.writer = asyncio.create_task(self._write(client_id, connection))
             self.active_connections[client_id] = websocket
+            self.connections[client_id] = connection
+            if self.backplane is not None:
+                try:
+                    await self.backplane.register([client_id])
+                except RedisError as e:
+                    self.logger.warning(f"Could not register client {client_id}: {e}")
+            metrics.incr("websocket_connections_opened")
+            metrics.gauge("websocket_connections_open", len(self.connections))
             self.logger.info(f"Client {client_id} connected. Total connections: {len(self.active_connections)}")
             return client_id
         except Exception as e:
             self.logger.error(f"Error accepting connection: {e}")
             raise
 
+    async def _write(self, client_id: str, connection: ClientConnection) -> None:
+        """Write a client's queued messages until it closes or a send fails"""
+        while True:
+            entry = await connection.get()
+            if entry is None:
+                return
+            message, _, _, sent = entry
+            try:
+                if isinstance(message, str):
+                    send = connection.websocket.send_text(message)
+                else:
+                    send = connection.websocket.send_json(message)
+                await asyncio.wait_for(send, timeout=WS_MAX_LAG)
+            except asyncio.TimeoutError:
+                self._drop_slow_client(client_id, f"a send took over {WS_MAX_LAG:g}s")
+            except Exception as e:
+                self.logger.error(f"Error sending message to {client_id}: {e}")
+                self.disconnect(client_id)
+            finally:
+                _resolve(sent, self.is_connected(client_id))
+            if not self.is_connected(client_id):
+                return
+
+    def _drop_slow_client(self, client_id: str, reason: str) -> None:
+        connection = self.connections.get(client_id)
+        if connection is None:
+            return
+        self.logger.warning(f"Disconnecting slow client {client_id}: {reason}")
+        metrics.incr("websocket_slow_clients_disconnected")
+        self.disconnect(client_id)
+        # Closing may itself wait on the stalled socket, do not hold up the caller
+        self._spawn(self._close_socket(connection.websocket, status.WS_1013_TRY_AGAIN_LATER))
+
+    async def _close_socket(self, websocket: WebSocket, code: int) -> None:
+        try:
+            await asyncio.wait_for(websocket.close(code=code), timeout=WS_MAX_LAG)
+        except Exception:
+            pass  # Already closed or gone
+
     def disconnect(self, client_id: str) -> None:
-        """Remove a client from active connections"""
+        """Remove a client from active connections, dropping messages not yet written"""
         websocket = self.active_connections.pop(client_id, None)
+        connection = self.connections.pop(client_id, None)
+        if connection is not None:
+            connection.abandon()
+            if connection.writer is not asyncio.current_task():
+                connection.writer.cancel()
+            if self.backplane is not None:
+                self._spawn(self._unregister(client_id))
+            self._closed += 1
+            self._lifetime_total += time.monotonic() - connection.connected_at
+            metrics.incr("websocket_connections_closed")
+            metrics.gauge("websocket_connections_open", len(self.connections))
+            metrics.gauge("websocket_connection_lifetime_avg_seconds", self._lifetime_total / self._closed)
         if websocket:
             self.logger.info(f"Client {client_id} disconnected. Total connections: {len(self.active_connections)}")
 
+    async def close(self, client_id: str) -> None:
+        """Write a client's queued messages, waiting at most WS_MAX_LAG, then remove it"""
+        connection = self.connections.get(client_id)
+        if connection is not None:
+            connection.closing = True
+            connection.ready.set()
+            await asyncio.wait({connection.writer}, timeout=WS_MAX_LAG)
+        self.disconnect(client_id)
+
     async def send_message(self, client_id: str, message: Dict[str, Any]) -> bool:
-        """Send a message to a specific client"""
-        websocket = self.active_connections.get(client_id)
-        if websocket:
-            try:
-                await websocket.send_json(message)
-                return True
-            except Exception as e:
-                self.logger.error(f"Error sending message to {client_id}: {e}")
-                self.disconnect(client_id)
-        return False
+        """Queue a message for a specific client, returns False if it is not connected.
 
-    async def broadcast(self, message: Dict[str, Any]) -> None:
-        """Broadcast message to all connected clients"""
-        disconnected_clients = []
-        for client_id, websocket in list(self.active_connections.items()):
+        Never waits for the client, its writer task sends the message. A
+        client of another process is sent the message through the backplane.
+        """
+        if client_id in self.connections:
+            return self._send_local(client_id, message)
+        if self.backplane is None:
+            return False
+        try:
+            return await self.backplane.send(client_id, message)
+        except RedisError as e:
+            self.logger.error(f"Error routing message to {client_id}: {e}")
+            return False
+
+    def _send_local(self, client_id: str, message: Dict[str, Any]) -> bool:
+        connection = self.connections.get(client_id)
+        if connection is None:
+            return False
+        if connection.lag() > WS_MAX_LAG:
+            self._drop_slow_client(client_id, f"over {WS_MAX_LAG:g}s behind")
+            return False
+        if not connection.put(message):
+            self._drop_slow_client(client_id, f"{WS_SEND_QUEUE_SIZE} messages waiting")
+            return False
+        return True
+
+    async def broadcast(self, message: Dict[str, Any]) -> int:
+        """Send a message to every connected client at once, returns how many of this process's it reached.
+
+        The message is serialized once and queued to every client's writer,
+        clients that have not been sent it within WS_BROADCAST_TIMEOUT are
+        disconnected together. Other processes are reached through the backplane.
+        """
+        text = json.dumps(message)
+        if self.backplane is not None:
             try:
-                await websocket.send_json(message)
-            except Exception as e:
-                self.logger.error(f"Error broadcasting to client {client_id}: {e}")
-                disconnected_clients.append(client_id)
+                await self.backplane.broadcast(text)
+            except RedisError as e:
+                self.logger.error(f"Error routing broadcast to other processes: {e}")
+        return await self._broadcast_local(text)
+
+    def _deliver_broadcast(self, text: str) -> None:
+        # Waiting on this process's clients must not hold up the backplane listener
+        self._spawn(self._broadcast_local(text))
+
+    async def _broadcast_local(self, text: str) -> int:
+        start = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        sends = {}
+        for client_id, connection in list(self.connections.items()):
+            sent = loop.create_future()
+            if connection.put(text, sent):
+                sends[sent] = client_id
+            else:
+                self._drop_slow_client(client_id, f"{WS_SEND_QUEUE_SIZE} messages waiting")
+        if sends:
+            await asyncio.wait(sends, timeout=WS_BROADCAST_TIMEOUT)
 
-        # Clean up disconnected clients
-        for client_id in disconnected_clients:
-            self.disconnect(client_id)
+        stalled = [client_id for sent, client_id in sends.items() if not sent.done()]
+        for client_id in stalled:
+            self._drop_slow_client(client_id, f"broadcast not sent within {WS_BROADCAST_TIMEOUT:g}s")
+        reached = sum(1 for sent in sends if sent.done() and sent.result())
+        elapsed = time.perf_counter() - start
+        metrics.incr("websocket_broadcasts")
+        metrics.gauge("websocket_broadcast_fanout_seconds", elapsed)
+        self.logger.info(
+            f"Broadcast reached {reached} of {len(sends)} clients in {elapsed * 1000:.1f} ms, "
+            f"dropped {len(stalled)} stalled clients"
+        )
+        return reached
 
     def get_connection_count(self) -> int:
         """Return number of active connections"""
@@ -3,8 +3,18 @@ import time
 import json
 import asyncio
 import logging
+import os
+import signal
 from datetime import datetime
-from core.simc import SimcClient
+from core.simc import SIMC_THREADS, SimcClient, report_summary
+from core.topgear import run_top_gear
+from core.sharding import merge_shards, shard_summary
+from core.statweights import stat_weights
+from core.cache import cache_simc_summary
+from core.queue import JOB_TTL, WORKER_TTL, JobQueue
+from core.queuestats import QueueStats
+from core.estimator import RuntimeEstimator
+from core.jobevents import job_channel, job_event, progress_publisher
 from base64 import b64decode
 import inspect
 
@@ -12,70 +22,343 @@ import inspect
 logging.basicConfig(level=logging.INFO, format='[Worker] %(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Jobs run at once, by default as many as fit the cores at SIMC_THREADS each
+WORKER_CONCURRENCY = int(os.getenv(
+    "SIMC_WORKER_CONCURRENCY",
+    str(max(1, (os.cpu_count() or 1) // SIMC_THREADS) if SIMC_THREADS else 1)
+))
+
 r = redis.Redis(host='localhost', port=6379, db=0)
+job_queue = JobQueue(r)
+queue_stats = QueueStats(r)
+runtime_estimator = RuntimeEstimator(r)
 simc_client = SimcClient()
 
-async def process_job(job_id):
-    """Process a single simulation job asynchronously"""
+# Job hash fields the handlers read, claiming a job fetches only these
+JOB_FIELDS = (
+    "id", "type", "input", "input_ref", "coalesce_key", "started_at", "features", "parent_id",
+    "index", "children", "stat", "character", "candidates"
+)
+
+async def run_simulation_job(job_data, decoded_input):
+    """Run a single profile and store the path of its HTML report"""
+    # IMPORTANT: Explicitly handle coroutine
+    logger.info("Calling run_simulation...")
+    result_or_coro = simc_client.run_simulation(decoded_input, on_progress=progress_publisher(r, job_data["id"]))
+    logger.info(f"Result type: {type(result_or_coro)}")
+    
+    # If it's a coroutine, await it
+    if asyncio.iscoroutine(result_or_coro):
+        logger.info("Result is a coroutine, awaiting it...")
+        output_file = await result_or_coro
+    else:
+        logger.info("Result is not a coroutine")
+        output_file = result_or_coro
+    
+    logger.info(f"Simulation completed for job {job_data['id']}: {output_file}")
+    return {"result_path": output_file}
+
+async def run_topgear_job(job_data, decoded_input):
+    """Rank gear combinations and store the ranking as JSON"""
+    result = await run_top_gear(simc_client, decoded_input, json.loads(job_data["candidates"]))
+    logger.info(f"Top gear completed for job {job_data['id']}: {result['combinations']} combinations in {result['chunks']} chunks")
+    return {"result": json.dumps(result)}
+
+def start_parent_job(job_data):
+    """Mark the parent of a child job as processing when its first child starts"""
+    parent_id = job_data["parent_id"]
+    if r.hsetnx(f"job:{parent_id}", "started_at", datetime.now().isoformat()):
+        set_job_state(parent_id, {"status": "PROCESSING"}, job_event(parent_id, "status", status="PROCESSING"))
+
+def set_job_state(job_id, fields, event, expire=False):
+    """Store a job's fields and publish its event in one round trip"""
+    pipe = r.pipeline(transaction=True)
+    pipe.hset(f"job:{job_id}", mapping=fields)
+    if expire and JOB_TTL:
+        pipe.expire(f"job:{job_id}", JOB_TTL)
+    pipe.publish(job_channel(job_id), event)
+    pipe.execute()
+
+def complete_child_job(job_data, result):
+    """Store a child job's result and count it on its parent, True for the last child"""
+    # The result is stored before the child is counted, so the last child sees every result
+    return job_queue.complete_child(job_data["id"], job_data["parent_id"], int(job_data["children"]), result)
+
+def child_results(job_id, children):
+    pipe = r.pipeline(transaction=False)
+    for index in range(children):
+        pipe.hget(f"job:{job_id}:{index}", "result")
+    return [json.loads(result) for result in pipe.execute()]
+
+def finish_parent_job(job_id, result):
+    """Record the combined result of a parent job"""
+    started_at = datetime.fromisoformat(r.hget(f"job:{job_id}", "started_at").decode())
+    set_job_state(job_id, {
+        "status": "COMPLETED",
+        "completed_at": datetime.now().isoformat(),
+        "result": json.dumps(result),
+        "duration": str((datetime.now() - started_at).total_seconds())
+    }, job_event(job_id, "status", status="COMPLETED"), expire=True)
+
+def fail_parent_job(parent_id, error):
+    """Fail a parent job when one of its children fails"""
+    set_job_state(
+        parent_id,
+        {"status": "FAILED", "error": error},
+        job_event(parent_id, "status", status="FAILED", error=error),
+        expire=True
+    )
+
+async def run_shard_job(job_data, decoded_input):
+    """Run one shard of a sharded job, the last shard to finish merges them all"""
+    parent_key = f"job:{job_data['parent_id']}"
+    if r.hget(parent_key, "status") == b"FAILED":
+        raise Exception("Another shard of this job failed")
+    start_parent_job(job_data)
+
+    try:
+        summary = json.dumps(shard_summary(
+            await simc_client.run_json(decoded_input, on_progress=progress_publisher(r, job_data["id"]))
+        ))
+    except Exception as e:
+        fail_parent_job(job_data["parent_id"], f"Shard {job_data['index']} failed: {e}")
+        raise
+
+    if complete_child_job(job_data, summary):
+        shards = int(job_data["children"])
+        result = merge_shards(child_results(job_data["parent_id"], shards))
+        finish_parent_job(job_data["parent_id"], result)
+        logger.info(f"Sharded job {job_data['parent_id']} completed: {result['iterations']} iterations over {shards} shards")
+    return {"result": summary}
+
+def batch_summary(rows, skipped):
+    """Per character table and raid total of a roster batch"""
+    simulated = sorted((row for row in rows if "dps" in row), key=lambda row: row["dps"], reverse=True)
+    return {
+        "characters": simulated,
+        "failed": [row for row in rows if "failed" in row],
+        "skipped": skipped,
+        "raid_dps": sum(row["dps"] for row in simulated),
+        # Characters are simulated independently, so their errors add in quadrature
+        "raid_error": sum(row["error"] ** 2 for row in simulated) ** 0.5
+    }
+
+async def run_batch_member_job(job_data, decoded_input):
+    """Simulate one character of a roster batch, the last one builds the summary table"""
+    start_parent_job(job_data)
+    row = json.loads(job_data["character"])
+    try:
+        player = report_summary(
+            await simc_client.run_json(decoded_input, on_progress=progress_publisher(r, job_data["id"]))
+        )["players"][0]
+        row.update(dps=player["mean"], error=player["error"])
+    except Exception as e:
+        row["failed"] = str(e)
+        raise
+    finally:
+        # A failed character still counts, the rest of the raid is reported
+        if complete_child_job(job_data, json.dumps(row)):
+            parent_id = job_data["parent_id"]
+            skipped = json.loads(r.hget(f"job:{parent_id}", "skipped") or b"[]")
+            result = batch_summary(child_results(parent_id, int(job_data["children"])), skipped)
+            finish_parent_job(parent_id, result)
+            logger.info(f"Roster batch {parent_id} completed: {len(result['characters'])} characters")
+    return {"result": json.dumps(row)}
+
+async def run_stat_weight_job(job_data, decoded_input):
+    """Run the baseline or one stat's delta of a stat weight job, the last run computes the weights"""
+    parent_key = f"job:{job_data['parent_id']}"
+    if r.hget(parent_key, "status") == b"FAILED":
+        raise Exception("Another run of this job failed")
+    start_parent_job(job_data)
+
+    try:
+        player = report_summary(
+            await simc_client.run_json(decoded_input, on_progress=progress_publisher(r, job_data["id"]))
+        )["players"][0]
+    except Exception as e:
+        fail_parent_job(job_data["parent_id"], f"{job_data['stat']} run failed: {e}")
+        raise
+
+    run = {"stat": job_data["stat"], "mean": player["mean"], "error": player["error"]}
+    if job_data["stat"] == "baseline":
+        cache_simc_summary(decoded_input, run)
+
+    if complete_child_job(job_data, json.dumps(run)):
+        parent_id = job_data["parent_id"]
+        runs = child_results(parent_id, int(job_data["children"]))
+        cached = r.hget(parent_key, "baseline")
+        baseline = json.loads(cached) if cached else next(run for run in runs if run["stat"] == "baseline")
+        result = stat_weights(
+            baseline,
+            [run for run in runs if run["stat"] != "baseline"],
+            int(r.hget(parent_key, "delta"))
+        )
+        finish_parent_job(parent_id, result)
+        logger.info(f"Stat weight job {parent_id} completed: {len(result['weights'])} stats")
+    return {"result": json.dumps(run)}
+
+# Job types and the handlers that run them, each returns the result fields to store
+JOB_HANDLERS = {
+    "simulation": run_simulation_job,
+    "topgear": run_topgear_job,
+    "shard": run_shard_job,
+    "batch_member": run_batch_member_job,
+    "stat_weight": run_stat_weight_job,
+}
+
+def release_job(job_id, job_data, fields):
+    """Drop a finished job's input and give its outcome `fields` to the jobs coalesced with it"""
+    if "input_ref" in job_data:
+        job_queue.payloads.release(job_data["input_ref"])
+    if "coalesce_key" in job_data:
+        followers = job_queue.finish_followers(job_id, job_data["coalesce_key"], fields)
+        if followers:
+            logger.info(f"Job {job_id} also finished {followers} coalesced jobs")
+
+async def process_job(job_id, job_data):
+    """Process a single claimed simulation job asynchronously"""
     logger.info(f"Starting processing of job: {job_id}")
-    r.hset(f"job:{job_id}", "status", "PROCESSING")
-    r.hset(f"job:{job_id}", "started_at", datetime.now().isoformat())
+    job_type = job_data.get("type", "simulation")
+    started_at = datetime.fromisoformat(job_data["started_at"])
+    # The job's outcome, set once it is recorded
+    fields = None
     
     try:
-        # Get job data
-        job_data = {k.decode(): v.decode() for k, v in r.hgetall(f"job:{job_id}").items()}
-        decoded_input = b64decode(job_data["input"]).decode("utf-8")
-        logger.info(f"Decoded input for job {job_id} (first 50 chars): {decoded_input[:50]}...")
-        
-        # IMPORTANT: Explicitly handle coroutine
-        logger.info("Calling run_simulation...")
-        result_or_coro = simc_client.run_simulation(decoded_input)
-        logger.info(f"Result type: {type(result_or_coro)}")
-        
-        # If it's a coroutine, await it
-        if asyncio.iscoroutine(result_or_coro):
-            logger.info("Result is a coroutine, awaiting it...")
-            output_file = await result_or_coro
+        if "input_ref" in job_data:
+            if "payload" not in job_data:
+                raise ValueError(f"Input {job_data['input_ref']} of the job has expired")
+            decoded_input = job_data["payload"]
         else:
-            logger.info("Result is not a coroutine")
-            output_file = result_or_coro
-        
-        logger.info(f"Simulation completed for job {job_id}: {output_file}")
-        
-        # Update job with result
-        r.hset(f"job:{job_id}", "status", "COMPLETED")
-        r.hset(f"job:{job_id}", "completed_at", datetime.now().isoformat())
-        r.hset(f"job:{job_id}", "result_path", output_file)
+            # Jobs queued before inputs were stored as payloads
+            decoded_input = b64decode(job_data["input"]).decode("utf-8")
+        logger.info(f"Decoded input for job {job_id} (first 50 chars): {decoded_input[:50]}...")
         
-        # Calculate duration
-        start = datetime.fromisoformat(job_data["started_at"])
-        end = datetime.fromisoformat(datetime.now().isoformat())
-        duration = (end - start).total_seconds()
-        r.hset(f"job:{job_id}", "duration", str(duration))
+        handler = JOB_HANDLERS.get(job_type)
+        if handler is None:
+            raise ValueError(f"Unknown job type: {job_type}")
+        result = await handler(job_data, decoded_input)
         
-        logger.info(f"Job {job_id} completed successfully in {duration:.2f} seconds")
+        # Store the result, count the job and publish its completion in one step
+        duration = (datetime.now() - started_at).total_seconds()
+        completed = {
+            "status": "COMPLETED",
+            "completed_at": datetime.now().isoformat(),
+            "duration": str(duration),
+            **result
+        }
+        queue_stats.record(
+            job_id, job_type, "COMPLETED", duration, fields=completed,
+            event=job_event(job_id, "status", status="COMPLETED", duration=duration)
+        )
+        fields = completed
         
     except Exception as e:
         logger.error(f"Error processing job {job_id}: {e}", exc_info=True)
-        r.hset(f"job:{job_id}", "status", "FAILED")
-        r.hset(f"job:{job_id}", "error", str(e))
+        fields = {"status": "FAILED", "error": str(e)}
+        queue_stats.record(
+            job_id, job_type, "FAILED", (datetime.now() - started_at).total_seconds(),
+            fields=fields, event=job_event(job_id, "status", status="FAILED", error=str(e))
+        )
+        return
+    finally:
+        # Released exactly once, whichever way the job ended. A cancelled job
+        # has no outcome and keeps its input for the worker that reclaims it
+        if fields is not None:
+            try:
+                release_job(job_id, job_data, fields)
+            except Exception as e:
+                logger.error(f"Releasing job {job_id} failed: {e}", exc_info=True)
 
-async def process_queue_async():
-    """Process the queue asynchronously"""
-    logger.info("Worker starting...")
-    
+    logger.info(f"Job {job_id} completed successfully in {duration:.2f} seconds")
+    # The job is recorded as completed, a failure from here on must not fail it
+    if "features" in job_data:
+        try:
+            runtime_estimator.fit(json.loads(job_data["features"]), duration)
+        except Exception as e:
+            logger.error(f"Updating the runtime estimator after job {job_id} failed: {e}", exc_info=True)
+
+async def run_claimed_job(entry_id, job_id, job_data):
+    """Run a claimed job, acknowledging it only once it has finished"""
+    logger.info(f"Processing job: {job_id}")
+    keepalive = asyncio.create_task(job_queue.keep_claimed(entry_id, job_id))
+    try:
+        await process_job(job_id, job_data)
+    finally:
+        keepalive.cancel()
+    job_queue.ack(entry_id, job_id)
+
+async def send_heartbeats(running):
+    """Keep this worker's heartbeat, capacity and jobs visible"""
     while True:
-        # Get job from queue, non-blocking
-        job_id_bytes = r.lpop("simulation_queue")  
-        if not job_id_bytes:
-            await asyncio.sleep(1)
-            continue
-        
-        job_id = job_id_bytes.decode()
-        logger.info(f"Processing job: {job_id}")
-        
-        # Process the job
-        await process_job(job_id)
+        job_queue.advertise(WORKER_CONCURRENCY, list(running.values()))
+        await asyncio.sleep(WORKER_TTL / 3)
+
+async def reap_lost_jobs():
+    """Requeue the jobs of workers that stopped sending heartbeats"""
+    while True:
+        await asyncio.sleep(WORKER_TTL)
+        try:
+            requeued = job_queue.reap()
+            if requeued:
+                logger.warning(f"Requeued {requeued} jobs of lost workers")
+        except redis.RedisError as e:
+            logger.error(f"Reaping lost jobs failed: {e}")
+
+async def process_queue_async():
+    """Process the queue asynchronously, up to WORKER_CONCURRENCY jobs at once"""
+    logger.info(f"Worker starting with capacity for {WORKER_CONCURRENCY} concurrent jobs...")
+    job_queue.ensure_group()
+    moved = job_queue.migrate_legacy_queue()
+    if moved:
+        logger.info(f"Moved {moved} jobs from the legacy list queue")
+
+    # SIGTERM and SIGINT stop new claims, running jobs are drained before exiting
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stopping.set)
+
+    slots = asyncio.Semaphore(WORKER_CONCURRENCY)
+    # Running job tasks and the ids of their jobs
+    running = {}
+    # Register before claiming, so reapers never mistake this worker for a lost one
+    job_queue.advertise(WORKER_CONCURRENCY, [])
+    background = [
+        asyncio.create_task(send_heartbeats(running)),
+        asyncio.create_task(reap_lost_jobs())
+    ]
+
+    def finished(task):
+        running.pop(task, None)
+        slots.release()
+        job_queue.advertise(WORKER_CONCURRENCY, list(running.values()))
+
+    try:
+        while not stopping.is_set():
+            await slots.acquire()
+            if stopping.is_set():
+                slots.release()
+                break
+            # Block until a job arrives or a stale job can be reclaimed
+            claimed = await job_queue.claim(JOB_FIELDS)
+            if claimed is None:
+                slots.release()
+                continue
+
+            # A job claimed while stopping is still run, it is part of the drain
+            task = asyncio.create_task(run_claimed_job(*claimed))
+            running[task] = claimed[1]
+            task.add_done_callback(finished)
+            job_queue.advertise(WORKER_CONCURRENCY, list(running.values()))
+
+        logger.info(f"Worker stopping, draining {len(running)} running jobs...")
+        await asyncio.gather(*running, return_exceptions=True)
+    finally:
+        for task in background:
+            task.cancel()
+        job_queue.withdraw()
+    logger.info("Worker stopped")
 
 def main():
     """Main entry point for the worker"""
@@ -87,4 +370,4 @@ def main():
         logger.error(f"Worker crashed: {e}", exc_info=True)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -6,6 +6,7 @@ from fastapi.middleware.cors import CORSMiddleware
 from models import create_db_and_tables
 from core.bliz import BlizzardAPIClient
 from core.simc import SimcClient
+from core.backplane import get_backplane
 from core.websocket import WebSocketManager
 from routes import (
     account, 
@@ -26,12 +27,15 @@ async def lifespan(app: FastAPI):
     # Create singleton instances that will be shared across all requests
     app.state.blizzard_client = BlizzardAPIClient()
     app.state.simc_client = SimcClient()
-    app.state.websocket_manager = WebSocketManager()
+    app.state.websocket_manager = WebSocketManager(get_backplane())
+    await app.state.websocket_manager.start()
     
     yield  # Application is running
     
     # Shutdown: Clean up resources
     await app.state.blizzard_client.close()
+    await app.state.simc_client.close()
+    await app.state.websocket_manager.stop()
 
 app = FastAPI(lifespan=lifespan)
 
@@ -1,5 +1,8 @@
 import asyncio
+import json
+from datetime import datetime
 from typing import List, Optional
+from uuid import uuid4
 
 from fastapi import APIRouter, Depends, HTTPException
 from fastapi.responses import JSONResponse
@@ -8,6 +11,9 @@ from sqlmodel import Session, select, and_
 
 from core.log import log
 from core.bliz import get_blizzard_client, BlizzardAPIClient
+from core.armory import build_simc_profile
+from core.profile import parse_profile
+from routes.simc import encode_input, enqueue_job_group, estimate_wait
 from auth import get_current_user
 from database import get_db
 from models import (
@@ -319,4 +325,85 @@ async def get_roster(
     class_media_results = await asyncio.gather(*class_media_tasks)
     class_media_dict = dict(zip(class_dict.keys(), class_media_results))
     
-    return await prepare_roster_response(roster, class_dict, class_media_dict, race_dict, realm_dict)
\ No newline at end of file
+    return await prepare_roster_response(roster, class_dict, class_media_dict, race_dict, realm_dict)
+
+@router.post("/guild/{realm}/{guild}/{roster_id}/simulate")
+async def simulate_roster(
+    realm: str,
+    guild: str,
+    roster_id: int,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db),
+    bliz: BlizzardAPIClient = Depends(get_blizzard_client)
+):
+    """Queue one batch job simulating every active character of a roster from armory data"""
+    if not current_user:
+        return JSONResponse(status_code=401, content={"detail": "Not authenticated"})
+
+    roster = get_roster_with_checks(realm, guild, roster_id, current_user, db)
+    if not roster:
+        return JSONResponse(
+            status_code=404,
+            content={"detail": "Roster not found or insufficient permissions"}
+        )
+
+    members = [rc for rc in roster.roster_characters if rc.status == RosterStatus.ACTIVE]
+    if not members:
+        return JSONResponse(status_code=400, content={"detail": "Roster has no active characters"})
+
+    access_token = current_user.api_token
+
+    # Armory requests are cached, so repeated batches only fetch changed characters
+    armory = await asyncio.gather(*(
+        asyncio.gather(
+            bliz.get_character_profile(access_token, rc.character.realm, rc.character.name.lower()),
+            bliz.get_character_equipment(access_token, rc.character.realm, rc.character.name.lower()),
+            bliz.get_character_specializations(access_token, rc.character.realm, rc.character.name.lower())
+        ) for rc in members
+    ))
+
+    children, skipped = [], []
+    for rc, (profile, equipment, specializations) in zip(members, armory):
+        character = {
+            "character_id": rc.character.id,
+            "name": rc.character.name,
+            "realm": rc.character.realm,
+            "role": rc.role.value
+        }
+        try:
+            simc_input = build_simc_profile(profile, equipment, specializations)
+            parse_profile(simc_input)
+        except ValueError as e:
+            skipped.append({**character, "reason": str(e)})
+            continue
+        children.append({
+            "type": "batch_member",
+            "character": json.dumps(character),
+            "input": encode_input(simc_input)
+        })
+
+    if not children:
+        return JSONResponse(
+            status_code=400,
+            content={"detail": "No active character has armory data", "skipped": skipped}
+        )
+
+    job_id = str(uuid4())
+    position = enqueue_job_group({
+        "id": job_id,
+        "type": "batch",
+        "roster_id": roster.id,
+        "skipped": json.dumps(skipped),
+        "status": "QUEUED",
+        "owner": f"user:{current_user.id}",
+        "created_at": datetime.now().isoformat()
+    }, children)
+
+    return {
+        "job_id": job_id,
+        "status": "QUEUED",
+        "characters": len(children),
+        "skipped": skipped,
+        "queue_position": position,
+        "estimated_wait": estimate_wait(position)
+    }
@@ -1,28 +1,79 @@
+import asyncio
+from contextlib import aclosing
 from datetime import datetime
 from uuid import uuid4
-from fastapi import APIRouter, HTTPException, WebSocket, WebSocketDisconnect, Depends, websockets
+from fastapi import APIRouter, HTTPException, Request, WebSocket, WebSocketDisconnect, Depends, websockets
 from fastapi.responses import HTMLResponse, JSONResponse
-from base64 import b64decode
+from base64 import b64decode, b64encode
+from typing import Any, Dict, List, Optional
 import json
+import os
 
 from pydantic import BaseModel
 import redis
+import redis.asyncio as aioredis
 
 from core.simc import SimcClient, get_simc_client
+from core.topgear import build_combinations
+from core.sharding import shard_inputs
+from core.profile import parse_profile
+from core.statweights import SIMC_STAT_WEIGHT_DELTA, stat_weight_inputs
+from core.cache import create_simc_cache_key, get_cached_simc_summary
 from core.websocket import WebSocketManager, get_websocket_manager
 from core.log import log
+from core.metrics import metrics
+from core.queue import BULK_JOB_TYPES, JobQueue
+from core.queuestats import QueueStats
+from core.estimator import SHORTEST_JOB_FIRST, RuntimeEstimator, job_features
+from core.jobevents import job_channel, job_snapshot
+from auth import get_current_user
+from models import User
 
 router = APIRouter()
 r = redis.Redis(host='localhost', port=6379, db=0)
+# Pub/sub needs a client that does not block the event loop while it waits
+async_redis = aioredis.Redis(host='localhost', port=6379, db=0)
+job_queue = JobQueue(r)
+queue_stats = QueueStats(r)
+runtime_estimator = RuntimeEstimator(r)
+
+# Jobs one websocket client may watch at once
+MAX_WATCHED_JOBS = int(os.getenv("SIMC_MAX_WATCHED_JOBS", "100"))
+# Seconds an adaptive simulation waits for the client to ask for the refine pass
+REFINE_DECISION_TIMEOUT = float(os.getenv("SIMC_REFINE_DECISION_TIMEOUT", "300"))
 
 class SimulationInput(BaseModel):
     simc_input: str
+    # Split the iterations over this many queue jobs, see core.sharding
+    shards: int = 1
+
+class TopGearInput(BaseModel):
+    simc_input: str
+    # Candidate items by SimC slot, see core.topgear.GearItem for the item fields
+    candidates: Dict[str, List[Dict[str, Any]]]
+
+def decode_simc_input(simc_input: str) -> str:
+    """Decode a base64 profile and validate it, raising ValueError before any SimC run"""
+    try:
+        decoded_input = b64decode(simc_input).decode("utf-8")
+    except ValueError as e:
+        raise ValueError(f"Failed to decode input: {e}")
+    parse_profile(decoded_input)
+    return decoded_input
+
+class StatWeightsInput(BaseModel):
+    simc_input: str
+    # Stats to weigh, see core.statweights.STATS, defaults to the primary and secondary stats
+    stats: Optional[List[str]] = None
 
 @router.post("/simulate", response_class=HTMLResponse)
 async def run_simulation(simulation: SimulationInput, simc_client: SimcClient = Depends(get_simc_client)):
     """Existing endpoint for backward compatibility"""
     try:
-        decoded_input = b64decode(simulation.simc_input).decode("utf-8")
+        decoded_input = decode_simc_input(simulation.simc_input)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    try:
         output_file = await simc_client.run_simulation(decoded_input)
         with open(output_file, "r") as f:
             content = f.read()
@@ -36,7 +87,17 @@ async def stream_simulation(
     websocket_manager: WebSocketManager = Depends(get_websocket_manager),
     simc_client: SimcClient = Depends(get_simc_client)
 ):
-    """WebSocket endpoint for streaming simulation output"""
+    """WebSocket endpoint for streaming simulation output.
+
+    With `"mode": "adaptive"` a coarse pass is run first and its numbers sent
+    as a "preliminary" message; the refine pass only runs once the client
+    sends `{"action": "refine"}`, or straight away if it sent `"refine": true`.
+
+    Other runs start with a "run" message naming the run and number every
+    message with `seq`. A client that lost its connection sends
+    `{"resume": run_id, "last_seq": n}` instead of an input to get the
+    messages after `n`, on whichever API process it reconnects to.
+    """
     client_id = None
     try:
         client_id = await websocket_manager.connect(websocket)
@@ -45,6 +106,7 @@ async def stream_simulation(
         # Wait for simulation input
         try:
             data = await websocket.receive_text()
+            websocket_manager.touch(client_id)
         except Exception as e:
             print(f"Error receiving initial message: {e}")
             await websocket_manager.send_message(client_id, {"type": "error", "content": f"Failed to receive input: {str(e)}"})
@@ -57,65 +119,135 @@ async def stream_simulation(
             await websocket_manager.send_message(client_id, {"type": "error", "content": f"Invalid JSON format: {str(e)}"})
             return
         
-        if "simc_input" not in message:
-            await websocket_manager.send_message(client_id, {"type": "error", "content": "simc_input required"})
-            return
-            
-        # Decode and start simulation
-        try:
-            decoded_input = b64decode(message["simc_input"]).decode("utf-8")
-        except Exception as e:
-            print(f"Base64 decode error: {e}")
-            await websocket_manager.send_message(client_id, {"type": "error", "content": f"Failed to decode input: {str(e)}"})
-            return
-        
-        print(f"Starting simulation for client {client_id}")
-        
-        # Stream simulation output
+        # Messages the client sends while the simulation runs
+        client_messages: asyncio.Queue = asyncio.Queue()
+
+        if "resume" in message:
+            try:
+                last_seq = int(message.get("last_seq", 0))
+            except (TypeError, ValueError):
+                await websocket_manager.send_message(client_id, {"type": "error", "content": "last_seq must be a number"})
+                return
+            outputs_source = await simc_client.resume_simulation(str(message["resume"]), last_seq)
+            if outputs_source is None:
+                await websocket_manager.send_message(client_id, {"type": "error", "content": "Simulation run not found, it may have expired"})
+                return
+            log.info(f"Client {client_id} resuming run {message['resume']} after {last_seq}")
+        else:
+            if "simc_input" not in message:
+                await websocket_manager.send_message(client_id, {"type": "error", "content": "simc_input required"})
+                return
+
+            # Decode and start simulation
+            try:
+                decoded_input = decode_simc_input(message["simc_input"])
+            except Exception as e:
+                log.info(f"Invalid input from client {client_id}: {e}")
+                await websocket_manager.send_message(client_id, {"type": "error", "content": str(e)})
+                return
+
+            print(f"Starting simulation for client {client_id}")
+
+            async def should_refine(preliminary: dict) -> bool:
+                """Wait for the client to ask for, or decline, the refine pass"""
+                if message.get("refine") is True:
+                    return True
+                while True:
+                    try:
+                        reply = await asyncio.wait_for(client_messages.get(), timeout=REFINE_DECISION_TIMEOUT)
+                    except asyncio.TimeoutError:
+                        return False
+                    if reply.get("action") in ("refine", "stop"):
+                        return reply["action"] == "refine"
+
+            if message.get("mode") == "adaptive":
+                try:
+                    target_error = float(message["target_error"]) if message.get("target_error") else None
+                except (TypeError, ValueError):
+                    await websocket_manager.send_message(client_id, {"type": "error", "content": "target_error must be a number"})
+                    return
+                outputs_source = simc_client.stream_adaptive(decoded_input, should_refine, target_error)
+            else:
+                outputs_source = simc_client.stream_simulation(decoded_input)
+
+        # Stream simulation output until it completes or the client goes away
+        async def relay_output():
+            async with aclosing(outputs_source) as outputs:
+                async for output in outputs:
+                    msg_type = output.get("type")
+                    content = output.get("content")
+                    progress = output.get("progress", None)
+                    # Frames of resumable runs keep their number
+                    numbered = {"seq": output["seq"]} if "seq" in output else {}
+
+                    if msg_type == "stdout":
+                        # Send progress update
+                        success = await websocket_manager.send_message(client_id, {
+                            "type": "progress",
+                            "content": content,
+                            "progress": progress,
+                            **numbered
+                        })
+                    elif msg_type == "stderr":
+                        success = await websocket_manager.send_message(client_id, {
+                            "type": "error",
+                            "content": content,
+                            **numbered
+                        })
+                    elif msg_type == "error":
+                        success = await websocket_manager.send_message(client_id, {
+                            "type": "error",
+                            "content": content,
+                            **numbered
+                        })
+                    elif msg_type == "result":
+                        # Send HTML as "output"
+                        success = await websocket_manager.send_message(client_id, {
+                            "type": "output",
+                            "content": content,
+                            **numbered
+                        })
+                        # Then send "complete"
+                        await websocket_manager.send_message(client_id, {
+                            "type": "complete"
+                        })
+                    elif msg_type in ("stage", "preliminary", "run", "gap"):
+                        success = await websocket_manager.send_message(client_id, output)
+                    elif msg_type == "final":
+                        success = await websocket_manager.send_message(client_id, output)
+                        await websocket_manager.send_message(client_id, {
+                            "type": "complete"
+                        })
+
+                    if not success:
+                        print(f"Failed to send message to {client_id}, client likely disconnected")
+                        break
+
+        relay_task = asyncio.create_task(relay_output())
+        disconnect_task = asyncio.create_task(receive_client_messages(websocket, client_messages, websocket_manager, client_id))
         try:
-            async for output in simc_client.stream_simulation(decoded_input):
-                msg_type = output.get("type")
-                content = output.get("content")
-                progress = output.get("progress", None)
-
-                if msg_type == "stdout":
-                    # Send progress update
-                    success = await websocket_manager.send_message(client_id, {
-                        "type": "progress",
-                        "content": content,
-                        "progress": progress
-                    })
-                elif msg_type == "stderr":
-                    success = await websocket_manager.send_message(client_id, {
-                        "type": "error",
-                        "content": content
-                    })
-                elif msg_type == "error":
-                    success = await websocket_manager.send_message(client_id, {
-                        "type": "error",
-                        "content": content
-                    })
-                elif msg_type == "result":
-                    # Send HTML as "output"
-                    success = await websocket_manager.send_message(client_id, {
-                        "type": "output",
-                        "content": content
-                    })
-                    # Then send "complete"
-                    await websocket_manager.send_message(client_id, {
-                        "type": "complete"
-                    })
-
-                if not success:
-                    print(f"Failed to send message to {client_id}, client likely disconnected")
-                    break
+            done, _ = await asyncio.wait(
+                {relay_task, disconnect_task},
+                return_when=asyncio.FIRST_COMPLETED
+            )
+        finally:
+            # Cancelling the relay closes the output stream, which stops SimC
+            # if no other client is subscribed to the same run or resumes it
+            relay_task.cancel()
+            disconnect_task.cancel()
+            await asyncio.gather(relay_task, disconnect_task, return_exceptions=True)
 
-        except Exception as e:
-            print(f"Error during simulation streaming: {e}")
-            await websocket_manager.send_message(client_id, {
-                "type": "error",
-                "content": f"Simulation error: {str(e)}"
-            })
+        if relay_task in done:
+            try:
+                relay_task.result()
+            except Exception as e:
+                print(f"Error during simulation streaming: {e}")
+                await websocket_manager.send_message(client_id, {
+                    "type": "error",
+                    "content": f"Simulation error: {str(e)}"
+                })
+        else:
+            log.info(f"Client {client_id} disconnected during simulation")
             
     except WebSocketDisconnect:
         print(f"Client {client_id} disconnected normally")
@@ -131,32 +263,209 @@ async def stream_simulation(
                 pass  # Client likely already disconnected
     finally:
         if client_id:
-            websocket_manager.disconnect(client_id)
+            await websocket_manager.close(client_id)
             print(f"Cleaned up client {client_id}")
 
+async def receive_client_messages(
+    websocket: WebSocket,
+    messages: asyncio.Queue,
+    websocket_manager: WebSocketManager,
+    client_id: str
+) -> None:
+    """Queue JSON messages from the client, returns once it disconnects.
+
+    Every message, heartbeat answers included, counts as a sign of life.
+    """
+    try:
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                return
+            websocket_manager.touch(client_id)
+            try:
+                data = json.loads(message.get("text") or "")
+            except json.JSONDecodeError:
+                continue
+            if isinstance(data, dict) and data.get("type") != "pong":
+                messages.put_nowait(data)
+    except Exception:
+        return
+
+def estimate_wait(position: int, job_duration: Optional[float] = None) -> float:
+    """Seconds until a job at `position` starts, given the estimates of the queued jobs and the live workers' capacity"""
+    if job_duration is None:
+        job_duration = job_queue.mean_estimate() or queue_stats.average_duration() or 30
+    return position * job_duration / max(1, job_queue.total_capacity())
+
+async def get_job_owner(request: Request, current_user: Optional[User] = Depends(get_current_user)) -> str:
+    """Who queued jobs count against for fair sharing, the user or else the client address"""
+    if current_user:
+        return f"user:{current_user.id}"
+    return f"ip:{request.client.host if request.client else 'unknown'}"
+
+def queued_job(job: dict, features: Optional[Dict[str, float]] = None) -> dict:
+    """Arguments of JobQueue.enqueue for a job, with its runtime estimated from `features`.
+
+    The job's base64 `input` is stored decoded as a shared payload instead of in its hash.
+    """
+    job = dict(job)
+    input_text = b64decode(job.pop("input")).decode("utf-8")
+    # By default the features of the job's own input
+    if features is None:
+        features = job_features(input_text)
+    return {
+        "job_id": job["id"],
+        "owner": job.get("owner", "anonymous"),
+        "lane": "bulk" if job.get("type") in BULK_JOB_TYPES else "interactive",
+        "estimate": runtime_estimator.predict(features),
+        "shortest_first": SHORTEST_JOB_FIRST,
+        "fields": {**job, "features": json.dumps(features)},
+        "payload": input_text
+    }
+
+def enqueue_job(job: dict, features: Optional[Dict[str, float]] = None) -> int:
+    """Store a job and add it to its owner's queue in one round trip, returns its queue position.
+
+    A simulation of the same profile as one already queued or running is not
+    queued again, it waits on that job and completes with its result.
+    """
+    queued = queued_job(job, features)
+    if job.get("type", "simulation") == "simulation":
+        queued["coalesce_key"] = f"coalesce:{create_simc_cache_key(queued['payload'])}"
+    return job_queue.enqueue(**queued)
+
+def enqueue_job_group(job: dict, children: List[dict]) -> int:
+    """Store a parent job and queue its child jobs, returns the last child's position.
+
+    The worker that finishes the last child records the parent's result.
+    """
+    # Only the children run, the parent does not keep the whole input
+    job = {**job, "children": len(children), "children_completed": 0}
+    job.pop("input", None)
+    return job_queue.enqueue_group(job, [
+        queued_job({
+            "id": f"{job['id']}:{index}",
+            "parent_id": job["id"],
+            "index": index,
+            "children": len(children),
+            "status": "QUEUED",
+            "owner": job.get("owner", "anonymous"),
+            "created_at": job["created_at"],
+            **child
+        })
+        for index, child in enumerate(children)
+    ])
+
+def encode_input(input_text: str) -> str:
+    return b64encode(input_text.encode("utf-8")).decode()
+
 @router.post("/simulate/async")
 async def queue_simulation(
     simulation: SimulationInput,
-    simc_client: SimcClient = Depends(get_simc_client)
+    simc_client: SimcClient = Depends(get_simc_client),
+    owner: str = Depends(get_job_owner)
 ):
-    """Existing async endpoint"""
+    """Existing async endpoint, with `shards` > 1 the iterations run as parallel jobs"""
     job_id = str(uuid4())
     job = {
         "id": job_id,
         "input": simulation.simc_input,
         "status": "QUEUED",
+        "owner": owner,
         "created_at": datetime.now().isoformat()
     }
     
-    r.hset(f"job:{job_id}", mapping=job)
-    r.rpush("simulation_queue", job_id)
-    position = r.llen("simulation_queue")
+    try:
+        decoded_input = decode_simc_input(simulation.simc_input)
+        inputs = shard_inputs(decoded_input, simulation.shards) if simulation.shards > 1 else None
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    if inputs:
+        position = enqueue_job_group(
+            {**job, "type": "sharded"},
+            [{"type": "shard", "input": encode_input(shard_input)} for shard_input in inputs]
+        )
+    else:
+        position = enqueue_job(job)
     
     return JSONResponse({
         "job_id": job_id,
         "status": "QUEUED",
         "queue_position": position,
-        "estimated_wait": position * 30
+        "estimated_wait": estimate_wait(position)
+    })
+
+@router.post("/simulate/topgear")
+async def queue_top_gear(top_gear: TopGearInput, owner: str = Depends(get_job_owner)):
+    """Queue a top gear job ranking every valid combination of candidate items"""
+    try:
+        decoded_input = decode_simc_input(top_gear.simc_input)
+        combinations = build_combinations(decoded_input, top_gear.candidates)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if not combinations:
+        raise HTTPException(status_code=400, detail="Candidates do not produce any gear combination")
+
+    job_id = str(uuid4())
+    job = {
+        "id": job_id,
+        "type": "topgear",
+        "input": top_gear.simc_input,
+        "candidates": json.dumps(top_gear.candidates),
+        "status": "QUEUED",
+        "owner": owner,
+        "created_at": datetime.now().isoformat()
+    }
+
+    position = enqueue_job(job, job_features(decoded_input, profilesets=len(combinations)))
+
+    return JSONResponse({
+        "job_id": job_id,
+        "status": "QUEUED",
+        "combinations": len(combinations),
+        "queue_position": position,
+        "estimated_wait": estimate_wait(position)
+    })
+
+@router.post("/simulate/statweights")
+async def queue_stat_weights(stat_weights: StatWeightsInput, owner: str = Depends(get_job_owner)):
+    """Queue a stat weight job, the baseline and every stat's delta run as separate jobs"""
+    try:
+        decoded_input = decode_simc_input(stat_weights.simc_input)
+        baseline_input, stat_inputs = stat_weight_inputs(decoded_input, stat_weights.stats)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    job = {
+        "id": str(uuid4()),
+        "type": "statweights",
+        "delta": SIMC_STAT_WEIGHT_DELTA,
+        "status": "QUEUED",
+        "owner": owner,
+        "created_at": datetime.now().isoformat()
+    }
+    children = [
+        {"type": "stat_weight", "stat": stat, "input": encode_input(stat_input)}
+        for stat, stat_input in stat_inputs.items()
+    ]
+
+    # The baseline only depends on the profile, skip it when a recent job ran it
+    baseline = get_cached_simc_summary(baseline_input)
+    if baseline is not None:
+        job["baseline"] = json.dumps(baseline)
+    else:
+        children.append({"type": "stat_weight", "stat": "baseline", "input": encode_input(baseline_input)})
+
+    position = enqueue_job_group(job, children)
+
+    return JSONResponse({
+        "job_id": job["id"],
+        "status": "QUEUED",
+        "runs": len(children),
+        "baseline_cached": baseline is not None,
+        "queue_position": position,
+        "estimated_wait": estimate_wait(position)
     })
 
 @router.get("/simulate/status/{job_id}")
@@ -168,17 +477,103 @@ async def get_job_status(job_id: str):
     
     job = {k.decode(): v.decode() for k, v in job_data.items()}
     
+    # Jobs split into child jobs report how many children have finished
+    if "children" in job:
+        children = int(job["children"])
+        job["progress"] = int(job["children_completed"]) / children if children else 0.0
+
     if job["status"] == "QUEUED":
-        queue = r.lrange("simulation_queue", 0, -1)
-        try:
-            position = next(i for i, j_id in enumerate(queue) if j_id.decode() == job_id) + 1
-            job["queue_position"] = position
-            job["estimated_wait"] = position * 30
-        except StopIteration:
-            job["queue_position"] = 0
+        # Coalesced jobs start when the job they wait on does
+        position = job_queue.position(job.get("coalesced_with", job_id))
+        job["queue_position"] = position
+        if position:
+            job["estimated_wait"] = estimate_wait(position)
     
     return JSONResponse(job)
 
+@router.websocket("/simulate/jobs")
+async def watch_jobs(
+    websocket: WebSocket,
+    websocket_manager: WebSocketManager = Depends(get_websocket_manager)
+):
+    """WebSocket endpoint pushing the status changes and progress of queued jobs.
+
+    Clients send `{"action": "subscribe", "job_ids": [...]}`, or "unsubscribe",
+    and get a "snapshot" of each job followed by its "status" and "progress"
+    events as workers publish them.
+
+    The server sends `{"type": "ping"}` every WS_HEARTBEAT_INTERVAL seconds
+    and clients answer `{"type": "pong"}`. A client that sends nothing for
+    WS_HEARTBEAT_TIMEOUT seconds, pongs included, is disconnected.
+    """
+    client_id = await websocket_manager.connect(websocket)
+    pubsub = async_redis.pubsub()
+    watched = set()
+    subscribed = asyncio.Event()
+    client_messages: asyncio.Queue = asyncio.Queue()
+
+    async def handle_requests():
+        while True:
+            request = await client_messages.get()
+            job_ids = request.get("job_ids")
+            if not isinstance(job_ids, list) or not all(isinstance(job_id, str) for job_id in job_ids):
+                await websocket_manager.send_message(client_id, {"type": "error", "content": "job_ids must be a list of job ids"})
+                continue
+
+            if request.get("action") == "unsubscribe":
+                channels = [job_channel(job_id) for job_id in job_ids if job_id in watched]
+                if channels:
+                    await pubsub.unsubscribe(*channels)
+                watched.difference_update(job_ids)
+                continue
+            if request.get("action") != "subscribe":
+                await websocket_manager.send_message(client_id, {"type": "error", "content": "action must be subscribe or unsubscribe"})
+                continue
+
+            for job_id in job_ids:
+                if job_id in watched:
+                    continue
+                if len(watched) >= MAX_WATCHED_JOBS:
+                    await websocket_manager.send_message(client_id, {"type": "error", "job_id": job_id, "content": f"At most {MAX_WATCHED_JOBS} jobs can be watched"})
+                    break
+                # Subscribe before reading the snapshot so no event falls in between
+                await pubsub.subscribe(job_channel(job_id))
+                subscribed.set()
+                job_data = await async_redis.hgetall(f"job:{job_id}")
+                if not job_data:
+                    await pubsub.unsubscribe(job_channel(job_id))
+                    await websocket_manager.send_message(client_id, {"type": "error", "job_id": job_id, "content": "Job not found"})
+                    continue
+                watched.add(job_id)
+                job = {k.decode(): v.decode() for k, v in job_data.items()}
+                await websocket_manager.send_message(client_id, job_snapshot(job_id, job))
+
+    async def relay_events():
+        await subscribed.wait()
+        while True:
+            message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+            if message is None or message["type"] != "message":
+                continue
+            if not await websocket_manager.send_message(client_id, json.loads(message["data"])):
+                return
+
+    tasks = [
+        asyncio.create_task(receive_client_messages(websocket, client_messages, websocket_manager, client_id)),
+        asyncio.create_task(handle_requests()),
+        asyncio.create_task(relay_events())
+    ]
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            if not task.cancelled() and task.exception() is not None:
+                log.error(f"Error watching jobs for client {client_id}", exc_info=task.exception())
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await pubsub.aclose()
+        await websocket_manager.close(client_id)
+
 @router.get("/simulate/result/{job_id}", response_class=HTMLResponse)
 async def get_job_result(job_id: str):
     """Existing result endpoint"""
@@ -191,6 +586,10 @@ async def get_job_result(job_id: str):
     if job["status"] != "COMPLETED":
         raise HTTPException(status_code=400, detail=f"Job is {job['status']}, not complete")
     
+    # Jobs like top gear store a JSON result instead of an HTML report
+    if "result" in job:
+        return JSONResponse(json.loads(job["result"]))
+    
     try:
         with open(job["result_path"], "r") as f:
             content = f.read()
@@ -200,31 +599,39 @@ async def get_job_result(job_id: str):
 
 @router.get("/queue/status")
 async def queue_status():
-    """Existing queue status endpoint"""
-    queue_length = r.llen("simulation_queue")
-    active_jobs = r.keys("job:*")
-    active_jobs_count = len(active_jobs)
-    
-    completed_jobs = [
-        {k.decode(): v.decode() for k, v in r.hgetall(job_key).items()}
-        for job_key in active_jobs  
-        if r.hget(job_key, "status").decode() == "COMPLETED"
-        and r.hexists(job_key, "duration")
-    ]
-    
-    avg_duration = 30  # Default assumption
-    if completed_jobs:
-        durations = [float(job["duration"]) for job in completed_jobs[-10:] if "duration" in job]
-        if durations:
-            avg_duration = sum(durations) / len(durations)
+    """Queue length, worker load and statistics of finished jobs, kept up to date by the workers"""
+    queue_length = job_queue.length()
+    workers = job_queue.live_workers()
+    stats = queue_stats.snapshot()
+    avg_duration = stats["duration_ewma"] or 30  # Default assumption until a job finishes
+    capacity = sum(worker["capacity"] for worker in workers)
     
     return {
         "queue_length": queue_length,
-        "active_jobs": active_jobs_count,
+        "active_jobs": sum(worker["in_flight"] for worker in workers),
         "avg_job_duration": avg_duration,
-        "estimated_wait_for_new_job": queue_length * avg_duration
+        "duration_percentiles": stats["duration_percentiles"],
+        "jobs": stats["counters"],
+        "workers": {worker["id"]: worker["in_flight"] for worker in workers},
+        "worker_capacity": capacity,
+        "estimated_wait_for_new_job": queue_length * (job_queue.mean_estimate() or avg_duration) / max(1, capacity)
+    }
+
+@router.get("/workers")
+async def list_workers():
+    """Live worker nodes with their capacity, load and in-flight jobs"""
+    workers = job_queue.live_workers()
+    return {
+        "workers": workers,
+        "capacity": sum(worker["capacity"] for worker in workers),
+        "in_flight": sum(worker["in_flight"] for worker in workers)
     }
 
+@router.get("/simulate/metrics")
+async def simulation_metrics():
+    """Process level simulation and connection metrics"""
+    return metrics.snapshot()
+
 import json
 
 @router.websocket("/test-socket")
@@ -246,10 +653,13 @@ async def test_websocket_connection(
             # Keep connection open and echo messages
             while True:
                 data = await websocket.receive_text()
+                websocket_manager.touch(client_id)
                 log.info(f"Received test message: {data[:50]}...")
                 
                 try:
                     parsed = json.loads(data)
+                    if isinstance(parsed, dict) and parsed.get("type") == "pong":
+                        continue
                     # Echo back with timestamp
                     response = {
                         "type": "echo",
@@ -276,4 +686,4 @@ async def test_websocket_connection(
         except:
             pass
     finally:
-        websocket_manager.disconnect(client_id)
\ No newline at end of file
+        await websocket_manager.close(client_id)
\ No newline at end of file
@@ -0,0 +1,30 @@
+import fakeredis
+import pytest
+
+from core.estimator import DEFAULT_MAX_TIME, RuntimeEstimator, job_features
+
+PROFILE = "rogue=Name\nspec=outlaw\n"
+
+
+def test_counts_players_and_profilesets():
+    features = job_features(PROFILE + 'profileset."A"+=head=,id=1\nprofileset."B"+=head=,id=2\n')
+    assert features["runs"] == 3.0
+
+
+def test_longer_fights_cost_more():
+    short = job_features(PROFILE + f"max_time={DEFAULT_MAX_TIME}\n")
+    long = job_features(PROFILE + f"max_time={DEFAULT_MAX_TIME * 2}\n")
+    assert long["iteration_work"] == pytest.approx(2 * short["iteration_work"])
+
+
+@pytest.mark.parametrize("option", ["max_time=abc", "max_time=nan", "target_error=abc", "target_error=-1"])
+def test_unreadable_numbers_fall_back_to_defaults(option):
+    assert job_features(f"{PROFILE}{option}\n") == job_features(PROFILE)
+
+
+def test_fit_moves_predictions_towards_durations():
+    estimator = RuntimeEstimator(fakeredis.FakeRedis())
+    features = job_features(PROFILE)
+    for _ in range(50):
+        estimator.fit(features, 120.0)
+    assert estimator.predict(features) == pytest.approx(120.0, rel=0.05)
@@ -0,0 +1,53 @@
+import random
+
+import pytest
+
+from benchmarks.bench_output_filter import DATA_FILE, LegacySafeOutputFilter
+from core.output_filter import SafeOutputFilter
+
+# Pieces the rules react to, combined at random so rules overlap and rewrite
+# each other's output
+FRAGMENTS = [
+    "/", "/home/", "/tmp/x", "Users/", "=", "PATH=", "LANG=", "SECRET_KEY=", "A_B=",
+    "10.", "0.", "255.", "256.", "1", "24", "..", ".", " ", "  ", "\t", ":",
+    "host", "HOST", "hostname", "Linux", "Darwin", "Windows", "5.15.0", "x", "abc",
+]
+
+
+@pytest.fixture(scope="module")
+def filters():
+    return LegacySafeOutputFilter(), SafeOutputFilter()
+
+
+@pytest.mark.parametrize("line", [
+    "connect 10.0.0.1/24",
+    "2./home/10.0.0..",
+    "Linux box 5.15.0-91 at /home/alice/simc PATH=/usr/bin",
+    "hostname=build-01 TOKEN=abc Users/bob/Desktop",
+    "Generating baseline: 100%",
+    "",
+])
+def test_known_lines_match_legacy(filters, line):
+    legacy, current = filters
+    assert current.filter_line(line) == legacy.filter_line(line)
+
+
+def test_recorded_output_matches_legacy(filters):
+    legacy, current = filters
+    for line in DATA_FILE.read_text().splitlines():
+        assert current.filter_line(line) == legacy.filter_line(line), line
+
+
+def test_random_lines_match_legacy(filters):
+    legacy, current = filters
+    rng = random.Random(27)
+    for _ in range(20000):
+        line = "".join(rng.choice(FRAGMENTS) for _ in range(rng.randint(1, 12)))
+        assert current.filter_line(line) == legacy.filter_line(line), repr(line)
+
+
+def test_masks_addresses_and_secrets():
+    filtered = SafeOutputFilter().filter_line("connect 10.0.0.1/24 API_KEY=hunter2 host=db01")
+    assert "10.0.0" not in filtered
+    assert "hunter2" not in filtered
+    assert "db01" not in filtered
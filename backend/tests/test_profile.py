@@ -0,0 +1,83 @@
+import pytest
+
+from core.profile import SIMC_MAX_ITERATIONS, canonical_profile, parse_profile
+
+PROFILE = """\
+# SimC addon export
+rogue="Some Name"
+level=80
+race=human
+spec=outlaw
+talents=ABCD
+head=,id=1,bonus_id=2/3
+actions.precombat=flask
+actions+=/kick,if=target.debuff.casting.react
+override.bloodlust=0
+external_buffs.power_infusion=1
+enchant_strength=400
+max_time=300
+iterations=1000
+profileset."Combo 1"+=finger1=,id=2
+"""
+
+
+def test_parses_addon_profile():
+    scopes = parse_profile(PROFILE)
+    assert [scope.header for scope in scopes] == [None, 'rogue="Some Name"']
+    assert scopes[1].options["level"] == [("=", "80")]
+    assert scopes[1].options["actions"] == [("+=", "/kick,if=target.debuff.casting.react")]
+
+
+@pytest.mark.parametrize("line", [
+    # Bare tokens are files SimC includes
+    "level=80 /etc/passwd",
+    "/etc/passwd",
+    # Unsafe options after the first token
+    "level=80 json2=/tmp/out.json",
+    "level=80 output=/tmp/out.txt",
+    "level=80 threads=64",
+    "level=80 iterations=100000000",
+    # Options a denylist would miss
+    "json3=/tmp/out.json",
+    "output_file=/tmp/out.txt",
+    "html_profile=/tmp/out.html",
+    "txt=/tmp/out.txt",
+    "save=/tmp/out.simc",
+    # Quoted keys
+    '"json2"=/tmp/out.json',
+    '"json"2=/tmp/out.json',
+    # Variables that expand to an unsafe option
+    "$(name)=json2\n$(name)=/tmp/out.json",
+    "$(file)=/etc/passwd\n$(file)",
+    # Options hidden in a profileset
+    'profileset."Combo 1"+=json2=/tmp/out.json',
+    # Unbalanced quotes hide the rest of the line
+    'level="80 json2=/tmp/out.json',
+])
+def test_rejects_unsafe_tokens(line):
+    with pytest.raises(ValueError):
+        parse_profile(f"rogue=Name\n{line}\n")
+
+
+def test_allows_quoted_values_with_spaces():
+    scopes = parse_profile('rogue=Name\nprofileset."Combo 1"+=finger1=,id=2\n')
+    assert scopes[1].options['profileset."Combo 1"'] == [("+=", "finger1=,id=2")]
+
+
+def test_caps_iterations():
+    parse_profile(f"iterations={SIMC_MAX_ITERATIONS}\nrogue=Name\n")
+    with pytest.raises(ValueError):
+        parse_profile(f"iterations={SIMC_MAX_ITERATIONS + 1}\nrogue=Name\n")
+    with pytest.raises(ValueError):
+        parse_profile("iterations=many\nrogue=Name\n")
+
+
+def test_requires_a_character():
+    with pytest.raises(ValueError):
+        parse_profile("iterations=1000\n")
+
+
+def test_canonical_profile_ignores_order_and_comments():
+    reordered = "\n".join(reversed(PROFILE.splitlines()[2:5]))
+    other = PROFILE.replace("level=80\nrace=human\nspec=outlaw\n", reordered + "\n# comment\n")
+    assert canonical_profile(other) == canonical_profile(PROFILE)
@@ -0,0 +1,119 @@
+import fakeredis
+import pytest
+
+from core import queue
+from core.queue import QUEUE_GROUP, QUEUE_STREAM, JobQueue
+
+
+@pytest.fixture
+def job_queue():
+    return JobQueue(fakeredis.FakeRedis(), consumer="worker")
+
+
+def enqueue(job_queue, job_id, owner, lane="interactive"):
+    return job_queue.enqueue(job_id, owner=owner, lane=lane, fields={"id": job_id, "status": "QUEUED"})
+
+
+def take(job_queue):
+    """Read the ready entry as a worker would, returns (entry id, job id) or None"""
+    response = job_queue.redis.xreadgroup(QUEUE_GROUP, "worker", {QUEUE_STREAM: ">"}, count=1)
+    if not response:
+        return None
+    entry_id, entry = response[0][1][0]
+    return entry_id.decode(), entry[b"job_id"].decode()
+
+
+def dispatch_order(job_queue):
+    """Job ids in the order workers get them, finishing none"""
+    order = []
+    while (taken := take(job_queue)) is not None:
+        order.append(taken[1])
+        job_queue.dispatch()
+    return order
+
+
+def test_owners_take_turns(job_queue, monkeypatch):
+    monkeypatch.setattr(queue, "USER_MAX_IN_FLIGHT", 0)
+    # a1 is dispatched at once, the rest of alice's jobs take turns with bob's
+    for job_id in ("a1", "a2", "a3", "a4"):
+        enqueue(job_queue, job_id, "alice")
+    enqueue(job_queue, "b1", "bob")
+    enqueue(job_queue, "b2", "bob")
+    assert dispatch_order(job_queue) == ["a1", "a2", "b1", "a3", "b2", "a4"]
+
+
+def test_interactive_lane_goes_first(job_queue, monkeypatch):
+    monkeypatch.setattr(queue, "USER_MAX_IN_FLIGHT", 0)
+    enqueue(job_queue, "bulk", "alice", lane="bulk")
+    enqueue(job_queue, "i1", "alice")
+    enqueue(job_queue, "i2", "bob")
+    # The bulk job was ready before the others were queued
+    assert dispatch_order(job_queue) == ["bulk", "i1", "i2"]
+
+
+def test_positions_follow_dispatch_order(job_queue, monkeypatch):
+    monkeypatch.setattr(queue, "USER_MAX_IN_FLIGHT", 0)
+    jobs = [(f"{owner}{index}", owner) for index in range(4) for owner in ("a", "b")[:1 + index % 2]]
+    for job_id, owner in jobs:
+        enqueue(job_queue, job_id, owner)
+    by_position = sorted((job_queue.position(job_id), job_id) for job_id, _ in jobs)
+    assert [position for position, _ in by_position] == list(range(1, len(jobs) + 1))
+    assert [job_id for _, job_id in by_position] == dispatch_order(job_queue)
+
+
+def test_owners_at_their_cap_are_skipped(job_queue, monkeypatch):
+    monkeypatch.setattr(queue, "USER_MAX_IN_FLIGHT", 1)
+    for job_id in ("a1", "a2", "a3"):
+        enqueue(job_queue, job_id, "alice")
+    enqueue(job_queue, "b1", "bob")
+    enqueue(job_queue, "b2", "bob")
+
+    entry_a1, _ = take(job_queue)
+    job_queue.dispatch()
+    assert take(job_queue)[1] == "b1"
+    # Both owners are at their cap, neither has a head left to dispatch
+    assert job_queue.dispatch() == 0
+    assert job_queue.redis.zcard("queue:interactive:heads") == 0
+
+    job_queue.ack(entry_a1, "a1")
+    assert take(job_queue)[1] == "a2"
+    assert (job_queue.position("a3"), job_queue.position("b2")) == (1, 2)
+
+
+def test_requeued_job_goes_first(job_queue, monkeypatch):
+    monkeypatch.setattr(queue, "USER_MAX_IN_FLIGHT", 0)
+    for job_id in ("a1", "a2", "a3"):
+        enqueue(job_queue, job_id, "alice")
+    entry_id, _ = take(job_queue)
+    # A lost worker's job is acknowledged, then requeued
+    job_queue.ack(entry_id, "a1")
+    job_queue.requeue("a1")
+    assert job_queue.position("a1") == 2
+    assert dispatch_order(job_queue) == ["a2", "a1", "a3"]
+    assert job_queue.redis.exists("queue:interactive:owner:alice") == 0
+
+
+def test_only_owners_below_their_cap_have_heads(job_queue, monkeypatch):
+    monkeypatch.setattr(queue, "USER_MAX_IN_FLIGHT", 1)
+    for index in range(200):
+        enqueue(job_queue, f"a{index}", "alice")
+    # a0 is in flight, alice's other jobs wait without a head to scan past
+    assert job_queue.redis.zcard("queue:interactive:heads") == 0
+    take(job_queue)
+    enqueue(job_queue, "b0", "bob")
+    enqueue(job_queue, "c0", "carol")
+    take(job_queue)
+    assert job_queue.redis.zrange("queue:interactive:heads", 0, -1) == [
+        job_queue.redis.hget("job:c0", "queue_member")
+    ]
+
+
+def test_identical_jobs_wait_on_the_queued_one(job_queue, monkeypatch):
+    monkeypatch.setattr(queue, "USER_MAX_IN_FLIGHT", 0)
+    enqueue(job_queue, "a1", "alice")
+    fields = {"status": "QUEUED"}
+    assert job_queue.enqueue("a2", owner="alice", fields=fields, payload="profile", coalesce_key="coalesce:p") == 2
+    assert job_queue.enqueue("b1", owner="bob", fields=fields, payload="profile", coalesce_key="coalesce:p") == 2
+    assert job_queue.redis.hget("job:b1", "coalesced_with") == b"a2"
+    assert job_queue.redis.lrange("job:a2:followers", 0, -1) == [b"b1"]
+    assert dispatch_order(job_queue) == ["a1", "a2"]
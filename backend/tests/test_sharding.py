@@ -0,0 +1,63 @@
+import random
+import statistics
+
+import pytest
+
+from core.sharding import SEED_STRIDE, SIMC_MAX_SHARDS, merge_shards, pool, shard_inputs, shard_summary
+from core.simc import profile_option
+
+PROFILE = "rogue=Name\nspec=outlaw\niterations=1000\n"
+
+
+def test_shards_split_iterations_with_distinct_seeds():
+    inputs = shard_inputs(PROFILE, 4)
+    assert [profile_option(text, "iterations") for text in inputs] == ["250"] * 4
+    assert all(profile_option(text, "target_error") == "0" for text in inputs)
+    seeds = [int(profile_option(text, "seed")) for text in inputs]
+    assert [seed - seeds[0] for seed in seeds] == [index * SEED_STRIDE for index in range(4)]
+
+
+@pytest.mark.parametrize("shards", [0, SIMC_MAX_SHARDS + 1])
+def test_rejects_shard_counts_out_of_range(shards):
+    with pytest.raises(ValueError):
+        shard_inputs(PROFILE, shards)
+
+
+def test_rejects_more_shards_than_iterations():
+    with pytest.raises(ValueError):
+        shard_inputs("rogue=Name\niterations=2\n", 3)
+
+
+def test_pooled_statistics_match_the_whole_sample():
+    rng = random.Random(32)
+    sample = [rng.gauss(100000, 5000) for _ in range(3000)]
+    shards = [sample[:500], sample[500:1700], sample[1700:]]
+    pooled = pool([
+        {"mean": statistics.fmean(shard), "std_dev": statistics.stdev(shard), "count": len(shard)}
+        for shard in shards
+    ])
+    assert pooled["iterations"] == len(sample)
+    assert pooled["mean"] == pytest.approx(statistics.fmean(sample))
+    assert pooled["std_dev"] == pytest.approx(statistics.stdev(sample))
+    assert pooled["error"] == pytest.approx(1.96 * statistics.stdev(sample) / len(sample) ** 0.5)
+
+
+def report(mean, std_dev, iterations, profilesets=()):
+    return {"sim": {
+        "statistics": {"iterations": iterations},
+        "players": [{"name": "Name", "collected_data": {"dps": {"mean": mean, "std_dev": std_dev, "count": iterations}}}],
+        "profilesets": {"results": [
+            {"name": name, "mean": value, "stddev": std_dev, "iterations": iterations} for name, value in profilesets
+        ]},
+    }}
+
+
+def test_merge_pools_players_and_ranks_profilesets():
+    merged = merge_shards([
+        shard_summary(report(1000.0, 10.0, 500, [("A", 900.0), ("B", 1100.0)])),
+        shard_summary(report(1010.0, 10.0, 500, [("A", 910.0), ("B", 1090.0)])),
+    ])
+    assert merged["shards"] == 2
+    assert merged["iterations"] == 1000
+    assert merged["players"][0]["mean"] == pytest.approx(1005.0)
+    assert [result["name"] for result in merged["profilesets"]] == ["B", "A"]
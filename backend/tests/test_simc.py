@@ -0,0 +1,28 @@
+import os
+import subprocess
+import sys
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def default_max_processes(**env):
+    """SIMC_MAX_PROCESSES as a fresh interpreter computes it from `env`"""
+    environment = {k: v for k, v in os.environ.items() if not k.startswith("SIMC_")}
+    environment.update(env)
+    output = subprocess.run(
+        [sys.executable, "-c", "import os; os.cpu_count = lambda: 8; import core.simc as s; print(s.SIMC_MAX_PROCESSES)"],
+        cwd=BACKEND_DIR, env=environment, capture_output=True, text=True, check=True
+    ).stdout
+    return int(output)
+
+
+def test_one_process_when_simc_uses_every_core():
+    assert default_max_processes(SIMC_THREADS="0") == 1
+
+
+def test_processes_fill_cores_at_configured_threads():
+    assert default_max_processes(SIMC_THREADS="2") == 4
+
+
+def test_explicit_limit_wins():
+    assert default_max_processes(SIMC_THREADS="0", SIMC_MAX_PROCESSES="3") == 3
@@ -0,0 +1,146 @@
+import asyncio
+
+import fakeredis
+
+from core import simc
+from core.simc import SimulationRun
+
+
+def frames(queue):
+    items = []
+    while not queue.empty():
+        items.append(queue.get_nowait())
+    return items
+
+
+def run_with_frames(count):
+    run = SimulationRun("key")
+    for index in range(count):
+        run.publish({"type": "progress", "content": f"line {index}"})
+    return run
+
+
+def test_resume_replays_frames_after_last_seq():
+    async def scenario():
+        run = run_with_frames(5)
+        return frames(run.subscribe(after=3))
+
+    run_frame, *replayed = asyncio.run(scenario())
+    assert run_frame["type"] == "run" and run_frame["latest_seq"] == 5
+    assert [frame["seq"] for frame in replayed] == [4, 5]
+
+
+def test_resume_reports_frames_no_longer_kept(monkeypatch):
+    monkeypatch.setattr(simc, "STREAM_REPLAY_FRAMES", 3)
+
+    async def scenario():
+        run = run_with_frames(6)
+        return frames(run.subscribe(after=1))
+
+    _, gap, *replayed = asyncio.run(scenario())
+    assert gap == {"type": "gap", "from_seq": 2, "to_seq": 3}
+    assert [frame["seq"] for frame in replayed] == [4, 5, 6]
+
+
+def test_finished_run_ends_the_replay():
+    async def scenario():
+        run = run_with_frames(2)
+        run.publish(None)
+        run.done = True
+        return frames(run.subscribe(after=2))
+
+    assert asyncio.run(scenario())[-1] is None
+
+
+def test_unknown_run_cannot_be_resumed():
+    client = simc.SimcClient(fakeredis.aioredis.FakeRedis())
+    assert asyncio.run(client.resume_simulation("elsewhere", 0)) is None
+
+
+def test_run_is_resumed_from_another_process(monkeypatch):
+    monkeypatch.setattr(simc, "STREAM_RESUME_GRACE", 0.05)
+    server = fakeredis.FakeServer()
+    owner, other = (simc.SimcClient(fakeredis.aioredis.FakeRedis(server=server)) for _ in range(2))
+
+    async def scenario():
+        finish = asyncio.Event()
+
+        async def run_process(input_text):
+            for index in range(1, 4):
+                yield {"type": "stdout", "content": f"line {index}", "progress": index}
+            await finish.wait()
+            yield {"type": "result", "content": "report"}
+
+        monkeypatch.setattr(owner, "_run_process", run_process)
+        stream = owner.stream_simulation("rogue=Name\n")
+        run_frame = await anext(stream)
+        await anext(stream)
+        await anext(stream)
+        # The client loses its connection after seq 2 and reconnects elsewhere
+        await stream.aclose()
+        resumed = await other.resume_simulation(run_frame["run_id"], 2)
+        following = asyncio.create_task(asyncio.wait_for(collect(resumed), 5))
+        # Followed from the other process, the run outlives the resume grace
+        await asyncio.sleep(0.2)
+        finish.set()
+        return await following
+
+    async def collect(resumed):
+        return [frame async for frame in resumed]
+
+    received = asyncio.run(scenario())
+    assert received[0]["type"] == "run"
+    assert [(frame["type"], frame["seq"]) for frame in received[1:]] == [("stdout", 3), ("result", 4)]
+
+
+def test_adaptive_passes_stream_their_progress(monkeypatch):
+    client = simc.SimcClient()
+
+    async def run_json(input_text, on_progress=None):
+        for percent in (25, 50, 100):
+            on_progress(percent, f"Generating baseline: {percent}%")
+            await asyncio.sleep(0)
+        return {"sim": {"players": [], "profilesets": {"results": []}}}
+
+    async def refine(coarse):
+        return True
+
+    async def scenario():
+        monkeypatch.setattr(client, "run_json", run_json)
+        return [frame async for frame in client.stream_adaptive("rogue=Name\n", refine)]
+
+    stream = asyncio.run(scenario())
+    types = [frame["type"] for frame in stream]
+    assert types[0] == "stage" and types[-1] == "final"
+    coarse, refined = types.index("preliminary"), types.index("stage", 1)
+    assert "stdout" in types[1:coarse] and "stdout" in types[refined:-1]
+    assert [frame["progress"] for frame in stream[1:coarse]][-1] == 100
+
+
+def test_lagging_subscriber_loses_output_frames_for_gaps(monkeypatch):
+    monkeypatch.setattr(simc, "STREAM_SUBSCRIBER_FRAMES", 8)
+
+    async def scenario():
+        run = SimulationRun("key")
+        queue = run.subscribe()
+        # The subscriber reads nothing while the run goes on
+        for index in range(1, 30):
+            run.publish({"type": "stdout", "content": f"line {index}", "progress": index})
+        run.publish({"type": "result", "content": "report"})
+        run.publish(None)
+        return queue.maxsize, frames(queue)
+
+    maxsize, received = asyncio.run(scenario())
+    assert len(received) <= maxsize
+    assert received[0]["type"] == "run"
+    assert received[-2:] == [{"type": "result", "content": "report", "seq": 30}, None]
+    # Every frame is either received or covered by a gap
+    seqs = set()
+    for frame in received[1:-1]:
+        if frame["type"] == "gap":
+            seqs.update(range(frame["from_seq"], frame["to_seq"] + 1))
+        else:
+            seqs.add(frame["seq"])
+    assert seqs == set(range(1, 31))
+    # The latest progress is never lost
+    assert [frame for frame in received if frame and frame["type"] == "stdout"][-1]["progress"] == 29
@@ -0,0 +1,52 @@
+import asyncio
+import json
+from base64 import b64encode
+
+import fakeredis
+import pytest
+from fastapi import HTTPException
+
+from core.statweights import SECONDARY_STATS, stat_weight_inputs, stat_weights
+from routes import simc as simc_routes
+
+PROFILE = "rogue=Name\nspec=outlaw\nlevel=80\n"
+
+
+def test_defaults_to_primary_and_secondary_stats():
+    baseline, inputs = stat_weight_inputs(PROFILE)
+    assert list(inputs) == ["agility", *SECONDARY_STATS]
+    assert "seed=" in baseline
+    assert all(text.startswith(baseline.rstrip("\n")) for text in inputs.values())
+
+
+def test_rejects_empty_and_unknown_stats():
+    with pytest.raises(ValueError):
+        stat_weight_inputs(PROFILE, [])
+    with pytest.raises(ValueError):
+        stat_weight_inputs(PROFILE, ["luck"])
+
+
+def test_empty_stats_request_is_rejected():
+    request = simc_routes.StatWeightsInput(simc_input=b64encode(PROFILE.encode()).decode(), stats=[])
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(simc_routes.queue_stat_weights(request, owner="user"))
+    assert error.value.status_code == 400
+
+
+def test_status_of_job_without_children(monkeypatch):
+    r = fakeredis.FakeRedis()
+    r.hset("job:parent", mapping={"status": "COMPLETED", "children": 0, "children_completed": 0})
+    monkeypatch.setattr(simc_routes, "r", r)
+    response = asyncio.run(simc_routes.get_job_status("parent"))
+    assert json.loads(response.body)["progress"] == 0.0
+
+
+def test_weights_are_normalized_to_the_best_stat():
+    result = stat_weights(
+        {"mean": 1000.0, "error": 0.0},
+        [{"stat": "haste_rating", "mean": 1500.0, "error": 3.0}, {"stat": "agility", "mean": 2000.0, "error": 4.0}],
+        delta=1000
+    )
+    assert [weight["stat"] for weight in result["weights"]] == ["agility", "haste_rating"]
+    assert [weight["normalized"] for weight in result["weights"]] == [1.0, 0.5]
+    assert result["weights"][0]["error"] == pytest.approx(0.004)
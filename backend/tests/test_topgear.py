@@ -0,0 +1,42 @@
+import pytest
+
+from core.topgear import build_combinations
+
+PROFILE = """warrior="Tester"
+spec=fury
+head=,id=100
+finger1=,id=200
+finger2=,id=201
+trinket1=,id=300
+trinket2=,id=301
+"""
+
+
+def test_changes_only_listed_slots():
+    combinations = build_combinations(PROFILE, {"head": [{"id": 101}]})
+    assert [{slot: item.id for slot, item in c.items()} for c in combinations] == [{"head": 101}]
+
+
+def test_equipped_only_pair_candidate_keeps_other_slots():
+    # The only ring candidate is already worn, that must not empty the product
+    profile = PROFILE.replace("finger2=,id=201\n", "")
+    combinations = build_combinations(profile, {"finger1": [{"id": 200}], "head": [{"id": 101}]})
+    assert [{slot: item.id for slot, item in c.items()} for c in combinations] == [{"head": 101}]
+
+
+def test_single_pair_candidate_without_equipped_pair_is_skipped():
+    profile = 'warrior="Tester"\nhead=,id=100\n'
+    combinations = build_combinations(profile, {"trinket1": [{"id": 300}], "head": [{"id": 101}]})
+    assert [{slot: item.id for slot, item in c.items()} for c in combinations] == [{"head": 101}]
+
+
+def test_paired_slots_never_hold_the_same_unique_item():
+    candidates = {"finger1": [{"id": 202, "unique_equipped": True}]}
+    for combination in build_combinations(PROFILE, candidates):
+        rings = [item.id for slot, item in combination.items() if slot.startswith("finger")]
+        assert len(rings) == len(set(rings))
+
+
+def test_unknown_slot_is_rejected():
+    with pytest.raises(ValueError):
+        build_combinations(PROFILE, {"tail": [{"id": 1}]})
@@ -0,0 +1,49 @@
+import asyncio
+
+from core import websocket
+from core.websocket import ClientConnection
+
+
+def drain(connection):
+    messages = []
+    while connection.entries:
+        connection._drop_replaced()
+        if connection.entries:
+            messages.append(connection.entries.popleft()[0])
+    return messages
+
+
+def test_job_progress_keeps_only_the_latest():
+    connection = ClientConnection(websocket=None)
+    for progress in (10, 20, 30):
+        connection.put({"type": "progress", "job_id": "job", "progress": progress})
+    connection.put({"type": "progress", "job_id": "other", "progress": 5})
+    assert drain(connection) == [
+        {"type": "progress", "job_id": "job", "progress": 30},
+        {"type": "progress", "job_id": "other", "progress": 5},
+    ]
+
+
+def test_streamed_output_lines_are_all_sent():
+    connection = ClientConnection(websocket=None)
+    frames = [{"type": "progress", "content": f"line {seq}", "seq": seq} for seq in range(3)]
+    for frame in frames:
+        connection.put(frame)
+    assert drain(connection) == frames
+
+
+def test_futures_of_coalesced_messages_resolve(monkeypatch):
+    monkeypatch.setattr(websocket, "WS_SEND_QUEUE_SIZE", 1)
+
+    async def scenario():
+        loop = asyncio.get_running_loop()
+        connection = ClientConnection(websocket=None)
+        replaced, kept, dropped = (loop.create_future() for _ in range(3))
+        connection.put({"type": "progress", "job_id": "a", "progress": 1}, replaced)
+        connection.put({"type": "progress", "job_id": "a", "progress": 2}, kept)
+        # The queue is full, another job's progress is dropped
+        assert connection.put({"type": "progress", "job_id": "b", "progress": 1}, dropped)
+        assert not connection.put({"type": "status", "job_id": "b"})
+        return replaced.done() and replaced.result(), kept.done(), dropped.done() and dropped.result()
+
+    assert asyncio.run(scenario()) == (True, False, False)
@@ -0,0 +1,91 @@
+import asyncio
+from datetime import datetime
+
+import fakeredis
+import pytest
+
+from core import worker
+from core.queue import JobQueue
+from core.queuestats import QueueStats
+
+
+@pytest.fixture
+def r(monkeypatch):
+    r = fakeredis.FakeRedis()
+    monkeypatch.setattr(worker, "r", r)
+    monkeypatch.setattr(worker, "job_queue", JobQueue(r))
+    monkeypatch.setattr(worker, "queue_stats", QueueStats(r))
+    return r
+
+
+def run_job(job_data):
+    job_data = {"started_at": datetime.now().isoformat(), **job_data}
+    asyncio.run(worker.process_job(job_data["id"], job_data))
+
+
+def test_estimator_failure_keeps_job_completed(r, monkeypatch):
+    async def handler(job_data, decoded_input):
+        return {"result": decoded_input}
+
+    class BrokenEstimator:
+        def fit(self, features, duration):
+            raise RuntimeError("estimator unavailable")
+
+    monkeypatch.setitem(worker.JOB_HANDLERS, "simulation", handler)
+    monkeypatch.setattr(worker, "runtime_estimator", BrokenEstimator())
+    run_job({"id": "job", "payload": "profile", "input_ref": "ref", "features": "{}"})
+
+    assert r.hget("job:job", "status") == b"COMPLETED"
+    assert r.hget("job:job", "result") == b"profile"
+
+
+def payload_refs(r, ref):
+    return int(r.hget(f"payload:{ref}", "refs"))
+
+
+def queue_leader_and_follower(r):
+    """A queued job and a second job coalesced with it, returns the leader's job data"""
+    key = "coalesce:profile"
+    worker.job_queue.enqueue("leader", fields={"status": "QUEUED"}, payload="profile", coalesce_key=key)
+    worker.job_queue.enqueue("follower", fields={"status": "QUEUED"}, payload="profile", coalesce_key=key)
+    assert r.hget("job:follower", "coalesced_with") == b"leader"
+    job_data = {key.decode(): value.decode() for key, value in r.hgetall("job:leader").items()}
+    return {**job_data, "id": "leader", "payload": "profile"}
+
+
+@pytest.mark.parametrize("outcome", ["COMPLETED", "FAILED"])
+def test_leader_and_followers_release_their_references(r, monkeypatch, outcome):
+    async def handler(job_data, decoded_input):
+        if outcome == "FAILED":
+            raise RuntimeError("simc crashed")
+        return {"result": "report"}
+
+    monkeypatch.setitem(worker.JOB_HANDLERS, "simulation", handler)
+    job_data = queue_leader_and_follower(r)
+    ref = job_data["input_ref"]
+    assert payload_refs(r, ref) == 2
+
+    run_job(job_data)
+
+    assert payload_refs(r, ref) == 0
+    assert r.ttl(f"payload:{ref}") > 0
+    assert r.hget("job:follower", "status") == outcome.encode()
+    assert r.hget("job:follower", "input_ref") is None
+
+
+def test_failure_after_completion_releases_once(r, monkeypatch):
+    async def handler(job_data, decoded_input):
+        return {"result": "report"}
+
+    class BrokenEstimator:
+        def fit(self, features, duration):
+            raise RuntimeError("estimator unavailable")
+
+    monkeypatch.setitem(worker.JOB_HANDLERS, "simulation", handler)
+    monkeypatch.setattr(worker, "runtime_estimator", BrokenEstimator())
+    # Another job queued with the same input keeps its own reference
+    worker.job_queue.enqueue("other", fields={"status": "QUEUED"}, payload="profile")
+    job_data = queue_leader_and_follower(r)
+    run_job({**job_data, "features": "{}"})
+
+    assert payload_refs(r, job_data["input_ref"]) == 1
@@ -34,6 +34,11 @@ function AsyncSimulationDisplay({ simcInput, onClose, onComplete }) {
     ws.onmessage = (event) => {
       try {
         const data = JSON.parse(event.data);
+        // Answer heartbeats so the server keeps the connection
+        if (data.type === 'ping') {
+          ws.send(JSON.stringify({ type: 'pong' }));
+          return;
+        }
 
         // The backend sends {type, content, ...}
         // Map backend data to frontend state updates
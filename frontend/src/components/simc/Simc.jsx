@@ -317,6 +317,11 @@ function Simc() {
       socket.onmessage = (event) => {
         try {
           const message = JSON.parse(event.data);
+          // Answer heartbeats so the server keeps the connection
+          if (message.type === 'ping') {
+            socket.send(JSON.stringify({ type: 'pong' }));
+            return;
+          }
           // Possible message types: 'progress', 'output', 'error', 'complete'
           if (message.type === 'error') {
             alert(`Simulation error: ${message.content}`);
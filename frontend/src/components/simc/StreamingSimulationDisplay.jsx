@@ -57,6 +57,11 @@ const StreamingSimulationDisplay = ({ simulationInput, show, onCancel, onComplet
       try {
         addLog(`Received message (size: ${event.data.length})`, 'data');
         const data = JSON.parse(event.data);
+        // Answer heartbeats so the server keeps the connection
+        if (data.type === 'ping') {
+          socket.send(JSON.stringify({ type: 'pong' }));
+          return;
+        }
 
         if (data.type === 'error') {
           addLog(`Error from server: ${data.content}`, 'error');
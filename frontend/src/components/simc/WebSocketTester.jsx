@@ -41,6 +41,11 @@ const WebSocketTester = () => {
         try {
           console.log('Received message:', event.data);
           const parsedData = JSON.parse(event.data);
+          // Answer heartbeats so the server keeps the connection
+          if (parsedData.type === 'ping') {
+            socket.send(JSON.stringify({ type: 'pong' }));
+            return;
+          }
           setMessages(prev => [...prev, {
             ...parsedData,
             received: true,